@@ -0,0 +1,357 @@
+"""
+Reading of gzipped images with seek points and threaded decompression.
+
+The gzip format cannot be decompressed from an arbitrary offset: reading a
+volume at the end of a .nii.gz file normally inflates the whole file. An
+IndexedGzipFile keeps copies of the state of the decompressor at regular
+offsets of the uncompressed stream while it reads, so that later reads
+restart from the nearest seek point. The seek points of the last files
+read are kept, so that the next files opened on them start with the whole
+index. The decompression runs in a background thread, ahead of the reader,
+and zlib releases the GIL while it inflates, so that it overlaps the work
+done on the data already read.
+"""
+
+import bisect
+import os
+import threading
+import weakref
+import zlib
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:  # Python2
+    import Queue as queue
+
+import nibabel as nib
+from nibabel.fileholders import FileHolder
+from nibabel.spatialimages import HeaderDataError
+from sklearn.externals.joblib import (delayed,
+                                      Parallel,
+                                      )
+
+from nistats.utils import _basestring
+
+# uncompressed bytes between two seek points
+DEF_SPACING = 2 ** 22
+# compressed bytes inflated at once
+DEF_CHUNK_SIZE = 2 ** 18
+# the window bits of a zlib decompressor of gzip members
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+# number of files whose seek points are kept
+INDEX_CACHE_SIZE = 8
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+
+class _GzipIndex(object):
+    """Seek points of a gzip file, shared by the IndexedGzipFiles opened on
+    the file: uncompressed offset, compressed offset and decompressor state
+    at each point, and uncompressed size once known."""
+
+    def __init__(self, spacing):
+        self.spacing = spacing
+        self.points = [(0, 0, zlib.decompressobj(_GZIP_WBITS))]
+        self.offsets = [0]
+        self.size = None
+        self._lock = threading.Lock()
+
+    def add_point(self, offset, compressed_offset, decompressor):
+        with self._lock:
+            if offset > self.offsets[-1]:
+                self.points.append((offset, compressed_offset, decompressor))
+                self.offsets.append(offset)
+
+    def nearest_point(self, offset):
+        """The last seek point at or before offset"""
+        with self._lock:
+            return self.points[bisect.bisect_right(self.offsets, offset) - 1]
+
+
+def _gzip_index(filename, spacing):
+    """The index of the gzip file filename, shared while the file is not
+    modified. The indexes of the last INDEX_CACHE_SIZE files are kept."""
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime, spacing)
+    with _index_cache_lock:
+        index = _index_cache.pop(key, None)
+        if index is None:
+            index = _GzipIndex(spacing)
+        # the least recently used indexes are evicted first
+        _index_cache[key] = index
+        while len(_index_cache) > INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
+
+
+class _Inflater(object):
+    """Background thread that inflates a gzip file from a seek point, and
+    puts the (offset, bytes) chunks of the uncompressed stream in a bounded
+    queue, followed by None at the end of the file. The seek points met on
+    the way are added to the index of the file.
+
+    The thread only holds a weak reference to the IndexedGzipFile, and
+    stops when it is closed or garbage collected."""
+
+    def __init__(self, gzip_file, point):
+        # the uncompressed offset at which the inflation starts
+        self.offset = point[0]
+        self.chunks = queue.Queue(maxsize=gzip_file.readahead)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(weakref.ref(gzip_file), gzip_file._index, gzip_file.name,
+                  point))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item, gzip_file_ref):
+        while not self._stop.is_set() and gzip_file_ref() is not None:
+            try:
+                self.chunks.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, gzip_file_ref, index, name, point):
+        offset, compressed_offset, decompressor = point
+        decompressor = decompressor.copy()
+        spacing = index.spacing
+        next_point = (offset // spacing + 1) * spacing
+        # the seek points are taken between chunks
+        chunk_size = max(1, min(DEF_CHUNK_SIZE, spacing // 4))
+        try:
+            with open(name, 'rb') as fileobj:
+                fileobj.seek(compressed_offset)
+                while True:
+                    data = fileobj.read(chunk_size)
+                    if not data:
+                        index.size = offset
+                        self._put(None, gzip_file_ref)
+                        return
+                    compressed_offset += len(data)
+                    chunk = []
+                    while data:
+                        chunk.append(decompressor.decompress(data))
+                        # the data after the end of a gzip member is the
+                        # start of the next member
+                        data = decompressor.unused_data
+                        if data:
+                            decompressor = zlib.decompressobj(_GZIP_WBITS)
+                    chunk = b''.join(chunk)
+                    if chunk and not self._put((offset, chunk),
+                                               gzip_file_ref):
+                        return
+                    offset += len(chunk)
+                    if offset >= next_point:
+                        index.add_point(offset, compressed_offset,
+                                        decompressor.copy())
+                        next_point = (offset // spacing + 1) * spacing
+        except Exception as error:
+            self._put(error, gzip_file_ref)
+
+    def close(self, wait=True):
+        self._stop.set()
+        if wait and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+class IndexedGzipFile(object):
+    """Read-only file object over a gzip file, that indexes the file with
+    seek points while it reads it. The index is shared with the other
+    IndexedGzipFiles of the file with the same spacing, see _gzip_index.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the gzip file.
+
+    spacing : int, optional
+        Number of uncompressed bytes between two seek points. Each seek
+        point holds a decompressor state of about 32KB.
+
+    readahead : int, optional
+        Number of chunks of about DEF_CHUNK_SIZE compressed bytes that the
+        background thread inflates ahead of the reader.
+    """
+
+    def __init__(self, filename, spacing=DEF_SPACING, readahead=8):
+        # fail early on missing files
+        open(filename, 'rb').close()
+        self.name = filename
+        self.spacing = spacing
+        self.readahead = readahead
+        self._index = _gzip_index(filename, spacing)
+        self._inflater = None
+        self._buffer, self._buffer_start = b'', 0
+        self._pos = 0
+        self.closed = False
+
+    def __getstate__(self):
+        # the seek points are rebuilt after unpickling
+        return {'name': self.name, 'spacing': self.spacing,
+                'readahead': self.readahead, 'pos': self._pos}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'], state['spacing'], state['readahead'])
+        self._pos = state['pos']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _restart(self, point):
+        if self._inflater is not None:
+            self._inflater.close()
+        self._buffer, self._buffer_start = b'', point[0]
+        self._inflater = _Inflater(self, point)
+
+    def _fill(self):
+        """Make the buffer hold the byte at the current position, and return
+        False at the end of the file."""
+        end = self._buffer_start + len(self._buffer)
+        if self._buffer_start <= self._pos < end:
+            return True
+        size = self._index.size
+        if size is not None and self._pos >= size:
+            return False
+        point = self._index.nearest_point(self._pos)
+        # the current stream is reused, unless it is past the position or
+        # a seek point is closer to the position
+        if self._inflater is None or self._pos < end or point[0] > end:
+            self._restart(point)
+        while True:
+            item = self._inflater.chunks.get()
+            if item is None:
+                self._buffer_start += len(self._buffer)
+                self._buffer = b''
+                return False
+            if isinstance(item, Exception):
+                self._inflater = None
+                raise IOError('Error while inflating %s: %s'
+                              % (self.name, item))
+            self._buffer_start, self._buffer = item
+            if self._pos < self._buffer_start + len(self._buffer):
+                return True
+
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        view = memoryview(buffer)
+        n_read = 0
+        while n_read < len(view) and self._fill():
+            start = self._pos - self._buffer_start
+            piece = self._buffer[start:start + len(view) - n_read]
+            view[n_read:n_read + len(piece)] = piece
+            n_read += len(piece)
+            self._pos += len(piece)
+        return n_read
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if size is None or size < 0:
+            pieces = []
+            while self._fill():
+                pieces.append(self._buffer[self._pos - self._buffer_start:])
+                self._pos += len(pieces[-1])
+            return b''.join(pieces)
+        buffer = bytearray(size)
+        return bytes(buffer[:self.readinto(buffer)])
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            if self._index.size is None:
+                # the size is only known once the file has been inflated
+                self._pos = float('inf')
+                self._fill()
+            offset += self._index.size
+        if offset < 0:
+            raise ValueError('Negative seek position %d' % offset)
+        self._pos = int(offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def _stop_readahead(self):
+        """Stop the background inflation, which restarts from the nearest
+        seek point at the next read."""
+        if self._inflater is not None:
+            self._inflater.close()
+            self._inflater = None
+        self._buffer = b''
+
+    def write(self, data):
+        # nibabel recognizes file objects by their read and write methods
+        raise IOError('%s is opened for reading only' % self.name)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self._stop_readahead()
+        self.closed = True
+
+    def __del__(self):
+        # stops the background inflation of partly read files, without
+        # waiting: daemon threads do not run at interpreter shutdown
+        inflater = getattr(self, '_inflater', None)
+        if inflater is not None:
+            inflater.close(wait=False)
+
+
+def load_niimg(filename, **kwargs):
+    """Load a NIfTI image, reading .nii.gz files through an IndexedGzipFile.
+
+    The data stays behind the proxy of the image, and partial reads of the
+    data, e.g. of a slab of volumes, restart the decompression from the
+    nearest seek point, including the seek points found by the previous
+    loads of the file. Only the header is inflated here: the background
+    inflation starts when the data are read. kwargs are passed to
+    IndexedGzipFile.
+    """
+    if not filename.endswith('.nii.gz'):
+        return nib.load(filename)
+    fileobj = IndexedGzipFile(filename, **kwargs)
+    for klass in (nib.Nifti1Image, nib.Nifti2Image):
+        try:
+            # memory mapping would inflate the file to find its size
+            img = klass.from_file_map(
+                {'image': FileHolder(fileobj=fileobj)}, mmap=False)
+            fileobj._stop_readahead()
+            return img
+        except HeaderDataError:
+            fileobj.seek(0)
+    fileobj.close()
+    return nib.load(filename)
+
+
+def _load_data(img):
+    if isinstance(img, _basestring):
+        img = load_niimg(img)
+        # caches the data of the image
+        img.get_data()
+    return img
+
+
+def load_niimgs(imgs, n_jobs=1):
+    """Load the images of imgs given as filenames, with their data.
+
+    The files are read and decompressed by n_jobs threads. The other
+    elements of imgs are returned unchanged.
+    """
+    return Parallel(n_jobs=n_jobs, backend='threading')(
+        delayed(_load_data)(img) for img in imgs)
@@ -11,10 +11,13 @@ import numpy as np
 import scipy.stats as sps
 import pandas as pd
 
-from .utils import z_score
+from .regression import PackedRegressionResults, _bin_order
+from .utils import positive_reciprocal, z_score
 
 DEF_TINY = 1e-50
 DEF_DOFMAX = 1e10
+# number of voxels whose F contrast effects are computed at once
+DEF_CHUNK_SIZE = 10000
 
 
 def expression_to_contrast_vector(expression, design_columns):
@@ -35,7 +38,7 @@ def compute_contrast(labels, regression_result, con_val, contrast_type=None):
     labels : array of shape (n_voxels,),
         A map of values on voxels used to identify the corresponding model
 
-    results : dict,
+    results : dict or PackedRegressionResults,
         With keys corresponding to the different labels
         values are RegressionResults instances corresponding to the voxels.
 
@@ -65,34 +68,170 @@ def compute_contrast(labels, regression_result, con_val, contrast_type=None):
             '"{0}" is not a known contrast type. Allowed types are {1}'.
             format(contrast_type, acceptable_contrast_types))
 
+    # effects are stored in the precision of the parameter estimates
+    if isinstance(regression_result, PackedRegressionResults):
+        dtype = regression_result.theta.dtype
+    else:
+        dtype = np.result_type(*[np.asarray(reg.theta).dtype
+                                 for reg in regression_result.values()])
     if contrast_type == 't':
-        effect_ = np.zeros((1, labels.size))
-        var_ = np.zeros(labels.size)
-        for label_ in regression_result:
-            label_mask = labels == label_
-            resl = regression_result[label_].Tcontrast(con_val)
-            effect_[:, label_mask] = resl.effect.T
-            var_[label_mask] = (resl.sd ** 2).T
+        effect_, var_ = _t_contrast(labels, regression_result, con_val, dtype)
     elif contrast_type == 'F':
-        from scipy.linalg import sqrtm
-        effect_ = np.zeros((dim, labels.size))
-        var_ = np.zeros(labels.size)
-        for label_ in regression_result:
-            label_mask = labels == label_
-            reg = regression_result[label_]
-            cbeta = np.atleast_2d(np.dot(con_val, reg.theta))
-            invcov = np.linalg.inv(np.atleast_2d(
-                    reg.vcov(matrix=con_val, dispersion=1.0)))
-            wcbeta = np.dot(sqrtm(invcov), cbeta)
-            rss = reg.dispersion
-            effect_[:, label_mask] = wcbeta
-            var_[label_mask] = rss
-
-    dof_ = regression_result[label_].df_resid
+        effect_, var_ = _F_contrast(labels, regression_result, con_val,
+                                    dtype)
+
+    if isinstance(regression_result, PackedRegressionResults):
+        dof_ = regression_result.df_resid
+    else:
+        dof_ = next(iter(regression_result.values())).df_resid
     return Contrast(effect=effect_, variance=var_, dim=dim, dof=dof_,
                     contrast_type=contrast_type)
 
 
+def _t_contrast(labels, regression_result, con_val, dtype=np.float64):
+    """Compute the effects and variances of the t contrast `con_val` for
+    all the voxels at once
+
+    Returns
+    -------
+    effect : array of shape (1, n_voxels)
+
+    variance : array of shape (n_voxels,)
+    """
+    con_val = np.asarray(con_val)
+    if con_val.ndim == 1:
+        con_val = con_val[np.newaxis]
+    if con_val.shape[0] != 1:
+        raise ValueError("t contrasts should have only one row")
+    effect, variance = _t_contrasts(labels, regression_result, con_val,
+                                    dtype)
+    return effect, variance[0]
+
+
+def _t_contrasts(labels, regression_result, con_vals, dtype=np.float64):
+    """Compute the effects and variances of the t contrasts given by the
+    rows of `con_vals` for all the voxels at once
+
+    The variance factors con_val.cov.con_val^T are computed once per bin
+    and gathered through the bin index of the voxels, instead of masking
+    the voxels of each label.
+
+    Parameters
+    ----------
+    labels : array of shape (n_voxels,)
+        A map of values on voxels used to identify the corresponding model
+
+    regression_result : dict or PackedRegressionResults
+        With keys corresponding to the different labels
+
+    con_vals : array of shape (n_contrasts, n_regressors)
+        One t contrast per row
+
+    dtype : numpy dtype, optional
+        Type of the effects
+
+    Returns
+    -------
+    effects : array of shape (n_contrasts, n_voxels)
+
+    variances : array of shape (n_contrasts, n_voxels)
+    """
+    con_vals = np.atleast_2d(con_vals)
+    if isinstance(regression_result, PackedRegressionResults):
+        n_regressors = regression_result.theta.shape[0]
+    else:
+        n_regressors = np.shape(next(iter(
+            regression_result.values())).theta)[0]
+    if con_vals.shape[1] != n_regressors:
+        raise ValueError("t contrasts should be length P=%d, "
+                         "but this is length %d" % (n_regressors,
+                                                    con_vals.shape[1]))
+
+    if isinstance(regression_result, PackedRegressionResults):
+        effects = np.dot(con_vals.astype(dtype), regression_result.theta)
+        factors = np.einsum('ci,kij,cj->ck', con_vals, regression_result.cov,
+                            con_vals)
+        variances = (factors[:, regression_result.bin_index] *
+                     regression_result.dispersion)
+        return effects, variances
+
+    keys = np.array(sorted(regression_result), dtype=np.float64)
+    bin_index = np.searchsorted(keys, labels)
+    order, bounds = _bin_order(bin_index, keys.size)
+    effects = np.zeros((con_vals.shape[0], labels.size), dtype)
+    variances = np.zeros((con_vals.shape[0], labels.size))
+    for k, key in enumerate(keys):
+        voxels = order[bounds[k]:bounds[k + 1]]
+        result = regression_result[key]
+        effects[:, voxels] = np.dot(con_vals, result.theta)
+        factors = np.einsum('ci,ij,cj->c', con_vals, result.cov, con_vals)
+        variances[:, voxels] = (factors[:, np.newaxis] *
+                                np.asarray(result.dispersion))
+    return effects, variances
+
+
+def _inverse_sqrtm(matrices):
+    """Symmetric inverse square roots of a stack of symmetric positive
+    semi-definite matrices of shape (n, dim, dim); null directions, i.e.
+    eigenvalues below the round-off of the largest one, are left null"""
+    eigvals, eigvecs = np.linalg.eigh(matrices)
+    cutoff = (matrices.shape[-1] * np.finfo(np.float64).eps *
+              np.abs(eigvals).max(axis=-1))
+    scale = np.sqrt(positive_reciprocal(
+        np.where(eigvals > cutoff[:, np.newaxis], eigvals, 0)))
+    return np.einsum('kij,kj,klj->kil', eigvecs, scale, eigvecs)
+
+
+def _F_contrast(labels, regression_result, con_val, dtype=np.float64,
+                chunk_size=DEF_CHUNK_SIZE):
+    """Compute the effects and variances of the F contrast `con_val` for
+    all the voxels
+
+    The contrast effects c.theta of each voxel are whitened by the inverse
+    square root of c.cov.c^T of its bin. The whitening matrices of all the
+    bins come from one stacked eigendecomposition, and the voxels are
+    streamed bin by bin, in chunks of at most `chunk_size` voxels, so that
+    no per-voxel (dim, dim) matrices are built.
+
+    Returns
+    -------
+    effect : array of shape (dim, n_voxels)
+
+    variance : array of shape (n_voxels,)
+    """
+    con_val = np.atleast_2d(con_val)
+    if isinstance(regression_result, PackedRegressionResults):
+        covs, bin_index = regression_result.cov, regression_result.bin_index
+        n_bins = regression_result.rho.size
+    else:
+        keys = np.array(sorted(regression_result), dtype=np.float64)
+        covs = np.array([regression_result[key].cov for key in keys])
+        bin_index = np.searchsorted(keys, labels)
+        n_bins = keys.size
+    whitening = _inverse_sqrtm(
+        np.einsum('ci,kij,dj->kcd', con_val, covs, con_val))
+
+    order, bounds = _bin_order(bin_index, n_bins)
+    effect = np.zeros((con_val.shape[0], labels.size), dtype)
+    variance = np.zeros(labels.size)
+    for k in np.flatnonzero(np.diff(bounds)):
+        voxels = order[bounds[k]:bounds[k + 1]]
+        if isinstance(regression_result, PackedRegressionResults):
+            theta = regression_result.theta
+            dispersion = regression_result.dispersion
+            columns = voxels
+        else:
+            theta = np.asarray(regression_result[keys[k]].theta)
+            dispersion = np.asarray(regression_result[keys[k]].dispersion)
+            columns = np.arange(voxels.size)
+        for start in range(0, voxels.size, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            effect[:, voxels[chunk]] = np.dot(
+                whitening[k], np.dot(con_val, theta[:, columns[chunk]]))
+            variance[voxels[chunk]] = dispersion[columns[chunk]]
+    return effect, variance
+
+
 def _fixed_effect_contrast(labels, results, con_vals, contrast_type=None):
     """Computes the summary contrast assuming fixed effects.
 
@@ -115,15 +254,70 @@ def _fixed_effect_contrast(labels, results, con_vals, contrast_type=None):
     return contrast * (1. / n_contrasts)
 
 
+def _fixed_effect_t_contrasts(labels, results, con_vals):
+    """Computes several summary t contrasts assuming fixed effects, with
+    one pass over the runs.
+
+    Parameters
+    ----------
+    labels : list of arrays of shape (n_voxels,)
+        The labels of each run
+
+    results : list of dicts or PackedRegressionResults
+        The results of each run
+
+    con_vals : list of arrays of shape (n_contrasts, n_regressors)
+        The contrasts of each run, one t contrast per row. As in
+        _fixed_effect_contrast, the runs where a contrast is null are
+        left out of its fixed effect.
+
+    Returns
+    -------
+    contrasts : list of Contrast instances, one per row of con_vals
+    """
+    effects = variances = None
+    n_contrasts = dof = 0
+    for i, (lab, res, con_val) in enumerate(zip(labels, results, con_vals)):
+        con_val = np.atleast_2d(con_val)
+        null = np.all(con_val == 0, axis=1)
+        if null.any():
+            warn('Contrast for session %d is null' % i)
+        if null.all():
+            continue
+        if isinstance(res, PackedRegressionResults):
+            dtype, df_resid = res.theta.dtype, res.df_resid
+        else:
+            result = next(iter(res.values()))
+            dtype, df_resid = np.asarray(result.theta).dtype, result.df_resid
+        effects_, variances_ = _t_contrasts(lab, res, con_val, dtype)
+        effects_[null] = 0
+        variances_[null] = 0
+        if effects is None:
+            effects, variances = effects_, variances_
+        else:
+            effects += effects_
+            variances += variances_
+        n_contrasts = n_contrasts + ~null
+        dof = dof + df_resid * ~null
+    if effects is None or not np.all(n_contrasts):
+        raise ValueError('all contrasts provided were null contrasts')
+    # same scaling as Contrast.__mul__: effect / n, variance / n ** 2
+    return [Contrast(effect=effect[np.newaxis] / n_,
+                     variance=variance / n_ ** 2, dim=1, dof=dof_,
+                     contrast_type='t')
+            for effect, variance, n_, dof_ in zip(effects, variances,
+                                                  n_contrasts, dof)]
+
+
 class Contrast(object):
     """ The contrast class handles the estimation of statistical contrasts
     on a given model: student (t) or Fisher (F).
     The important feature is that it supports addition,
     thus opening the possibility of fixed-effects models.
 
-    The current implementation is meant to be simple,
-    and could be enhanced in the future on the computational side
-    (high-dimensional F constrasts may lead to memory breakage).
+    The current implementation is meant to be simple: the effects of
+    F contrasts are stored as a dense (dim, n_voxels) array, although they
+    are computed by chunks of voxels.
     """
 
     def __init__(self, effect, variance, dim=None, dof=DEF_DOFMAX,
@@ -37,7 +37,6 @@ Author: Bertrand Thirion, 2009-2015
 """
 from __future__ import with_statement
 
-import sys
 from warnings import warn
 
 import numpy as np
@@ -45,7 +44,7 @@ import pandas as pd
 from scipy import linalg
 
 from .experimental_paradigm import check_events
-from .hemodynamic_models import compute_regressor, _orthogonalize
+from .hemodynamic_models import _compute_regressors, _orthogonalize
 from .utils import full_rank, _basestring
 
 ######################################################################
@@ -218,25 +217,25 @@ def _convolve_regressors(events, hrf_model, frame_times, fir_delays=[0],
             a third name is used, i.e. '#name_dispersion'
         if 'fir', the regressos are numbered accoding to '#name_#delay'
     """
-    regressor_names = []
-    regressor_matrix = None
     trial_type, onset, duration, modulation = check_events(events)
-    for condition in np.unique(trial_type):
-        condition_mask = (trial_type == condition)
-        exp_condition = (onset[condition_mask],
-                         duration[condition_mask],
-                         modulation[condition_mask])
-        reg, names = compute_regressor(
-            exp_condition, hrf_model, frame_times, con_id=condition,
-            fir_delays=fir_delays, oversampling=oversampling,
-            min_onset=min_onset)
-
-        regressor_names += names
-        if regressor_matrix is None:
-            regressor_matrix = reg
-        else:
-            regressor_matrix = np.hstack((regressor_matrix, reg))
-    return regressor_matrix, regressor_names
+    # the conditions are hashed rather than sorted with the events
+    index, conditions = pd.factorize(trial_type, sort=True)
+    if (index < 0).any():
+        # missing trial types form a condition, as with np.unique
+        conditions, index = np.unique(trial_type, return_inverse=True)
+    if conditions.size == 0:
+        return None, []
+    # the events are grouped by condition with one stable sort, which keeps
+    # the order of the events of each condition
+    order = np.argsort(index, kind='mergesort')
+    bounds = np.cumsum(np.bincount(index, minlength=conditions.size))[:-1]
+    exp_conditions = list(zip(*[np.split(column[order], bounds)
+                                for column in (onset, duration, modulation)]))
+    # all the conditions are convolved at once
+    return _compute_regressors(
+        exp_conditions, hrf_model, frame_times, conditions,
+        fir_delays=fir_delays, oversampling=oversampling,
+        min_onset=min_onset)
 
 
 ######################################################################
@@ -408,6 +407,25 @@ def check_design_matrix(design_matrix):
     return frame_times, matrix, names
 
 
+def _cond_exceeds(X, cmax):
+    """ Whether the condition number of X exceeds cmax
+
+    The condition number is bounded from the eigenvalues of X^T X, which
+    are much cheaper than the singular values of a tall X, and computed
+    from the singular values only when the bound is not conclusive, i.e.
+    for nearly singular matrices.
+    """
+    n, p = X.shape
+    if n == 0 or p == 0:
+        return np.linalg.cond(X) > cmax
+    eigvals = np.linalg.eigvalsh(np.dot(X.T, X))
+    # bound of the rounding errors of the Gram matrix and its eigenvalues
+    error = n * p * np.finfo(np.float64).eps * eigvals[-1]
+    if eigvals[0] - error > eigvals[-1] / cmax ** 2:
+        return False
+    return np.linalg.cond(X) > cmax
+
+
 def make_second_level_design_matrix(subjects_label, confounds=None):
     """Sets up a second level design.
 
@@ -439,26 +457,34 @@ def make_second_level_design_matrix(subjects_label, confounds=None):
     if len(np.unique(design_columns)) != len(design_columns):
         raise ValueError('Design matrix columns do not have unique names')
 
-    # float dtype necessary for linalg
-    design_matrix = pd.DataFrame(columns=design_columns, dtype=float)
-    for ridx, subject_label in enumerate(subjects_label):
-        design_matrix.loc[ridx] = [0] * len(design_columns)
-        design_matrix.loc[ridx, 'intercept'] = 1
-        if confounds is not None:
-            conrow = confounds['subject_label'] == subject_label
-            if np.sum(conrow) > 1:
+    if confounds is None:
+        design_matrix = pd.DataFrame(np.ones((len(subjects_label), 1)),
+                                     columns=design_columns)
+    else:
+        # the rows of the subjects are looked up in one pass; the subjects
+        # with no row or several rows are reported in the order of
+        # subjects_label
+        labels = confounds['subject_label']
+        n_rows = labels.value_counts().reindex(subjects_label).fillna(0)
+        invalid = np.flatnonzero(n_rows.values != 1)
+        if invalid.size > 0:
+            subject_label = subjects_label[invalid[0]]
+            if n_rows.values[invalid[0]] > 1:
                 raise ValueError('confounds contain more than one row for '
                                  'subject %s' % subject_label)
-            elif np.sum(conrow) == 0:
-                raise ValueError('confounds not specified for subject %s' %
-                                 subject_label)
-            for conf_name in confounds_name:
-                confounds_value = confounds[conrow][conf_name].values[0]
-                design_matrix.loc[ridx, conf_name] = confounds_value
+            raise ValueError('confounds not specified for subject %s' %
+                             subject_label)
+        positions = pd.Series(np.arange(len(labels)), index=labels.values)
+        positions = positions[~positions.index.duplicated()]
+        rows = positions.reindex(subjects_label).values
+        design_matrix = confounds[confounds_name].iloc[rows]
+        design_matrix = design_matrix.reset_index(drop=True)
+        design_matrix['intercept'] = 1
+    # float dtype necessary for linalg
+    design_matrix = design_matrix.astype(float)
 
     # check design matrix is not singular
-    epsilon = sys.float_info.epsilon
-    if np.linalg.cond(design_matrix.values) > design_matrix.size:
+    if _cond_exceeds(design_matrix.values, design_matrix.size):
         warn('Attention: Design matrix is singular. Aberrant estimates '
              'are expected.')
     return design_matrix
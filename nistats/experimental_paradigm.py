@@ -54,15 +54,17 @@ def check_events(events):
     if 'duration' not in events.keys():
         raise ValueError('The provided events data has no duration column.')
 
-    onset = np.array(events['onset'])
-    duration = np.array(events['duration']).astype(np.float)
+    # the columns are viewed rather than copied when their type allows it
+    onset = np.asarray(events['onset'])
+    duration = np.asarray(events['duration'], dtype=np.float)
     n_events = len(onset)
-    trial_type = np.array(events['trial_type'])
     modulation = np.ones(n_events)
-    if 'trial_type' not in events.keys():
+    if 'trial_type' in events.keys():
+        trial_type = np.asarray(events['trial_type'])
+    else:
         warnings.warn("'trial_type' column not found in the given events data.")
         trial_type = np.repeat('dummy', n_events)
     if 'modulation' in events.keys():
         warnings.warn("'modulation' column found in the given events data.")
-        modulation = np.array(events['modulation']).astype(np.float)
+        modulation = np.asarray(events['modulation'], dtype=np.float)
     return trial_type, onset, duration, modulation
@@ -14,10 +14,19 @@ Author: Bertrand Thirion, Martin Perez-Guevara, 2016
 import glob
 import json
 import os
+import shutil
 import sys
+import tempfile
+import threading
 import time
 from warnings import warn
 
+try:
+    import queue
+except ImportError:  # Python2
+    import Queue as queue
+
+import nibabel as nib
 import numpy as np
 import pandas as pd
 from nibabel import Nifti1Image
@@ -30,22 +39,40 @@ from sklearn.externals.joblib import Memory
 from nilearn.input_data import NiftiMasker
 from nilearn._utils import CacheMixin
 from nilearn._utils.niimg_conversions import check_niimg
-from sklearn.externals.joblib import (Parallel,
+from nilearn.image import iter_img
+from sklearn.externals.joblib import (cpu_count,
                                       delayed,
+                                      dump,
+                                      load,
+                                      Parallel,
                                       )
 
-from .contrasts import _fixed_effect_contrast, expression_to_contrast_vector
+from .contrasts import (_fixed_effect_contrast,
+                        _fixed_effect_t_contrasts,
+                        expression_to_contrast_vector,
+                        )
 from .design_matrix import make_first_level_design_matrix
-from .regression import (ARModel,
+from .experimental_paradigm import check_events
+from .glm_cache import GLMCache
+from .hemodynamic_models import _compute_regressors, _orthogonalize
+from .regression import (BatchedARModel,
                          OLSModel,
-                         SimpleRegressionResults,
+                         PackedRegressionResults,
+                         RegressionResults,
+                         SufficientStatistics,
+                         _bin_order,
+                         _pack_results,
                          )
 from .utils import (_basestring,
+                    _check_and_load_tables,
                     _check_run_tables,
                     _check_events_file_uses_tab_separators,
                     get_bids_files,
                     parse_bids_filename,
                     )
+from nistats._utils.gzip_index import (IndexedGzipFile,
+                                       load_niimg,
+                                       )
 from nistats._utils.helpers import replace_parameters
 
 
@@ -67,22 +94,186 @@ def mean_scaling(Y, axis=0):
         The data mean.
 
     """
-    mean = Y.mean(axis=axis)
+    mean = Y.mean(axis=axis, dtype=np.float64)
     if (mean == 0).any():
         warn('Mean values of 0 observed.'
              'The data have probably been centered.'
              'Scaling might not work as expected')
     mean = np.maximum(mean, 1)
-    Y = 100 * (Y / mean - 1)
+    # keep single precision data in single precision
+    scale = mean.astype(Y.dtype) if Y.dtype.kind == 'f' else mean
+    if axis == 1:
+        scale = scale[:, np.newaxis]
+    Y = 100 * (Y / scale - 1)
     return Y, mean
 
 
-def _ar_model_fit(X, val, Y):
-    """Wrapper for fit method of ARModel to allow joblib parallelization"""
-    return ARModel(X, val).fit(Y)
+def _ar_model_fit(X, vals, Y, labels, dtype=None):
+    """Wrapper for fit method of BatchedARModel to allow joblib
+    parallelization"""
+    results = BatchedARModel(X, vals, dtype=dtype).fit(Y, labels)
+    return dict((vals[k], result) for k, result in results.items())
+
+
+def _ar1_estimate(resid, bins):
+    """Compute the AR(1) coefficients of the residuals, discretized in bins"""
+    ar1 = (np.einsum('ij,ij->j', resid[1:], resid[:-1], dtype=np.float64) /
+           np.einsum('ij,ij->j', resid, resid, dtype=np.float64))
+    return (ar1 * bins).astype(np.int) * 1. / bins
+
 
+def _ols_block_ar1(ols_model, Y, block, bins):
+    """Compute the discretized AR(1) coefficients of the voxels `block`"""
+    # the whitened residuals of an OLS model are its residuals
+    return _ar1_estimate(ols_model.fit(np.asarray(Y[:, block])).wresid, bins)
 
-def run_glm(Y, X, noise_model='ar1', bins=100, n_jobs=1, verbose=0):
+
+def _block_fit(model, Y, block, labels=None, wY=None, wresid=None):
+    """Fit the voxels `block` of Y and return their parameter and dispersion
+    estimates
+
+    `labels` gives the bin of each voxel of the block for a BatchedARModel,
+    and is None for an OLSModel. If given, the whitened data and residuals
+    of the block are written to the (memory-mapped) arrays wY and wresid.
+    """
+    Y = np.asarray(Y[:, block])
+    if labels is None:
+        results = model.fit(Y)
+        theta, dispersion = results.theta, results.dispersion
+        wY_, wresid_ = results.wY, results.wresid
+    elif wresid is None:
+        theta, dispersion = model.fit_compact(Y, labels)
+    else:
+        theta, dispersion, wY_, wresid_ = model.fit_compact(
+            Y, labels, return_residuals=True)
+    if wY is not None:
+        wY[:, block] = wY_
+    if wresid is not None:
+        wresid[:, block] = wresid_
+    return theta, dispersion
+
+
+def _voxel_blocks(n_voxels, block_size):
+    """Split the voxels in contiguous blocks of at most block_size voxels"""
+    return [slice(start, start + block_size)
+            for start in range(0, n_voxels, block_size)]
+
+
+def _share(value, temp_folder, name):
+    """Dump `value` once in `temp_folder` and return a memory-mapped copy of
+    it, that joblib sends to the workers by reference instead of pickling
+    its arrays. Nothing is done if `temp_folder` is None."""
+    if temp_folder is None or isinstance(value, np.memmap):
+        return value
+    filename = os.path.join(temp_folder, name + '.pkl')
+    dump(value, filename)
+    return load(filename, mmap_mode='r')
+
+
+def _write_time_series(directory, prefix, X, Y, theta, chunk_size=10000):
+    """Write the residuals and predicted time series of the fit of Y to
+    memory maps of shape (n_voxels, n_scans) in directory, chunk of voxels
+    by chunk of voxels, and return their description
+
+    The names of the files start with prefix and are unique, so that the
+    fits sharing a directory do not overwrite each other's files."""
+    files = {'shape': Y.shape[::-1], 'dtype': Y.dtype.str}
+    for kind in ['residuals', 'predicted']:
+        fd, files[kind] = tempfile.mkstemp(
+            prefix=prefix + '_', suffix='_%s.mmap' % kind, dir=directory)
+        os.close(fd)
+    residuals = np.memmap(files['residuals'], dtype=Y.dtype, mode='w+',
+                          shape=files['shape'])
+    predicted = np.memmap(files['predicted'], dtype=Y.dtype, mode='w+',
+                          shape=files['shape'])
+    for block in _voxel_blocks(Y.shape[1], chunk_size):
+        predicted_ = np.dot(X, theta[:, block])
+        predicted[block] = predicted_.T
+        residuals[block] = (Y[:, block] - predicted_).T
+    residuals.flush()
+    predicted.flush()
+    del residuals, predicted
+    return files
+
+
+def _run_glm_blocks(Y, X, noise_model, bins, n_jobs, verbose, block_size,
+                    temp_folder=None, full_results=False, dtype=None):
+    """Version of run_glm where the voxels are processed in blocks through
+    the OLS fit, the AR(1) estimation and the AR refit
+
+    The data and models are shared with the workers through memory maps in
+    `temp_folder` if given, and the workers only return the per-voxel
+    parameters and dispersions. If `full_results` is True, the whitened data
+    and residuals are written to memory maps as well, and RegressionResults
+    are returned instead of PackedRegressionResults.
+    """
+    blocks = _voxel_blocks(Y.shape[1], block_size)
+    shared_Y = _share(Y, temp_folder, 'Y')
+    ols_model = OLSModel(X, dtype=dtype)
+    if noise_model == 'ar1':
+        labels = np.concatenate(Parallel(n_jobs=n_jobs, verbose=verbose)(
+            delayed(_ols_block_ar1)(ols_model, shared_Y, block, bins)
+            for block in blocks))
+        vals, bin_index = np.unique(labels, return_inverse=True)
+        model = BatchedARModel(X, vals, dtype=dtype)
+        covs = model.normalized_cov_beta
+        block_labels = [bin_index[block] for block in blocks]
+    else:
+        labels = np.zeros(Y.shape[1])
+        vals, bin_index = np.zeros(1), np.zeros(Y.shape[1], dtype=np.intp)
+        model = ols_model
+        covs = model.normalized_cov_beta[np.newaxis]
+        block_labels = [None] * len(blocks)
+
+    wY = wresid = None
+    if full_results:
+        if temp_folder is None:
+            wresid = np.empty(Y.shape, dtype)
+        else:
+            wresid = np.memmap(os.path.join(temp_folder, 'wresid.mmap'),
+                               dtype=np.dtype(dtype), shape=Y.shape, mode='w+')
+        if noise_model == 'ar1':
+            wY = np.empty_like(wresid) if temp_folder is None else \
+                np.memmap(os.path.join(temp_folder, 'wY.mmap'),
+                          dtype=np.dtype(dtype), shape=Y.shape, mode='w+')
+
+    shared_model = _share(model, temp_folder, 'model')
+    fits = Parallel(n_jobs=n_jobs, verbose=verbose)(
+        delayed(_block_fit)(shared_model, shared_Y, block, block_labels_,
+                            wY, wresid)
+        for block, block_labels_ in zip(blocks, block_labels))
+    theta = np.hstack([theta_ for theta_, _ in fits])
+    dispersion = np.concatenate([dispersion_ for _, dispersion_ in fits])
+    del fits, shared_Y, shared_model
+
+    results = {}
+    if full_results and noise_model == 'ols':
+        # load the residuals in memory before the memory maps are removed
+        results[0.0] = RegressionResults(
+            theta, Y, model, Y, np.array(wresid), dispersion=dispersion,
+            cov=model.normalized_cov_beta)
+    elif full_results:
+        # reorder once, so that each bin is a contiguous view
+        order, bounds = _bin_order(bin_index, vals.size)
+        Yt = Y.T[order]
+        wYt = np.asarray(wY.T[order])
+        wresidt = np.asarray(wresid.T[order])
+        for k, val in enumerate(vals):
+            bin_ = order[bounds[k]:bounds[k + 1]]
+            voxels = slice(bounds[k], bounds[k + 1])
+            results[val] = RegressionResults(
+                theta[:, bin_], Yt[voxels].T, model.model(k),
+                wYt[voxels].T, wresidt[voxels].T,
+                dispersion=dispersion[bin_], cov=covs[k])
+    else:
+        results = PackedRegressionResults(theta, dispersion, covs, bin_index,
+                                          vals, model.df_total,
+                                          model.df_model)
+    return labels, results
+
+
+def run_glm(Y, X, noise_model='ar1', bins=100, n_jobs=1, verbose=0,
+            block_size=None, dtype=None):
     """ GLM fit for an fMRI data matrix
 
     Parameters
@@ -101,19 +292,37 @@ def run_glm(Y, X, noise_model='ar1', bins=100, n_jobs=1, verbose=0):
 
     n_jobs : int, optional
         The number of CPUs to use to do the computation. -1 means
-        'all CPUs'.
+        'all CPUs'. When several CPUs are used, the data are shared with the
+        workers through a memory map, and each worker fits a block of
+        voxels.
 
     verbose : int, optional
         The verbosity level. Defaut is 0
 
+    block_size : int or None, optional
+        If not None, the voxels are streamed in blocks of `block_size`
+        voxels through the OLS fit, the AR(1) estimation and the AR refit,
+        so that the temporary arrays (residuals, whitened data) never exceed
+        one block per job. Only the parameter and dispersion estimates are
+        kept, and the results are packed in a PackedRegressionResults.
+
+    dtype : numpy dtype or None, optional
+        If not None, floating point type in which the data, parameters and
+        residuals are handled, e.g. np.float32 to halve the memory footprint
+        and bandwidth of the fit. The design-sized quantities (covariance of
+        the parameters) and the dispersions are always computed in float64.
+        Defaults to float64.
+
     Returns
     -------
     labels : array of shape (n_voxels,),
         A map of values on voxels used to identify the corresponding model.
 
-    results : dict,
+    results : dict or PackedRegressionResults,
         Keys correspond to the different labels values
-        values are RegressionResults instances corresponding to the voxels.
+        values are RegressionResults instances corresponding to the voxels
+        (a PackedRegressionResults of SimpleRegressionResults instances if
+        `block_size` is not None).
 
     """
     acceptable_noise_models = ['ar1', 'ols']
@@ -128,26 +337,44 @@ def run_glm(Y, X, noise_model='ar1', bins=100, n_jobs=1, verbose=0):
             ' You provided X with shape {0} and Y with shape {1}'.\
                 format(X.shape, Y.shape))
 
+    if dtype is not None:
+        Y = np.asarray(Y, dtype)
+
+    if n_jobs != 1:
+        # Share the data with the workers through memory maps, and only
+        # transfer the per-voxel estimates back
+        if block_size is None:
+            n_workers = n_jobs if n_jobs > 0 else cpu_count() + 1 + n_jobs
+            block_size = int(np.ceil(Y.shape[1] / float(max(n_workers, 1))))
+            full_results = True
+        else:
+            full_results = False
+        temp_folder = tempfile.mkdtemp(
+            prefix='nistats_glm_', dir=os.environ.get('JOBLIB_TEMP_FOLDER'))
+        try:
+            return _run_glm_blocks(Y, X, noise_model, bins, n_jobs, verbose,
+                                   max(block_size, 1), temp_folder,
+                                   full_results, dtype)
+        finally:
+            shutil.rmtree(temp_folder, ignore_errors=True)
+
+    if block_size is not None:
+        return _run_glm_blocks(Y, X, noise_model, bins, n_jobs, verbose,
+                               block_size, dtype=dtype)
+
     # Create the model
-    ols_result = OLSModel(X).fit(Y)
+    ols_result = OLSModel(X, dtype=dtype).fit(Y)
 
     if noise_model == 'ar1':
         # compute and discretize the AR1 coefs
-        ar1 = ((ols_result.resid[1:] * ols_result.resid[:-1]).sum(axis=0) /
-               (ols_result.resid ** 2).sum(axis=0))
+        # the whitened residuals of an OLS model are its residuals
+        ar1 = _ar1_estimate(ols_result.wresid, bins)
         del ols_result
-        ar1 = (ar1 * bins).astype(np.int) * 1. / bins
         # Fit the AR model acccording to current AR(1) estimates
-        results = {}
         labels = ar1
-        # Parallelize by creating a job per ARModel
-        vals = np.unique(ar1)
-        ar_result = Parallel(n_jobs=n_jobs, verbose=verbose)(
-            delayed(_ar_model_fit)(X, val, Y[:, labels == val]) for val in vals)
-        for val, result in zip(vals, ar_result):
-            results[val] = result
-        del vals
-        del ar_result
+        vals, bin_index = np.unique(ar1, return_inverse=True)
+        results = _ar_model_fit(X, vals, Y, bin_index, dtype)
+        del vals, bin_index
 
     else:
         labels = np.zeros(Y.shape[1])
@@ -156,6 +383,377 @@ def run_glm(Y, X, noise_model='ar1', bins=100, n_jobs=1, verbose=0):
     return labels, results
 
 
+def _check_run_img(run_img):
+    """check_niimg for 4D run images, that only reads the header of an image
+    file so that its data stays behind the proxy of the image. Gzipped
+    images are read through an IndexedGzipFile."""
+    if isinstance(run_img, _basestring):
+        filename = os.path.expanduser(run_img)
+        if os.path.isfile(filename):
+            img = load_niimg(filename)
+            if len(img.shape) == 4:
+                return img
+    return check_niimg(run_img, ensure_ndim=4)
+
+
+def _run_n_scans(run_img):
+    """Number of scans of a 4D run image. The image files are neither
+    opened through an IndexedGzipFile nor kept open: only their header is
+    read.
+
+    Returns
+    -------
+    run_img : Niimg-like object
+        The path of an image file, or the checked image.
+
+    n_scans : int
+        The number of scans of the run.
+    """
+    if isinstance(run_img, _basestring):
+        filename = os.path.expanduser(run_img)
+        if os.path.isfile(filename):
+            shape = nib.load(filename).shape
+            if len(shape) == 4:
+                return filename, shape[3]
+    run_img = check_niimg(run_img, ensure_ndim=4)
+    return run_img, run_img.shape[3]
+
+
+def _close_run_img(run_img):
+    """Close the IndexedGzipFile of a run image opened by _check_run_img"""
+    file_map = getattr(run_img, 'file_map', None)
+    if file_map is None or 'image' not in file_map:
+        return
+    fileobj = file_map['image'].fileobj
+    if isinstance(fileobj, IndexedGzipFile):
+        fileobj.close()
+
+
+def _has_temporal_processing(masker):
+    """Whether the masker transform mixes the scans of a run, in which case
+    it cannot mask the scans by slabs."""
+    return any(getattr(masker, name, None) for name in
+               ('standardize', 'detrend', 'low_pass', 'high_pass'))
+
+
+def _mask_slabs(masker, img, slab_size, dtype=None):
+    """Mask the 4D image img with masker by slabs of slab_size scans.
+
+    The scans of each slab are read through the data proxy of img, so that
+    only slab_size scans of the image are in memory at once.
+
+    Returns
+    -------
+    Y : array of shape (n_scans, n_voxels)
+        The masked data, of type dtype if not None.
+    """
+    n_scans = img.shape[3]
+    Y = None
+    for start in range(0, n_scans, slab_size):
+        stop = min(start + slab_size, n_scans)
+        slab = Nifti1Image(np.asarray(img.dataobj[..., start:stop]),
+                           img.affine, img.header)
+        Y_slab = masker.transform(slab)
+        if Y is None:
+            Y = np.empty((n_scans, Y_slab.shape[1]),
+                         Y_slab.dtype if dtype is None else dtype)
+        Y[start:stop] = Y_slab
+        del slab, Y_slab
+    return Y
+
+
+def _run_design(model, run_idx, run_img, events, confounds, design_matrix):
+    """Check the image of one run of a FirstLevelModel from its header, and
+    build its design matrix. The data of the run are only opened by
+    _load_run.
+
+    Returns
+    -------
+    run_img : Niimg-like object
+        The path of the image file of the run, or its checked image.
+
+    design : pandas DataFrame
+        The design matrix of the run.
+    """
+    run_img, n_scans = _run_n_scans(run_img)
+    if design_matrix is None:
+        if confounds is not None:
+            confounds_matrix = confounds.values
+            if confounds_matrix.shape[0] != n_scans:
+                raise ValueError('Rows in confounds does not match'
+                                 'n_scans in run_img at index %d'
+                                 % (run_idx,))
+            confounds_names = confounds.columns.tolist()
+        else:
+            confounds_matrix = None
+            confounds_names = None
+        start_time = model.slice_time_ref * model.t_r
+        end_time = (n_scans - 1 + model.slice_time_ref) * model.t_r
+        frame_times = np.linspace(start_time, end_time, n_scans)
+        design = make_first_level_design_matrix(frame_times, events,
+                                                model.hrf_model,
+                                                model.drift_model,
+                                                model.high_pass,
+                                                model.drift_order,
+                                                model.fir_delays,
+                                                confounds_matrix,
+                                                confounds_names,
+                                                model.min_onset)
+    else:
+        design = design_matrix
+    return run_img, design
+
+
+def _load_run(model, run_img, design):
+    """Mask the data of one run of a FirstLevelModel with the fitted masker_
+    of the model. An image file is opened with _check_run_img, and closed
+    once masked.
+
+    Returns
+    -------
+    design : pandas DataFrame
+        The design matrix of the run, unchanged.
+
+    Y : array of shape (n_scans, n_voxels)
+        The masked data, cast to model.dtype.
+    """
+    if model.verbose > 1:
+        t_masking = time.time()
+        sys.stderr.write('Starting masker computation \r')
+
+    opened = isinstance(run_img, _basestring)
+    run_img = _check_run_img(run_img)
+    try:
+        if model.slab_size is not None and not _has_temporal_processing(
+                model.masker_):
+            Y = _mask_slabs(model.masker_, run_img, model.slab_size,
+                            model.dtype)
+        else:
+            if model.slab_size is not None:
+                warn('slab_size is ignored since the masker standardizes or '
+                     'filters the time series of the whole run')
+            Y = model.masker_.transform(run_img)
+            if model.dtype is not None:
+                Y = np.asarray(Y, model.dtype)
+    finally:
+        if opened:
+            _close_run_img(run_img)
+
+    if model.verbose > 1:
+        t_masking = time.time() - t_masking
+        sys.stderr.write('Masker took %d seconds       \n' % t_masking)
+    return design, Y
+
+
+def _fit_run_data(model, run_idx, design, Y, block_size=None):
+    """Fit the GLM of one run of a FirstLevelModel to its masked data Y.
+
+    Returns
+    -------
+    design : pandas DataFrame
+        The design matrix of the run.
+
+    labels, results :
+        As returned by run_glm, packed if model.minimize_memory is True.
+
+    statistics : SufficientStatistics or None
+        The statistics of the run, if model.store_statistics is True.
+
+    time_series_files : dict or None
+        The memory maps written, if model.residuals_dir is not None.
+    """
+    # the scaling of each scan is applied before the statistics are
+    # accumulated, the temporal scaling only when they are fitted
+    statistics = None
+    if model.signal_scaling and model.scaling_axis == 1:
+        Y, _ = mean_scaling(Y, model.scaling_axis)
+    if model.store_statistics:
+        statistics = SufficientStatistics().update(design.values, Y)
+    if model.signal_scaling and model.scaling_axis != 1:
+        Y, _ = mean_scaling(Y, model.scaling_axis)
+    if model.memory:
+        mem_glm = model.memory.cache(run_glm, ignore=['n_jobs'])
+    else:
+        mem_glm = run_glm
+
+    # compute GLM
+    if model.verbose > 1:
+        t_glm = time.time()
+        sys.stderr.write('Performing GLM computation\r')
+    labels, results = mem_glm(Y, design.values,
+                              noise_model=model.noise_model,
+                              bins=100, n_jobs=model.n_jobs,
+                              block_size=block_size,
+                              dtype=model.dtype)
+    if model.verbose > 1:
+        t_glm = time.time() - t_glm
+        sys.stderr.write('GLM took %d seconds         \n' % t_glm)
+
+    # We save memory if inspecting model details is not necessary
+    if model.minimize_memory:
+        results = _pack_results(labels, results)
+    time_series_files = None
+    if model.residuals_dir is not None:
+        prefix = 'run-%02d' % run_idx
+        if model.subject_label is not None:
+            prefix = 'sub-%s_%s' % (model.subject_label, prefix)
+        time_series_files = _write_time_series(
+            model.residuals_dir, prefix, design.values,
+            Y, _pack_results(labels, results).theta)
+    return design, labels, results, statistics, time_series_files
+
+
+def _fit_run(model, run_idx, run_img, design, block_size=None):
+    """Fit the GLM of one run of a FirstLevelModel with a fitted masker_.
+
+    This is a function of the model, which it does not modify, so that
+    joblib can dispatch the runs to workers. It returns the outputs of
+    _fit_run_data.
+    """
+    design, Y = _load_run(model, run_img, design)
+    return _fit_run_data(model, run_idx, design, Y, block_size=block_size)
+
+
+def _prefetch(function, args_list, n_prefetch):
+    """Yield function(*args) for each args of args_list, computed ahead by a
+    background thread.
+
+    The thread waits as soon as n_prefetch values are ready and not yet
+    consumed, which bounds the memory used. An exception raised by function
+    is raised by the generator when the corresponding value is consumed.
+    When the generator is closed, the thread is stopped and the values
+    computed ahead are released.
+    """
+    values = queue.Queue(maxsize=n_prefetch)
+    stop = threading.Event()
+
+    def produce():
+        for args in args_list:
+            try:
+                item = (function(*args), None)
+            except Exception as error:
+                item = (None, error)
+            while not stop.is_set():
+                try:
+                    values.put(item, timeout=.1)
+                    break
+                except queue.Full:
+                    pass
+            if item[1] is not None or stop.is_set():
+                return
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        for _ in args_list:
+            value, error = values.get()
+            if error is not None:
+                raise error
+            yield value
+            del value
+    finally:
+        stop.set()
+        thread.join()
+        while not values.empty():
+            values.get_nowait()
+
+
+def _beta_series(X, nuisance, Y, conditions, n_kernels=1, X_sums=None):
+    """Least squares separate (LSS) estimates of the response to each trial
+
+    The model of each trial holds the regressors of the trial, the sum of
+    the regressors of the other trials of its condition, the sums of the
+    regressors of each other condition and the nuisance regressors. These
+    models only differ by low rank terms: the nuisance regressors are
+    projected out of the trial regressors once, the products of the
+    projected regressors with the data are computed once, and the estimate
+    of each trial is a combination of them, obtained from the small normal
+    equations of its model.
+
+    Parameters
+    ----------
+    X : array of shape (n_scans, n_trials * n_kernels)
+        The regressors of the trials, n_kernels consecutive columns per
+        trial, the first one being the main regressor of the trial.
+
+    nuisance : array of shape (n_scans, n_nuisance)
+        The regressors shared by all the models, e.g. drifts and confounds.
+
+    Y : array of shape (n_scans, n_voxels)
+        The data.
+
+    conditions : array of shape (n_trials,)
+        The condition of each trial.
+
+    n_kernels : int, optional
+        The number of regressors of each trial.
+
+    X_sums : array of shape (n_scans, n_trials * n_kernels), optional
+        The regressors of the trials that are summed in the regressors of
+        the conditions, if they differ from X, e.g. when the derivatives of
+        X are orthogonalized trial by trial but those of the conditions are
+        orthogonalized after the sum.
+
+    Returns
+    -------
+    betas : array of shape (n_trials, n_voxels)
+        The estimate of the main regressor of each trial, in the model of
+        the trial.
+    """
+    _, conditions = np.unique(conditions, return_inverse=True)
+    n_trials, n_conditions = conditions.size, conditions.max() + 1
+    k = n_kernels
+    # the trial regressors orthogonal to the nuisance regressors, that are
+    # orthogonal to the data projected out of the nuisance regressors
+    nuisance_pinv = np.linalg.pinv(nuisance)
+    X = X - np.dot(nuisance, np.dot(nuisance_pinv, X))
+    XtY = np.dot(X.T, Y)
+    XtX = np.dot(X.T, X)
+    if X_sums is None:
+        X_sums, XsY, XtXs, XsXs = X, XtY, XtX, XtX
+    else:
+        X_sums = X_sums - np.dot(nuisance, np.dot(nuisance_pinv, X_sums))
+        XsY = np.dot(X_sums.T, Y)
+        XtXs = np.dot(X.T, X_sums)
+        XsXs = np.dot(X_sums.T, X_sums)
+    # the sums of the regressors of the trials of each condition
+    columns = np.arange(n_trials * k)
+    sums = np.zeros((n_trials * k, n_conditions * k))
+    sums[columns, np.repeat(conditions, k) * k + columns % k] = 1
+    XtXs_sums = np.dot(XtXs, sums)
+    XsXs_sums = np.dot(XsXs, sums)
+    sums_XsXs_sums = np.dot(sums.T, XsXs_sums)
+
+    weights = np.zeros((n_trials, n_trials * k), dtype=XtY.dtype)
+    weights_sums = np.zeros((n_trials, n_trials * k), dtype=XtY.dtype)
+    gram = np.empty(((n_conditions + 1) * k, (n_conditions + 1) * k))
+    for trial, condition in enumerate(conditions):
+        trial_ = slice(trial * k, (trial + 1) * k)
+        # the regressors of the trial are removed from the sum of its
+        # condition
+        condition_ = slice(condition * k, (condition + 1) * k)
+        cross = XtXs_sums[trial_].copy()
+        cross[:, condition_] -= XtXs[trial_, trial_]
+        between = sums_XsXs_sums.copy()
+        between[condition_] -= XsXs_sums[trial_]
+        between[:, condition_] -= XsXs_sums[trial_].T
+        between[condition_, condition_] += XsXs[trial_, trial_]
+        gram[:k, :k] = XtX[trial_, trial_]
+        gram[:k, k:] = cross
+        gram[k:, :k] = cross.T
+        gram[k:, k:] = between
+        # the estimate of the main regressor of the trial is a combination
+        # of the products of the regressors with the data
+        combination = np.linalg.pinv(gram)[:, 0]
+        weights[trial, trial_] = combination[:k]
+        weights_sums[trial] = np.dot(sums, combination[k:])
+        weights_sums[trial, trial_] -= combination[k:][condition_]
+    if XsY is XtY:
+        return np.dot(weights + weights_sums, XtY)
+    return np.dot(weights, XtY) + np.dot(weights_sums, XsY)
+
+
 class FirstLevelModel(BaseEstimator, TransformerMixin, CacheMixin):
     """ Implementation of the General Linear Model for single session fMRI data
 
@@ -251,6 +849,36 @@ class FirstLevelModel(BaseEstimator, TransformerMixin, CacheMixin):
         The number of CPUs to use to do the computation. -1 means
         'all CPUs', -2 'all CPUs but one', and so on.
 
+    n_jobs_runs : integer, optional
+        The number of runs fitted in parallel by fit, each of them with
+        n_jobs workers for its GLM, so that up to n_jobs_runs * n_jobs CPUs
+        are used. Parallel runs are best suited to many short runs, parallel
+        bins to few long ones. The joblib backend can be chosen with
+        joblib.parallel_backend, e.g. threads to avoid copying the data to
+        the workers. 1 by default.
+
+    prefetch : integer, optional
+        If positive and n_jobs_runs is 1, fit loads and masks the next runs
+        in a background thread while the GLM of a run is fitted, which hides
+        the I/O latency. At most prefetch masked runs wait for their fit, to
+        bound the memory used. 0 by default.
+
+    glm_cache : str or GLMCache or None, optional
+        If not None, cache of the GLM fits of the runs, or its directory.
+        The fit of a run is found in the cache from the path, size and
+        modification time of its image file, or a digest of its data, the
+        mask and parameters of the masker, a digest of its design matrix and
+        the noise model, without masking its data. Used only when
+        minimize_memory is True, store_statistics is False and
+        residuals_dir is None.
+
+    slab_size : integer or None, optional
+        If not None, fit reads and masks the scans of each run by slabs of
+        slab_size scans, so that the whole 4D image of a run is never loaded
+        in memory, only its masked data. Run images given as files are
+        inspected through their headers only. Ignored if the masker
+        standardizes or filters the time series.
+
     minimize_memory : boolean, optional
         Gets rid of some variables on the model fit results that are not
         necessary for contrast computation and would only be useful for
@@ -261,17 +889,59 @@ class FirstLevelModel(BaseEstimator, TransformerMixin, CacheMixin):
         This id will be used to identify a `FirstLevelModel` when passed to
         a `SecondLevelModel` object.
 
+    block_size : int or None, optional
+        If not None, the GLM of each run is fitted by streaming blocks of
+        `block_size` voxels, which bounds the memory used by the temporary
+        arrays of the fit. Only used when minimize_memory is True.
+
+    dtype : numpy dtype or None, optional
+        If not None, floating point type of the masked data and of the GLM
+        fit, e.g. np.float32 to halve the memory used by the fit. The
+        covariances of the parameters are always computed in float64.
+        Defaults to float64.
+
+    store_statistics : boolean, optional
+        If True, fit also keeps the sufficient statistics of the GLM of each
+        run in sufficient_statistics_, from which fit_from_statistics can
+        rebuild the results, e.g. with another noise model, without the
+        data. False by default.
+
+    residuals_dir : str or None, optional
+        If not None, directory in which fit writes the residuals and the
+        predicted time series of each run, as memory maps of shape
+        (n_voxels, n_scans). They are computed by chunks of voxels while
+        fitting, so that they are kept even if minimize_memory is True, and
+        residuals and predicted read only the voxels and scans requested.
+        Each fit writes files of unique names, that it does not remove.
+
     Attributes
     ----------
     labels_ : array of shape (n_voxels,),
         a map of values on voxels used to identify the corresponding model
 
-    results_ : dict,
+    results_ : list of dict or PackedRegressionResults,
         with keys corresponding to the different labels values.
         Values are SimpleRegressionResults corresponding to the voxels,
-        if minimize_memory is True,
+        packed in a PackedRegressionResults if minimize_memory is True,
         RegressionResults if minimize_memory is False
 
+    time_series_files_ : list of dict or None
+        The files of the residuals and predicted time series of each run,
+        if residuals_dir is not None.
+
+    sufficient_statistics_ : list of SufficientStatistics or None
+        The sufficient statistics of the GLM of each run, if
+        store_statistics is True or after partial_fit. They hold the masked
+        data as follows, depending on signal_scaling:
+
+        - False: the masked data.
+        - 1: the masked data scaled scan by scan, since the scaling of each
+          scan only depends on that scan.
+        - 0 or (0, 1): the masked data before their scaling, which needs
+          the temporal mean of the whole run. fit_from_statistics and
+          partial_fit apply it when they fit the GLM, through
+          SufficientStatistics.scaled.
+
 
     """
     @replace_parameters({'mask': 'mask_img'}, end_version='next')
@@ -281,7 +951,10 @@ class FirstLevelModel(BaseEstimator, TransformerMixin, CacheMixin):
                  target_shape=None, smoothing_fwhm=None, memory=Memory(None),
                  memory_level=1, standardize=False, signal_scaling=0,
                  noise_model='ar1', verbose=0, n_jobs=1,
-                 minimize_memory=True, subject_label=None):
+                 minimize_memory=True, subject_label=None, block_size=None,
+                 dtype=None, store_statistics=False, residuals_dir=None,
+                 n_jobs_runs=1, prefetch=0, slab_size=None,
+                 glm_cache=None):
         # design matrix parameters
         self.t_r = t_r
         self.slice_time_ref = slice_time_ref
@@ -319,6 +992,17 @@ class FirstLevelModel(BaseEstimator, TransformerMixin, CacheMixin):
         self.labels_ = None
         self.results_ = None
         self.subject_label = subject_label
+        self.block_size = block_size
+        self.dtype = dtype
+        self.store_statistics = store_statistics
+        self.residuals_dir = residuals_dir
+        self.n_jobs_runs = n_jobs_runs
+        self.prefetch = prefetch
+        self.slab_size = slab_size
+        if isinstance(glm_cache, _basestring):
+            self.glm_cache = GLMCache(glm_cache)
+        else:
+            self.glm_cache = glm_cache
 
     def fit(self, run_imgs, events=None, confounds=None,
             design_matrices=None):
@@ -381,9 +1065,116 @@ class FirstLevelModel(BaseEstimator, TransformerMixin, CacheMixin):
             confounds = _check_run_tables(run_imgs, confounds, 'confounds')
 
         # Learn the mask
+        self._fit_masker(run_imgs[0])
+
+        block_size = self.block_size
+        if block_size is not None and not self.minimize_memory:
+            warn('block_size is ignored when minimize_memory is False, '
+                 'since the full regression results keep the whole data')
+            block_size = None
+
+        # For each run fit the model and keep only the regression results.
+        self._partial_fitting = False
+        self.labels_, self.results_, self.design_matrices_ = [], [], []
+        self.sufficient_statistics_ = [] if self.store_statistics else None
+        self.time_series_files_ = None
+        if self.residuals_dir is not None:
+            self.time_series_files_ = []
+            if not os.path.isdir(self.residuals_dir):
+                os.makedirs(self.residuals_dir)
+        n_runs = len(run_imgs)
+        t0 = time.time()
+        runs = [_run_design(self, run_idx, run_img,
+                            None if events is None else events[run_idx],
+                            None if confounds is None else confounds[run_idx],
+                            None if design_matrices is None
+                            else design_matrices[run_idx])
+                for run_idx, run_img in enumerate(run_imgs)]
+
+        # The fits found in the cache are neither loaded nor computed
+        fits, keys = [None] * n_runs, [None] * n_runs
+        if (self.glm_cache is not None and self.minimize_memory and
+                not self.store_statistics and self.residuals_dir is None):
+            for run_idx, (_, design) in enumerate(runs):
+                keys[run_idx] = self.glm_cache.key(
+                    'first_level', run_imgs[run_idx], self.masker_, design,
+                    self.noise_model, self.signal_scaling and
+                    self.scaling_axis, self.dtype)
+                cached = self.glm_cache.get(keys[run_idx])
+                if cached is not None:
+                    fits[run_idx] = (design,) + cached + (None, None)
+        todo = [run_idx for run_idx in range(n_runs) if fits[run_idx] is None]
+
+        if self.n_jobs_runs == 1:
+            if self.prefetch > 0:
+                # the next runs are loaded and masked while one is fitted
+                loaded = _prefetch(_load_run, [(self,) + runs[run_idx]
+                                               for run_idx in todo],
+                                   self.prefetch)
+            else:
+                loaded = (_load_run(self, *runs[run_idx]) for run_idx in todo)
+            # the loading thread is stopped if a fit fails
+            try:
+                for run_idx, (design, Y) in zip(todo, loaded):
+                    # Report progress
+                    if self.verbose > 0:
+                        percent = float(run_idx) / n_runs
+                        percent = round(percent * 100, 2)
+                        dt = time.time() - t0
+                        # We use a max to avoid a division by zero
+                        if run_idx == 0:
+                            remaining = 'go take a coffee, a big one'
+                        else:
+                            remaining = ((100. - percent) /
+                                         max(0.01, percent) * dt)
+                            remaining = '%i seconds remaining' % remaining
+
+                        sys.stderr.write(
+                            "Computing run %d out of %d runs (%s)\n"
+                            % (run_idx + 1, n_runs, remaining))
+                    fits[run_idx] = _fit_run_data(self, run_idx, design, Y,
+                                                  block_size=block_size)
+                    del design, Y
+            finally:
+                loaded.close()
+        else:
+            # the runs are independent given the mask: each worker fits
+            # whole runs, with n_jobs workers for the bins of each of them
+            computed = Parallel(n_jobs=self.n_jobs_runs,
+                                verbose=self.verbose)(
+                delayed(_fit_run)(self, run_idx, *runs[run_idx],
+                                  block_size=block_size)
+                for run_idx in todo)
+            for run_idx, fit in zip(todo, computed):
+                fits[run_idx] = fit
+            del computed
+        for run_idx in todo:
+            if keys[run_idx] is not None:
+                self.glm_cache.put(keys[run_idx], *fits[run_idx][1:3])
+
+        for design, labels, results, statistics, files in fits:
+            self.design_matrices_.append(design)
+            self.labels_.append(labels)
+            self.results_.append(results)
+            if self.store_statistics:
+                self.sufficient_statistics_.append(statistics)
+            if self.residuals_dir is not None:
+                self.time_series_files_.append(files)
+        del fits
+
+        # Report progress
+        if self.verbose > 0:
+            sys.stderr.write("\nComputation of %d runs done in %i seconds\n\n"
+                             % (n_runs, time.time() - t0))
+
+        return self
+
+    def _fit_masker(self, ref_img):
+        """Create and fit masker_ on ref_img, unless a fitted masker was
+        given as mask_img"""
         if self.mask_img is False:
             # We create a dummy mask to preserve functionality of api
-            ref_img = check_niimg(run_imgs[0])
+            ref_img = check_niimg(ref_img)
             self.mask_img = Nifti1Image(np.ones(ref_img.shape[:3]),
                                         ref_img.affine)
         if not isinstance(self.mask_img, NiftiMasker):
@@ -395,9 +1186,10 @@ class FirstLevelModel(BaseEstimator, TransformerMixin, CacheMixin):
                 verbose=max(0, self.verbose - 2),
                 target_shape=self.target_shape,
                 memory_level=self.memory_level)
-            self.masker_.fit(run_imgs[0])
+            self.masker_.fit(ref_img)
         else:
-            if self.mask_img.mask_img_ is None and self.masker_ is None:
+            if (self.mask_img.mask_img_ is None and
+                    getattr(self, 'masker_', None) is None):
                 self.masker_ = clone(self.mask_img)
                 for param_name in ['target_affine', 'target_shape',
                                    'smoothing_fwhm', 't_r', 'memory',
@@ -409,100 +1201,253 @@ class FirstLevelModel(BaseEstimator, TransformerMixin, CacheMixin):
                         warn('Parameter %s of the masker'
                              ' overriden' % param_name)
                     setattr(self.masker_, param_name, our_param)
-                self.masker_.fit(run_imgs[0])
+                self.masker_.fit(ref_img)
             else:
                 self.masker_ = self.mask_img
 
-        # For each run fit the model and keep only the regression results.
-        self.labels_, self.results_, self.design_matrices_ = [], [], []
-        n_runs = len(run_imgs)
-        t0 = time.time()
-        for run_idx, run_img in enumerate(run_imgs):
-            # Report progress
-            if self.verbose > 0:
-                percent = float(run_idx) / n_runs
-                percent = round(percent * 100, 2)
-                dt = time.time() - t0
-                # We use a max to avoid a division by zero
-                if run_idx == 0:
-                    remaining = 'go take a coffee, a big one'
-                else:
-                    remaining = (100. - percent) / max(0.01, percent) * dt
-                    remaining = '%i seconds remaining' % remaining
-
-                sys.stderr.write(
-                    "Computing run %d out of %d runs (%s)\n"
-                    % (run_idx + 1, n_runs, remaining))
-
-            # Build the experimental design for the glm
-            run_img = check_niimg(run_img, ensure_ndim=4)
-            if design_matrices is None:
-                n_scans = run_img.get_data().shape[3]
-                if confounds is not None:
-                    confounds_matrix = confounds[run_idx].values
-                    if confounds_matrix.shape[0] != n_scans:
-                        raise ValueError('Rows in confounds does not match'
-                                         'n_scans in run_img at index %d'
-                                         % (run_idx,))
-                    confounds_names = confounds[run_idx].columns.tolist()
-                else:
-                    confounds_matrix = None
-                    confounds_names = None
+    def partial_fit(self, run_img, events=None, design_matrix=None,
+                    n_scans=None):
+        """Fit the GLM of a single run incrementally, as its scans arrive
+
+        The scans are accumulated in running sufficient statistics of the
+        GLM (see nistats.regression.SufficientStatistics), from which the
+        model is refitted after each call. The cost of a call depends on
+        the number of new scans but not on the number of scans seen so far,
+        and compute_contrast can be called at any time, as soon as there
+        are more scans than regressors.
+
+        The design matrix of the whole run is set on the first call, and
+        the rows of each block of scans are taken from it in order. The
+        first call after fit or fit_from_statistics starts over, with a new
+        run.
+
+        Parameters
+        ----------
+        run_img: Niimg-like object
+            New scan(s) of the run, a 3D image or a 4D block of images.
+
+        events: pandas Dataframe or string, optional
+            fMRI events of the whole run, used to build its design matrix
+            on the first call. Requires n_scans and t_r.
+
+        design_matrix: pandas DataFrame, optional
+            Design matrix of the whole run, used on the first call. If given
+            it takes precedence over events. Confounds can be included as
+            columns of this design matrix.
+
+        n_scans: int, optional
+            Number of scans of the whole run, used to build the design matrix
+            from events.
+
+        """
+        run_img = check_niimg(run_img, atleast_4d=True)
+        if not getattr(self, '_partial_fitting', False):
+            if self.standardize:
+                raise ValueError('standardize is not supported by '
+                                 'partial_fit, since it requires the whole '
+                                 'run')
+            if design_matrix is None:
+                if events is None or n_scans is None:
+                    raise ValueError('events and n_scans, or a design '
+                                     'matrix, must be provided')
+                if self.t_r is None:
+                    raise ValueError('t_r not given to FirstLevelModel '
+                                     'object to compute design from events')
+                _check_events_file_uses_tab_separators(events_files=events)
+                events = _check_and_load_tables([events], 'events')[0]
                 start_time = self.slice_time_ref * self.t_r
                 end_time = (n_scans - 1 + self.slice_time_ref) * self.t_r
                 frame_times = np.linspace(start_time, end_time, n_scans)
-                design = make_first_level_design_matrix(frame_times, events[run_idx],
-                                                        self.hrf_model, self.drift_model,
-                                                        self.high_pass, self.drift_order,
-                                                        self.fir_delays, confounds_matrix,
-                                                        confounds_names, self.min_onset)
+                design_matrix = make_first_level_design_matrix(
+                    frame_times, events, self.hrf_model, self.drift_model,
+                    self.high_pass, self.drift_order, self.fir_delays,
+                    min_onset=self.min_onset)
             else:
-                design = design_matrices[run_idx]
-            self.design_matrices_.append(design)
-
-            # Mask and prepare data for GLM
-            if self.verbose > 1:
-                t_masking = time.time()
-                sys.stderr.write('Starting masker computation \r')
+                design_matrix = _check_and_load_tables(
+                    [design_matrix], 'design_matrix')[0]
+            self._fit_masker(run_img)
+            self.design_matrices_ = [design_matrix]
+            self.labels_ = self.results_ = None
+            self.sufficient_statistics_ = [SufficientStatistics()]
+            self.time_series_files_ = None
+            self._partial_fitting = True
+
+        stats = self.sufficient_statistics_[0]
+        design = self.design_matrices_[0].values
+        Y = self.masker_.transform(run_img)
+        if stats.n_scans + Y.shape[0] > design.shape[0]:
+            raise ValueError('The design matrix has %d rows, less than the '
+                             '%d scans given' % (design.shape[0],
+                                                 stats.n_scans + Y.shape[0]))
+        if self.signal_scaling and self.scaling_axis == 1:
+            Y, _ = mean_scaling(Y, 1)
+        stats.update(design[stats.n_scans:stats.n_scans + Y.shape[0]], Y)
+
+        if stats.n_scans > design.shape[1]:
+            labels, results = self._fit_statistics(stats)
+            self.labels_, self.results_ = [labels], [results]
+        return self
 
-            Y = self.masker_.transform(run_img)
+    def _fit_statistics(self, stats):
+        """Fit the GLM of a run from its sufficient statistics, after the
+        temporal mean scaling of the data if required"""
+        if self.signal_scaling and self.scaling_axis != 1:
+            # see mean_scaling
+            mean = stats.y_sum / stats.n_scans
+            if self.scaling_axis == (0, 1):
+                mean = mean.mean()
+            if np.any(mean == 0):
+                warn('Mean values of 0 observed.'
+                     'The data have probably been centered.'
+                     'Scaling might not work as expected')
+            stats = stats.scaled(np.maximum(mean, 1))
+        return stats.fit(self.noise_model, bins=100)
+
+    def fit_from_statistics(self, sufficient_statistics=None,
+                            design_matrices=None):
+        """Fit the GLM from the sufficient statistics of the runs,
+        without their data
+
+        This rebuilds labels_ and results_ in a few milliseconds per run,
+        e.g. to try another noise_model after fit or partial_fit, or from
+        statistics saved with SufficientStatistics.save. The results are
+        PackedRegressionResults.
 
-            if self.verbose > 1:
-                t_masking = time.time() - t_masking
-                sys.stderr.write('Masker took %d seconds       \n' % t_masking)
+        Parameters
+        ----------
+        sufficient_statistics : SufficientStatistics or list of them,
+            optional
+            The statistics of each run. Defaults to sufficient_statistics_.
 
-            if self.signal_scaling:
-                Y, _ = mean_scaling(Y, self.scaling_axis)
-            if self.memory:
-                mem_glm = self.memory.cache(run_glm, ignore=['n_jobs'])
-            else:
-                mem_glm = run_glm
-
-            # compute GLM
-            if self.verbose > 1:
-                t_glm = time.time()
-                sys.stderr.write('Performing GLM computation\r')
-            labels, results = mem_glm(Y, design.values,
-                                      noise_model=self.noise_model,
-                                      bins=100, n_jobs=self.n_jobs)
-            if self.verbose > 1:
-                t_glm = time.time() - t_glm
-                sys.stderr.write('GLM took %d seconds         \n' % t_glm)
+        design_matrices : pandas DataFrame or list of pandas DataFrames,
+            optional
+            The design matrices of the runs, whose columns name the
+            regressors of the statistics. Defaults to design_matrices_.
 
+        """
+        if sufficient_statistics is None:
+            sufficient_statistics = getattr(self, 'sufficient_statistics_',
+                                            None)
+            if sufficient_statistics is None:
+                raise ValueError('No sufficient statistics given or stored; '
+                                 'use store_statistics=True or partial_fit')
+        if not isinstance(sufficient_statistics, (list, tuple)):
+            sufficient_statistics = [sufficient_statistics]
+        if design_matrices is None:
+            design_matrices = getattr(self, 'design_matrices_', None)
+            if design_matrices is None:
+                raise ValueError('design_matrices must be provided')
+        design_matrices = _check_run_tables(sufficient_statistics,
+                                            design_matrices,
+                                            'design_matrices')
+        for stats, design in zip(sufficient_statistics, design_matrices):
+            if stats.XtX.shape[0] != design.shape[1]:
+                raise ValueError('The design matrices do not match the '
+                                 'regressors of the sufficient statistics')
+        if getattr(self, 'masker_', None) is None:
+            if self.mask_img is None or self.mask_img is False:
+                raise ValueError('mask_img must be given to map the '
+                                 'statistics to images')
+            self._fit_masker(None)
+
+        self._partial_fitting = False
+        self.design_matrices_ = list(design_matrices)
+        self.sufficient_statistics_ = list(sufficient_statistics)
+        self.labels_, self.results_ = [], []
+        for stats in self.sufficient_statistics_:
+            labels, results = self._fit_statistics(stats)
             self.labels_.append(labels)
-            # We save memory if inspecting model details is not necessary
-            if self.minimize_memory:
-                for key in results:
-                    results[key] = SimpleRegressionResults(results[key])
             self.results_.append(results)
-            del Y
+        return self
 
-        # Report progress
-        if self.verbose > 0:
-            sys.stderr.write("\nComputation of %d runs done in %i seconds\n\n"
-                             % (n_runs, time.time() - t0))
+    def compute_beta_series(self, run_imgs, events, confounds=None):
+        """Estimate the response to each trial of the runs, with the least
+        squares separate (LSS) method
+
+        Each trial is estimated in its own model, that holds the regressor of
+        the trial, a regressor of the other trials of its condition, one
+        regressor per other condition, the drifts and the confounds. The
+        models are not fitted one by one: they share the projection of the
+        drifts and confounds, and the products of the trial regressors with
+        the data, so that the whole beta series costs about as much as a
+        couple of GLM fits. The estimates are ordinary least squares
+        estimates whatever the noise_model. When the hrf model has
+        derivatives, they are included in the regressors of the trial and
+        of the conditions, and orthogonalized with respect to the main
+        regressor of each of them, after the sum of the trials of the
+        conditions, as in the design matrix of each model. The beta of the
+        main regressor is returned.
+
+        The masker is fitted on the first run, unless the model was already
+        fitted.
 
-        return self
+        Parameters
+        ----------
+        run_imgs: Niimg-like object or list of Niimg-like objects,
+            The runs, as for fit.
+
+        events: pandas Dataframe or string or list of pandas DataFrames or
+                strings
+            The events of each run, one trial per row.
+
+        confounds: pandas Dataframe or string or list of pandas DataFrames or
+                   strings, optional
+            The confounds of each run, as for fit.
+
+        Returns
+        -------
+        beta_series : Nifti1Image or list of Nifti1Image
+            For each run, a 4D image with one volume per trial, in the order
+            of the rows of the events of the run.
+        """
+        if self.t_r is None:
+            raise ValueError('t_r not given to FirstLevelModel object'
+                             ' to compute design from events')
+        if self.hrf_model == 'fir':
+            raise ValueError('The beta series cannot be estimated with a '
+                             'fir hrf model')
+        _check_events_file_uses_tab_separators(events_files=events)
+        single_run = not isinstance(run_imgs, (list, tuple))
+        if single_run:
+            run_imgs = [run_imgs]
+        events = _check_run_tables(run_imgs, events, 'events')
+        if confounds is not None:
+            confounds = _check_run_tables(run_imgs, confounds, 'confounds')
+        if getattr(self, 'masker_', None) is None:
+            self._fit_masker(run_imgs[0])
+
+        beta_series = []
+        for run_idx, run_img in enumerate(run_imgs):
+            # the design without events holds the drifts and confounds
+            run_img, nuisance = _run_design(
+                self, run_idx, run_img, None,
+                None if confounds is None else confounds[run_idx], None)
+            trial_type, onset, duration, modulation = check_events(
+                events[run_idx])
+            trials = [([onset_], [duration_], [modulation_]) for
+                      onset_, duration_, modulation_ in
+                      zip(onset, duration, modulation)]
+            X_sums, names = _compute_regressors(
+                trials, self.hrf_model, np.asarray(nuisance.index),
+                ['trial_%d' % trial for trial in range(len(trials))],
+                fir_delays=self.fir_delays,
+                min_onset=self.min_onset, orthogonalize=False)
+            n_kernels = len(names) // len(trials)
+            # the derivatives of the trials are orthogonalized trial by
+            # trial, those of the conditions once summed
+            X = X_sums.copy()
+            if n_kernels > 1:
+                for start in range(0, X.shape[1], n_kernels):
+                    _orthogonalize(X[:, start:start + n_kernels])
+            else:
+                X_sums = None
+            _, Y = _load_run(self, run_img, nuisance)
+            if self.signal_scaling:
+                Y, _ = mean_scaling(Y, self.scaling_axis)
+            betas = _beta_series(X, nuisance.values, Y, trial_type,
+                                 n_kernels=n_kernels, X_sums=X_sums)
+            beta_series.append(self.masker_.inverse_transform(betas))
+        return beta_series[0] if single_run else beta_series
 
     def compute_contrast(self, contrast_def, stat_type=None,
                          output_type='z_score'):
@@ -541,25 +1486,9 @@ class FirstLevelModel(BaseEstimator, TransformerMixin, CacheMixin):
         if self.labels_ is None or self.results_ is None:
             raise ValueError('The model has not been fit yet')
 
-        if isinstance(contrast_def, (np.ndarray, str)):
-            con_vals = [contrast_def]
-        elif isinstance(contrast_def, (list, tuple)):
-            con_vals = contrast_def
-        else:
-            raise ValueError('contrast_def must be an array or str or list of'
-                             ' (array or str)')
-
-        # Translate formulas to vectors
-        design_columns = self.design_matrices_[0].columns.tolist()
-        for cidx, con in enumerate(con_vals):
-            if isinstance(con, _basestring):
-                con_vals[cidx] = expression_to_contrast_vector(
-                    con, design_columns)
-
-        n_runs = len(self.labels_)
-        if len(con_vals) != n_runs:
-            warn('One contrast given, assuming it for all %d runs' % n_runs)
-            con_vals = con_vals * n_runs
+        con_vals = _get_run_contrasts(
+            contrast_def, self.design_matrices_[0].columns.tolist(),
+            len(self.labels_))
 
         # 'all' is assumed to be the final entry; if adding more, place before 'all'
         valid_types = ['z_score', 'stat', 'p_value', 'effect_size',
@@ -584,6 +1513,181 @@ class FirstLevelModel(BaseEstimator, TransformerMixin, CacheMixin):
 
         return outputs if output_type == 'all' else output
 
+    def compute_contrasts(self, contrasts, output_type='z_score',
+                          as_4d=False):
+        """Generate the maps of several contrasts in one pass
+
+        The t contrasts are stacked in one matrix per run, so that their
+        effects and variances are computed with a few matrix products per
+        run, and the maps of each output type are unmasked at once. F
+        contrasts are computed one by one, as with compute_contrast.
+
+        Parameters
+        ----------
+        contrasts : dict
+            Maps the name of each contrast to its definition, which can be
+            any contrast_def accepted by compute_contrast. The type of each
+            contrast is inferred from its definition as in compute_contrast:
+            't' for a vector or a single row (one per run), 'F' for a matrix
+            of several rows.
+
+        output_type : str, optional
+            Type of the output maps. Can be 'z_score', 'stat', 'p_value',
+            'effect_size', 'effect_variance' or 'all'
+
+        as_4d : bool, optional
+            If True, the maps of each output type are returned as a single
+            4D image, with one volume per contrast in the iteration order of
+            `contrasts`.
+
+        Returns
+        -------
+        output : dict
+            Maps the name of each contrast to the desired output image(s),
+            as returned by compute_contrast. If `as_4d` is True, the output
+            is instead the 4D image of the desired output type, or if
+            ``output_type == 'all'`` a dictionary of 4D images keyed by the
+            type of image.
+
+        """
+        if self.labels_ is None or self.results_ is None:
+            raise ValueError('The model has not been fit yet')
+        if not isinstance(contrasts, dict):
+            raise ValueError('contrasts must be a dict of contrast_def')
+
+        valid_types = ['z_score', 'stat', 'p_value', 'effect_size',
+                       'effect_variance', 'all']
+        if output_type not in valid_types:
+            raise ValueError('output_type must be one of {}'
+                             .format(valid_types))
+        output_types = (valid_types[:-1] if output_type == 'all'
+                        else [output_type])
+
+        names = list(contrasts)
+        design_columns = self.design_matrices_[0].columns.tolist()
+        n_runs = len(self.labels_)
+        con_vals = [_get_run_contrasts(contrasts[name], design_columns, n_runs)
+                    for name in names]
+
+        # stack the t contrasts, i.e. the ones defined by vectors or single
+        # rows
+        is_t = [all(np.atleast_2d(con_val).shape[0] == 1
+                    for con_val in con_vals_)
+                for con_vals_ in con_vals]
+        t_names = [name for name, t_ in zip(names, is_t) if t_]
+        computed = {}
+        if t_names:
+            t_con_vals = [np.array([np.ravel(con_vals_[run]) for con_vals_, t_
+                                    in zip(con_vals, is_t) if t_])
+                          for run in range(n_runs)]
+            computed.update(zip(t_names, _fixed_effect_t_contrasts(
+                self.labels_, self.results_, t_con_vals)))
+        for name, con_vals_, t_ in zip(names, con_vals, is_t):
+            if not t_:
+                computed[name] = _fixed_effect_contrast(
+                    self.labels_, self.results_, con_vals_, 'F')
+
+        outputs = dict((name, {}) for name in names)
+        maps_4d = {}
+        for output_type_ in output_types:
+            estimates = np.vstack([getattr(computed[name], output_type_)()
+                                   for name in names])
+            maps_4d[output_type_] = self.masker_.inverse_transform(estimates)
+            if as_4d:
+                maps_4d[output_type_].header['descrip'] = (
+                    '%s of contrasts %s' % (output_type_, ', '.join(
+                        str(name) for name in names)))
+                continue
+            for name, con_vals_, output in zip(
+                    names, con_vals, iter_img(maps_4d[output_type_])):
+                output.header['descrip'] = (
+                    '%s of contrast %s' % (output_type_, str(con_vals_)))
+                outputs[name][output_type_] = output
+
+        if as_4d:
+            return maps_4d if output_type == 'all' else maps_4d[output_type]
+        if output_type == 'all':
+            return outputs
+        return dict((name, outputs[name][output_type]) for name in names)
+
+    def _read_time_series(self, kind, run, voxels, scans):
+        """Read the requested part of the time series memory map `kind`"""
+        if getattr(self, 'time_series_files_', None) is None:
+            raise ValueError('No time series were written: set '
+                             'residuals_dir before fitting the model')
+        files = self.time_series_files_[run]
+        data = np.memmap(files[kind], dtype=np.dtype(files['dtype']),
+                         mode='r', shape=tuple(files['shape']))
+        voxels = slice(None) if voxels is None else voxels
+        scans = slice(None) if scans is None else scans
+        # voxel-major layout: only the rows of the voxels are read
+        return np.array(data[voxels][..., scans].T)
+
+    def residuals(self, run=0, voxels=None, scans=None):
+        """Read the residuals of a run written in residuals_dir
+
+        Parameters
+        ----------
+        run : int, optional
+            index of the run
+
+        voxels : slice, int or array of ints or booleans, optional
+            masked voxels to read, all of them by default
+
+        scans : slice, int or array of ints or booleans, optional
+            scans to read, all of them by default
+
+        Returns
+        -------
+        residuals : array of shape (n_scans, n_voxels)
+            residuals of the (possibly mean-scaled) data of the voxels
+        """
+        return self._read_time_series('residuals', run, voxels, scans)
+
+    def predicted(self, run=0, voxels=None, scans=None):
+        """Read the predicted time series of a run written in residuals_dir
+
+        Parameters
+        ----------
+        run : int, optional
+            index of the run
+
+        voxels : slice, int or array of ints or booleans, optional
+            masked voxels to read, all of them by default
+
+        scans : slice, int or array of ints or booleans, optional
+            scans to read, all of them by default
+
+        Returns
+        -------
+        predicted : array of shape (n_scans, n_voxels)
+            the design matrix times the parameter estimates of the voxels
+        """
+        return self._read_time_series('predicted', run, voxels, scans)
+
+
+def _get_run_contrasts(contrast_def, design_columns, n_runs):
+    """Translate a contrast definition of FirstLevelModel.compute_contrast
+    into a list of one contrast array per run"""
+    if isinstance(contrast_def, (np.ndarray, str)):
+        con_vals = [contrast_def]
+    elif isinstance(contrast_def, (list, tuple)):
+        con_vals = list(contrast_def)
+    else:
+        raise ValueError('contrast_def must be an array or str or list of'
+                         ' (array or str)')
+
+    # Translate formulas to vectors
+    for cidx, con in enumerate(con_vals):
+        if isinstance(con, _basestring):
+            con_vals[cidx] = expression_to_contrast_vector(
+                con, design_columns)
+
+    if len(con_vals) != n_runs:
+        warn('One contrast given, assuming it for all %d runs' % n_runs)
+        con_vals = con_vals * n_runs
+    return con_vals
+
 
 @replace_parameters({'mask': 'mask_img'}, end_version='next')
 def first_level_models_from_bids(
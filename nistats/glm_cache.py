@@ -0,0 +1,190 @@
+"""
+Cache of GLM fits keyed on cheap fingerprints of their inputs.
+
+joblib.Memory finds a cached call by hashing its arguments, that is the
+whole masked data of a run, at every call. A GLMCache instead identifies
+the images given as files by their path, size and modification time, and
+the masker, design matrix and model parameters by small digests, so that
+the fit of an unchanged run is found without reading its data.
+
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from nibabel.spatialimages import SpatialImage
+from pandas import DataFrame
+
+from .regression import PackedRegressionResults, _pack_results
+from .utils import _basestring
+
+# default size of the cache, in bytes
+DEF_MAX_BYTES = 2 ** 33
+_ARRAYS = ('theta', 'dispersion', 'cov', 'bin_index', 'rho', 'df')
+# parameters of a masker that change the masked data
+_MASKER_PARAMS = ('smoothing_fwhm', 'target_affine', 'target_shape',
+                  'standardize', 'detrend', 'low_pass', 'high_pass', 't_r',
+                  'dtype')
+
+
+def _digest(array):
+    """Digest of the values, type and shape of an array, whatever its
+    memory layout"""
+    array = np.asarray(array)
+    if array.dtype == object:
+        digest = hashlib.sha1(repr(array.tolist()).encode())
+    else:
+        digest = hashlib.sha1(
+            np.ascontiguousarray(array).reshape(-1).view(np.uint8))
+    digest.update(repr((array.dtype.str, array.shape)).encode())
+    return digest.hexdigest()
+
+
+def _file_fingerprint(filename):
+    stat = os.stat(filename)
+    return ('file', os.path.abspath(filename), stat.st_size, stat.st_mtime)
+
+
+def _fingerprint(obj):
+    """Cheap identity of an input of a GLM fit.
+
+    Files, and images whose data have not been read from their file, are
+    identified by the path, size and modification time of the file. The
+    other images, arrays and DataFrames are identified by a digest of their
+    values, and maskers by their mask and parameters.
+
+    Returns
+    -------
+    fingerprint : tuple or str
+        A value whose repr identifies obj.
+    """
+    if isinstance(obj, _basestring) and os.path.isfile(obj):
+        return _file_fingerprint(obj)
+    if isinstance(obj, SpatialImage):
+        filename = obj.get_filename()
+        if filename is not None and not obj.in_memory:
+            return _file_fingerprint(filename)
+        return ('image', _digest(obj.get_data()), _digest(obj.affine))
+    if isinstance(obj, np.ndarray):
+        return ('array', _digest(obj))
+    if isinstance(obj, DataFrame):
+        return ('frame', tuple(obj.columns), _digest(obj.values))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_fingerprint(element) for element in obj)
+    if hasattr(obj, 'mask_img_'):
+        return (obj.__class__.__name__, _fingerprint(obj.mask_img_)) + tuple(
+            _fingerprint(getattr(obj, name, None)) for name in _MASKER_PARAMS)
+    return repr(obj)
+
+
+class GLMCache(object):
+    """Cache of GLM fits on disk, with least recently used eviction.
+
+    Each entry holds the packed results of a fit, as .npy files in a
+    directory named after its key. The parameter estimates are memory
+    mapped when an entry is read, so that a cache hit takes milliseconds.
+
+    Parameters
+    ----------
+    cachedir : str
+        Directory of the cache, created if needed.
+
+    max_bytes : int, optional
+        Size of the cache. The least recently used entries are removed when
+        an entry is added to a full cache.
+    """
+
+    def __init__(self, cachedir, max_bytes=DEF_MAX_BYTES):
+        self.cachedir = os.path.abspath(os.path.expanduser(cachedir))
+        self.max_bytes = max_bytes
+
+    def __repr__(self):
+        return '%s(cachedir=%r, max_bytes=%r)' % (
+            self.__class__.__name__, self.cachedir, self.max_bytes)
+
+    def key(self, *inputs):
+        """Key of the fit of the given inputs, see _fingerprint"""
+        return hashlib.sha1(repr(_fingerprint(inputs)).encode()).hexdigest()
+
+    def _entries(self):
+        """Paths, sizes and access times of the entries of the cache"""
+        entries = []
+        if not os.path.isdir(self.cachedir):
+            return entries
+        for name in os.listdir(self.cachedir):
+            path = os.path.join(self.cachedir, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, filename))
+                           for filename in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                # removed meanwhile
+                pass
+        return entries
+
+    def get(self, key):
+        """Load the fit stored under key.
+
+        Returns
+        -------
+        labels, results : array of shape (n_voxels,),
+                          PackedRegressionResults
+            As returned by run_glm, or None if there is no such entry.
+        """
+        path = os.path.join(self.cachedir, key)
+        try:
+            arrays = {name: np.load(os.path.join(path, name + '.npy'),
+                                    mmap_mode='r' if name == 'theta'
+                                    else None)
+                      for name in _ARRAYS}
+            # marks the entry as recently used
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        df_total, df_model = arrays.pop('df').tolist()
+        results = PackedRegressionResults(df_total=df_total,
+                                          df_model=df_model, **arrays)
+        return results.labels, results
+
+    def put(self, key, labels, results):
+        """Store the fit (labels, results) returned by run_glm under key,
+        then evict the least recently used entries beyond max_bytes."""
+        results = _pack_results(labels, results)
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        # the entry is written aside, then renamed to be complete at once
+        tmp = tempfile.mkdtemp(prefix='.', dir=self.cachedir)
+        arrays = dict(theta=results.theta, dispersion=results.dispersion,
+                      cov=results.cov, bin_index=results.bin_index,
+                      rho=results.rho,
+                      df=np.array([results.df_total, results.df_model]))
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), array)
+        path = os.path.join(self.cachedir, key)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # stored meanwhile
+            shutil.rmtree(tmp, ignore_errors=True)
+        self._evict(keep=path)
+
+    def _evict(self, keep=None):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+        if total > self.max_bytes and keep is not None:
+            # an entry larger than the cache is not kept
+            shutil.rmtree(keep, ignore_errors=True)
+
+    def clear(self):
+        """Remove all the entries of the cache"""
+        shutil.rmtree(self.cachedir, ignore_errors=True)
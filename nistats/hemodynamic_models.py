@@ -6,10 +6,41 @@ This module closely follows SPM implementation
 Author: Bertrand Thirion, 2011--2018
 """
 
+import hashlib
+import threading
 import warnings
+from collections import OrderedDict
+
 import numpy as np
+from scipy import sparse
 from scipy.stats import gamma
 
+from .utils import _basestring
+
+try:
+    from scipy.fftpack import next_fast_len
+except ImportError:  # scipy < 0.18
+    def next_fast_len(target):
+        return 2 ** int(np.ceil(np.log2(target)))
+
+# number of values of the Fourier transforms of the regressors computed at once
+FFT_CHUNK_SIZE = 2 ** 22
+# number of resampling matrices kept by _resampling_matrix
+RESAMPLING_CACHE_SIZE = 64
+_resampling_cache = OrderedDict()
+_resampling_cache_lock = threading.Lock()
+# number of sets of kernels kept by _hrf_kernel
+HRF_CACHE_SIZE = 256
+_hrf_cache = OrderedDict()
+_hrf_cache_lock = threading.Lock()
+# kernels registered with register_hrf_kernel, by hrf model and (tr,
+# oversampling), and the suffixes of the names of their regressors
+_registered_hrfs = {}
+_BUILTIN_HRFS = [
+    'spm', 'spm + derivative', 'spm + derivative + dispersion', 'fir',
+    'glover', 'glover + derivative', 'glover + derivative + dispersion',
+    None]
+
 
 def _gamma_difference_hrf(tr, oversampling=50, time_length=32., onset=0.,
                           delay=6, undershoot=16., dispersion=1.,
@@ -258,6 +289,39 @@ def _sample_condition(exp_condition, frame_times, oversampling=50,
     hr_frame_times : array of shape(over_sampling * n_scans)
         time points used for regressor sampling
     """
+    regressors, hr_frame_times = _sample_conditions(
+        [exp_condition], frame_times, oversampling, min_onset)
+    return regressors[0], hr_frame_times
+
+
+def _sample_conditions(exp_conditions, frame_times, oversampling=50,
+                       min_onset=-24):
+    """Make the possibly oversampled event regressors of several conditions,
+    on one time grid.
+
+    Parameters
+    ----------
+    exp_conditions : list of arraylikes of shape (3, n_events)
+        yields description of events for each condition as a
+        (onsets, durations, amplitudes) triplet
+
+    frame_times : array of shape(n_scans)
+        sample time points
+
+    oversampling : int, optional
+        factor for oversampling event regressor
+
+    min_onset : float, optional
+        minimal onset relative to frame_times[0] (in seconds)
+        events that start before frame_times[0] + min_onset are not considered
+
+    Returns
+    -------
+    regressors: array of shape(n_conditions, over_sampling * n_scans)
+        possibly oversampled event regressors
+    hr_frame_times : array of shape(over_sampling * n_scans)
+        time points used for regressor sampling
+    """
     # Find the high-resolution frame_times
     n = frame_times.size
     min_onset = float(min_onset)
@@ -269,31 +333,91 @@ def _sample_condition(exp_condition, frame_times, oversampling=50,
                                  frame_times.max() * (1 + 1. / (n - 1)),
                                  np.rint(n_hr).astype(np.int))
 
-    # Get the condition information
-    onsets, durations, values = tuple(map(np.asanyarray, exp_condition))
+    # Get the events of all the conditions, and their condition
+    exp_conditions = [tuple(map(np.asanyarray, exp_condition))
+                      for exp_condition in exp_conditions]
+    index = np.repeat(np.arange(len(exp_conditions)),
+                      [np.size(onsets) for onsets, _, _ in exp_conditions])
+    onsets, durations, values = (
+        np.concatenate([np.ravel(exp_condition[k])
+                        for exp_condition in exp_conditions])
+        for k in range(3))
     if (onsets < frame_times[0] + min_onset).any():
         warnings.warn(('Some stimulus onsets are earlier than %s in the'
                        ' experiment and are thus not considered in the model'
                 % (frame_times[0] + min_onset)), UserWarning)
 
-    # Set up the regressor timecourse
+    # Set up the regressor timecourses
     tmax = len(hr_frame_times)
-    regressor = np.zeros_like(hr_frame_times).astype(np.float)
+    regressors = np.zeros((len(exp_conditions), tmax))
     t_onset = np.minimum(np.searchsorted(hr_frame_times, onsets), tmax - 1)
-    regressor[t_onset] += values
     t_offset = np.minimum(
         np.searchsorted(hr_frame_times, onsets + durations),
         tmax - 1)
 
     # Handle the case where duration is 0 by offsetting at t + 1
-    for i, t in enumerate(t_offset):
-        if t < (tmax - 1) and t == t_onset[i]:
-            t_offset[i] += 1
+    t_offset[(t_offset < tmax - 1) & (t_offset == t_onset)] += 1
 
-    regressor[t_offset] -= values
-    regressor = np.cumsum(regressor)
+    # the events that start or end on the same sample add up
+    np.add.at(regressors, (index, t_onset), values)
+    np.add.at(regressors, (index, t_offset), -values)
+    np.cumsum(regressors, axis=1, out=regressors)
 
-    return regressor, hr_frame_times
+    return regressors, hr_frame_times
+
+
+def _resampling_matrix(hr_frame_times, frame_times):
+    """ Sparse matrix of the linear interpolation at frame times of the
+    regressors sampled at hr_frame_times
+
+    The matrices are kept in a bounded least recently used cache, shared by
+    the runs with the same timing.
+
+    Parameters
+    ----------
+    hr_frame_times : array of shape(n_samples),
+        the increasing time stamps of the high resolution regressors
+
+    frame_times: array of shape(n_scans),
+         the desired time stamps
+
+    Returns
+    -------
+    resampling_matrix: sparse matrix of shape(n_scans, n_samples)
+        the matrix that maps the high resolution regressors to the resampled
+        regressors
+    """
+    hr_frame_times = np.ascontiguousarray(hr_frame_times, dtype=np.float)
+    frame_times = np.ascontiguousarray(frame_times, dtype=np.float)
+    key = (hashlib.sha1(hr_frame_times).hexdigest(),
+           hashlib.sha1(frame_times).hexdigest())
+    with _resampling_cache_lock:
+        matrix = _resampling_cache.pop(key, None)
+        if matrix is not None:
+            _resampling_cache[key] = matrix
+            return matrix
+    if ((frame_times < hr_frame_times[0]).any() or
+            (frame_times > hr_frame_times[-1]).any()):
+        raise ValueError('The frame times should be in the range of the '
+                         'high resolution frame times [%s, %s]'
+                         % (hr_frame_times[0], hr_frame_times[-1]))
+    # the interval [hr_frame_times[hi - 1], hr_frame_times[hi]] of each
+    # frame time
+    hi = np.clip(np.searchsorted(hr_frame_times, frame_times),
+                 1, hr_frame_times.size - 1)
+    lo = hi - 1
+    weights = ((frame_times - hr_frame_times[lo]) /
+               (hr_frame_times[hi] - hr_frame_times[lo]))
+    rows = np.arange(frame_times.size)
+    matrix = sparse.csr_matrix(
+        (np.concatenate((1 - weights, weights)),
+         (np.concatenate((rows, rows)), np.concatenate((lo, hi)))),
+        shape=(frame_times.size, hr_frame_times.size))
+    with _resampling_cache_lock:
+        _resampling_cache[key] = matrix
+        while len(_resampling_cache) > RESAMPLING_CACHE_SIZE:
+            _resampling_cache.popitem(last=False)
+    return matrix
 
 
 def _resample_regressor(hr_regressor, hr_frame_times, frame_times):
@@ -301,8 +425,8 @@ def _resample_regressor(hr_regressor, hr_frame_times, frame_times):
 
     Parameters
     ----------
-    hr_regressor : array of shape(n_samples),
-        the regressor time course sampled at high temporal resolution
+    hr_regressor : array of shape(n_samples) or (n_regressors, n_samples),
+        the regressor time course(s) sampled at high temporal resolution
 
     hr_frame_times : array of shape(n_samples),
         the corresponding time stamps
@@ -312,12 +436,11 @@ def _resample_regressor(hr_regressor, hr_frame_times, frame_times):
 
     Returns
     -------
-    regressor: array of shape(n_scans)
-         the resampled regressor
+    regressor: array of shape(n_scans) or (n_scans, n_regressors)
+         the resampled regressor(s)
     """
-    from scipy.interpolate import interp1d
-    f = interp1d(hr_frame_times, hr_regressor)
-    return f(frame_times).T
+    matrix = _resampling_matrix(hr_frame_times, frame_times)
+    return matrix.dot(np.asarray(hr_regressor).T)
 
 
 def _orthogonalize(X):
@@ -340,9 +463,10 @@ def _orthogonalize(X):
     if X.size == X.shape[0]:
         return X
 
-    from scipy.linalg import pinv
-    for i in range(1, X.shape[1]):
-        X[:, i] -= np.dot(np.dot(X[:, i], X[:, :i]), pinv(X[:, :i]))
+    # with X = QR, the residual of column i on the preceding columns is
+    # Q[:, i] * R[i, i]: one QR decomposition orthogonalizes all of them
+    Q, R = np.linalg.qr(X)
+    X[:, 1:] = Q[:, 1:] * np.diag(R)[1:]
 
     return X
 
@@ -375,6 +499,80 @@ def _regressor_names(con_name, hrf_model, fir_delays=None):
         return [con_name, con_name + "_derivative", con_name + "_dispersion"]
     elif hrf_model == 'fir':
         return [con_name + "_delay_%d" % i for i in fir_delays]
+    elif _registered_hrf(hrf_model) is not None:
+        return [con_name + suffix
+                for suffix in _registered_hrf(hrf_model)['suffixes']]
+
+
+def register_hrf_kernel(hrf_model, kernels, tr, oversampling=50,
+                        suffixes=None):
+    """ Register precomputed kernels of a custom hrf model, that can then
+    be used as hrf_model to compute regressors and design matrices
+
+    Parameters
+    ----------
+    hrf_model : string
+        name of the hrf model, that must differ from the names of the
+        hrf models of nistats
+
+    kernels : array of shape (n_samples,) or list of such arrays
+        samples of the hrf, and of its derivatives if any, with a sampling
+        interval of tr / oversampling
+
+    tr : float
+        the repetition time in seconds
+
+    oversampling : int, optional
+        temporal oversampling factor of the kernels
+
+    suffixes : list of strings, optional
+        suffixes of the names of the regressors of each kernel, that default
+        to '' for the first kernel and '_<k>' for the k-th other one
+
+    Notes
+    -----
+    The names of the registered hrf models are not case sensitive.
+    """
+    hrf_model = hrf_model.lower()
+    if hrf_model in _BUILTIN_HRFS:
+        raise ValueError('"%s" is the name of an hrf model of nistats'
+                         % hrf_model)
+    if np.ndim(kernels) == 1:
+        kernels = [kernels]
+    kernels = [np.array(kernel, dtype=np.float64) for kernel in kernels]
+    for kernel in kernels:
+        kernel.setflags(write=False)
+    if suffixes is None:
+        suffixes = [''] + ['_%d' % k for k in range(1, len(kernels))]
+    elif len(suffixes) != len(kernels):
+        raise ValueError('%d suffixes given for %d kernels'
+                         % (len(suffixes), len(kernels)))
+    registered = _registered_hrfs.setdefault(
+        hrf_model, {'suffixes': list(suffixes), 'kernels': {}})
+    if len(registered['suffixes']) != len(kernels):
+        raise ValueError('"%s" is registered with %d kernels'
+                         % (hrf_model, len(registered['suffixes'])))
+    registered['suffixes'] = list(suffixes)
+    registered['kernels'][(float(tr), oversampling)] = kernels
+
+
+def _registered_hrf(hrf_model):
+    """ Registration of the hrf model hrf_model by register_hrf_kernel,
+    or None"""
+    if isinstance(hrf_model, _basestring):
+        return _registered_hrfs.get(hrf_model.lower())
+    return None
+
+
+def _registered_hrf_kernel(hrf_model, tr, oversampling):
+    """ Kernels registered for hrf_model, with a repetition time close to
+    tr, since tr is estimated from the frame times"""
+    for (tr_, oversampling_), kernels in \
+            _registered_hrf(hrf_model)['kernels'].items():
+        if oversampling_ == oversampling and np.isclose(tr_, tr, rtol=1e-6):
+            return list(kernels)
+    raise ValueError('No kernel of the hrf model "%s" is registered for tr '
+                     '%s and oversampling %d' % (hrf_model, tr, oversampling))
 
 
 def _hrf_kernel(hrf_model, tr, oversampling=50, fir_delays=None):
@@ -398,12 +596,33 @@ def _hrf_kernel(hrf_model, tr, oversampling=50, fir_delays=None):
     Returns
     -------
     hkernel : list of arrays
-        samples of the hrf (the number depends on the hrf_model used)
+        samples of the hrf (the number depends on the hrf_model used), that
+        are read-only since they are shared by the calls with the same
+        parameters: the last HRF_CACHE_SIZE sets of kernels are kept.
     """
-    acceptable_hrfs = [
-        'spm', 'spm + derivative', 'spm + derivative + dispersion', 'fir',
-        'glover', 'glover + derivative', 'glover + derivative + dispersion',
-        None]
+    if _registered_hrf(hrf_model) is not None:
+        return _registered_hrf_kernel(hrf_model, tr, oversampling)
+    # the delays are only parameters of fir models
+    key = (hrf_model, tr, oversampling,
+           tuple(np.ravel(fir_delays)) if hrf_model == 'fir' else None)
+    with _hrf_cache_lock:
+        hkernel = _hrf_cache.pop(key, None)
+        if hkernel is not None:
+            # the least recently used kernels are evicted first
+            _hrf_cache[key] = hkernel
+            return list(hkernel)
+    hkernel = _compute_hrf_kernel(hrf_model, tr, oversampling, fir_delays)
+    for kernel in hkernel:
+        kernel.setflags(write=False)
+    with _hrf_cache_lock:
+        _hrf_cache[key] = hkernel
+        while len(_hrf_cache) > HRF_CACHE_SIZE:
+            _hrf_cache.popitem(last=False)
+    return list(hkernel)
+
+
+def _compute_hrf_kernel(hrf_model, tr, oversampling=50, fir_delays=None):
+    """ Compute the kernels returned by _hrf_kernel"""
     if hrf_model == 'spm':
         hkernel = [spm_hrf(tr, oversampling)]
     elif hrf_model == 'spm + derivative':
@@ -430,7 +649,8 @@ def _hrf_kernel(hrf_model, tr, oversampling=50, fir_delays=None):
         hkernel = [np.hstack((1, np.zeros(oversampling - 1)))]
     else:
         raise ValueError('"{0}" is not a known hrf model. Use one of {1}'.
-                         format(hrf_model, acceptable_hrfs))
+                         format(hrf_model, _BUILTIN_HRFS +
+                                sorted(_registered_hrfs)))
     return hkernel
 
 
@@ -492,19 +712,86 @@ def compute_regressor(exp_condition, hrf_model, frame_times, con_id='cond',
     In case of glover and spm models, the derived regressors are
     orthogonalized wrt the main one.
     """
+    return _compute_regressors([exp_condition], hrf_model, frame_times,
+                               [con_id], oversampling, fir_delays, min_onset)
+
+
+def _convolve_kernels(regressors, hkernel, fft=True):
+    """ Convolve each regressor with each kernel
+
+    Parameters
+    ----------
+    regressors : array of shape (n_regressors, n_samples)
+        the regressors sampled at high temporal resolution
+
+    hkernel : list of arrays
+        the kernels, at the same temporal resolution
+
+    fft : bool, optional
+        whether to convolve all the regressors with all the kernels at once
+        in the Fourier domain, which is much faster for long kernels, or one
+        by one in the time domain, which is exact for box kernels
+
+    Returns
+    -------
+    conv_reg : array of shape (n_regressors, n_kernels, n_samples)
+        the convolved regressors, truncated to n_samples
+    """
+    n_regressors, n_samples = regressors.shape
+    conv_reg = np.empty((n_regressors, len(hkernel), n_samples))
+    if not fft:
+        for i, regressor in enumerate(regressors):
+            for j, h in enumerate(hkernel):
+                conv_reg[i, j] = np.convolve(regressor, h)[:n_samples]
+        return conv_reg
+    n_fft = next_fast_len(n_samples + max(h.size for h in hkernel) - 1)
+    kernels_fft = np.array([np.fft.rfft(h, n_fft) for h in hkernel])
+    # the regressors are transformed by chunks to bound the memory used
+    chunk_size = max(1, FFT_CHUNK_SIZE // (len(hkernel) * n_fft))
+    for start in range(0, n_regressors, chunk_size):
+        regressors_fft = np.fft.rfft(regressors[start:start + chunk_size],
+                                     n_fft)
+        conv_reg[start:start + chunk_size] = np.fft.irfft(
+            regressors_fft[:, np.newaxis] * kernels_fft,
+            n_fft)[..., :n_samples]
+    return conv_reg
+
+
+def _compute_regressors(exp_conditions, hrf_model, frame_times, con_ids,
+                        oversampling=50, fir_delays=None, min_onset=-24,
+                        orthogonalize=True):
+    """ Compute the regressors of several conditions at once, see
+    compute_regressor
+
+    The event regressors of all the conditions are sampled on one high
+    resolution grid, convolved with all the kernels at once, and resampled
+    at the frame times in one step. If orthogonalize is False, the
+    regressors of the derivatives are not orthogonalized with respect to
+    the main regressor of their condition.
+
+    Returns
+    -------
+    computed_regressors: array of shape(n_scans, n_conditions * n_kernels)
+        computed regressors sampled at frame times, by condition
+
+    reg_names: list of strings
+        corresponding regressor names
+    """
     # this is the average tr in this session, not necessarily the true tr
     tr = float(frame_times.max()) / (np.size(frame_times) - 1)
 
-    # 1. create the high temporal resolution regressor
-    hr_regressor, hr_frame_times = _sample_condition(
-        exp_condition, frame_times, oversampling, min_onset)
+    # 1. create the high temporal resolution regressors
+    hr_regressors, hr_frame_times = _sample_conditions(
+        exp_conditions, frame_times, oversampling, min_onset)
 
     # 2. create the  hrf model(s)
     hkernel = _hrf_kernel(hrf_model, tr, oversampling, fir_delays)
 
-    # 3. convolve the regressor and hrf, and downsample the regressor
-    conv_reg = np.array([np.convolve(hr_regressor, h)[:hr_regressor.size]
-                         for h in hkernel])
+    # 3. convolve the regressors and hrf; the box kernels of fir models are
+    # convolved exactly in the time domain
+    conv_reg = _convolve_kernels(hr_regressors, hkernel,
+                                 fft=hrf_model not in ['fir', None])
+    conv_reg = conv_reg.reshape(-1, hr_frame_times.size)
 
     # 4. temporally resample the regressors
     if hrf_model == 'fir' and oversampling > 1:
@@ -514,11 +801,106 @@ def compute_regressor(exp_condition, hrf_model, frame_times, con_id='cond',
     else:
         computed_regressors = _resample_regressor(
             conv_reg, hr_frame_times, frame_times)
-        
-    # 5. ortogonalize the regressors
-    if hrf_model != 'fir':
-        computed_regressors = _orthogonalize(computed_regressors)
+
+    # 5. ortogonalize the regressors of each condition
+    n_kernels = len(hkernel)
+    if orthogonalize and hrf_model != 'fir' and n_kernels > 1:
+        for start in range(0, computed_regressors.shape[1], n_kernels):
+            _orthogonalize(computed_regressors[:, start:start + n_kernels])
 
     # 6 generate regressor names
-    reg_names = _regressor_names(con_id, hrf_model, fir_delays=fir_delays)
+    reg_names = [name for con_id in con_ids for name in
+                 _regressor_names(con_id, hrf_model, fir_delays=fir_delays)]
+    return computed_regressors, reg_names
+
+
+def compute_continuous_regressor(signal, sample_times, frame_times,
+                                 hrf_model=None, con_id='signal'):
+    """ Convolve continuous signals sampled at a high rate, e.g.
+    physiological recordings or audio envelopes, with an hrf model and
+    sample them at frame times
+
+    The signals are transformed once to the Fourier domain, where they are
+    convolved with the hrf kernels and low-pass filtered below the Nyquist
+    frequency of the frame times, to avoid aliasing. They are then
+    interpolated at the frame times. The regressors can be added to a design
+    matrix as the add_regs of make_first_level_design_matrix.
+
+    Parameters
+    ----------
+    signal : array of shape (n_samples,) or (n_samples, n_signals)
+        the signals, regularly sampled
+
+    sample_times : array of shape (n_samples,)
+        the sampling times of the signals, in seconds, on the clock of the
+        frame times
+
+    frame_times : array of shape (n_scans,)
+        the desired sampling times, within the range of sample_times
+
+    hrf_model : {'spm', 'spm + derivative', 'spm + derivative + dispersion',
+        'glover', 'glover + derivative', 'glover + derivative + dispersion',
+        None}, optional
+        Name of the hrf model to be used. If None, the signals are only
+        filtered and resampled.
+
+    con_id : string or list of strings, optional
+        identifier of the signal, or of each signal
+
+    Returns
+    -------
+    computed_regressors: array of shape(n_scans, n_signals * n_kernels)
+        computed regressors sampled at frame times, signal by signal
+
+    reg_names: list of strings
+        corresponding regressor names
+    """
+    if hrf_model == 'fir':
+        raise ValueError('Continuous signals cannot be convolved with a '
+                         'fir model')
+    signal = np.asarray(signal, dtype=np.float)
+    if signal.ndim == 1:
+        signal = signal[:, np.newaxis]
+    sample_times = np.asarray(sample_times, dtype=np.float)
+    if sample_times.shape != signal.shape[:1]:
+        raise ValueError('The signal has %d samples but %d sample times were '
+                         'given' % (signal.shape[0], sample_times.size))
+    dt = np.diff(sample_times)
+    if not np.allclose(dt, dt.mean(), rtol=1e-3):
+        raise ValueError('The samples of the signal should be regularly '
+                         'spaced')
+    dt = dt.mean()
+    con_ids = [con_id] if isinstance(con_id, _basestring) else list(con_id)
+    if len(con_ids) != signal.shape[1]:
+        raise ValueError('%d identifiers were given for %d signals'
+                         % (len(con_ids), signal.shape[1]))
+
+    # the kernels are sampled at the rate of the signals
+    if hrf_model is None:
+        hkernel = [np.ones(1)]
+    else:
+        hkernel = _hrf_kernel(hrf_model, dt, 1)
+    n_samples = signal.shape[0]
+    n_fft = next_fast_len(n_samples + max(h.size for h in hkernel) - 1)
+    # frequencies above the Nyquist frequency of the frame times are removed
+    frequencies = np.fft.rfftfreq(n_fft, dt)
+    tr = (frame_times.max() - frame_times.min()) / max(1, frame_times.size - 1)
+    low_pass = frequencies <= .5 / tr
+    signal_fft = np.fft.rfft(signal, n_fft, axis=0)[low_pass]
+    filtered = np.empty((signal.shape[1] * len(hkernel), n_samples))
+    for k, h in enumerate(hkernel):
+        filtered_fft = np.zeros((frequencies.size, signal.shape[1]),
+                                dtype=signal_fft.dtype)
+        filtered_fft[low_pass] = (signal_fft *
+                                  np.fft.rfft(h, n_fft)[low_pass, np.newaxis])
+        filtered[k::len(hkernel)] = np.fft.irfft(
+            filtered_fft, n_fft, axis=0)[:n_samples].T
+
+    computed_regressors = _resample_regressor(filtered, sample_times,
+                                              frame_times)
+    if len(hkernel) > 1:
+        for start in range(0, computed_regressors.shape[1], len(hkernel)):
+            _orthogonalize(computed_regressors[:, start:start + len(hkernel)])
+    reg_names = [name for con_id in con_ids for name in
+                 _regressor_names(con_id, hrf_model)]
     return computed_regressors, reg_names
@@ -20,14 +20,17 @@ General reference for regression models:
 
 __docformat__ = 'restructuredtext en'
 
+try:
+    from collections.abc import Mapping
+except ImportError:  # python2
+    from collections import Mapping
+
 import numpy as np
 
 from nibabel.onetime import setattr_on_read
-from numpy.linalg import matrix_rank
-import scipy.linalg as spl
 
 from .model import LikelihoodModelResults
-from .utils import positive_reciprocal
+from .utils import _matrix_rank, _pinv, positive_reciprocal
 
 
 class OLSModel(object):
@@ -68,7 +71,7 @@ class OLSModel(object):
         Degrees of freedome of the model.  The rank of the design.
     """
 
-    def __init__(self, design):
+    def __init__(self, design, dtype=None):
         """
         Parameters
         ----------
@@ -76,8 +79,15 @@ class OLSModel(object):
             This is your design matrix.
             Data are assumed to be column ordered with
             observations in rows.
+
+        dtype : numpy dtype or None, optional
+            If not None, floating point type in which the data, parameters
+            and residuals are handled by `fit`, e.g. np.float32 to halve
+            their memory footprint. The design-sized quantities, such as
+            `normalized_cov_beta`, are always computed in float64.
         """
         super(OLSModel, self).__init__()
+        self.dtype = dtype
         self.initialize(design)
 
     def initialize(self, design):
@@ -85,13 +95,14 @@ class OLSModel(object):
         # TODO: handle case for noconstant regression
         self.design = design
         self.wdesign = self.whiten(self.design)
-        self.calc_beta = spl.pinv(self.wdesign)
-        self.normalized_cov_beta = np.dot(self.calc_beta,
-                                          np.transpose(self.calc_beta))
+        # the pseudo-inverse, its covariance and the rank are derived from
+        # shared factorizations: for the OLS model, the design and whitened
+        # design are decomposed once, as when the design was checked
+        self.calc_beta, self.normalized_cov_beta = _pinv(self.wdesign)
         self.df_total = self.wdesign.shape[0]
 
         eps = np.abs(self.design).sum() * np.finfo(np.float).eps
-        self.df_model = matrix_rank(self.design, eps)
+        self.df_model = _matrix_rank(self.design, eps)
         self.df_resid = self.df_total - self.df_model
 
     def logL(self, beta, Y, nuisance=None):
@@ -195,11 +206,17 @@ class OLSModel(object):
         # Other estimates of the covariance matrix for a heteroscedastic
         # regression model can be implemented in WLSmodel. (Weighted least
         # squares models assume covariance is diagonal, i.e. heteroscedastic).
+        calc_beta, wdesign = self.calc_beta, self.wdesign
+        if self.dtype is not None:
+            Y = np.asarray(Y, self.dtype)
+            calc_beta = calc_beta.astype(self.dtype)
+            wdesign = np.asarray(wdesign, self.dtype)
         wY = self.whiten(Y)
-        beta = np.dot(self.calc_beta, wY)
-        wresid = wY - np.dot(self.wdesign, beta)
-        dispersion = np.sum(wresid ** 2, 0) / (self.wdesign.shape[0] -
-                                               self.wdesign.shape[1])
+        beta = np.dot(calc_beta, wY)
+        wresid = wY - np.dot(wdesign, beta)
+        dispersion = (
+            np.einsum('i...,i...->...', wresid, wresid, dtype=np.float64) /
+            (self.wdesign.shape[0] - self.wdesign.shape[1]))
         lfit = RegressionResults(beta, Y, self,
                                  wY, wresid, dispersion=dispersion,
                                  cov=self.normalized_cov_beta)
@@ -253,13 +270,269 @@ class ARModel(OLSModel):
         wX : ndarray
             X whitened with order self.order AR
         """
-        X = np.asarray(X, np.float64)
+        X = np.asarray(X, np.dtype(self.dtype))
         _X = X.copy()
         for i in range(self.order):
             _X[(i + 1):] = _X[(i + 1):] - self.rho[i] * X[0: - (i + 1)]
         return _X
 
 
+def _ar1_whiten(X, rho):
+    """ Whiten the columns of X according to AR(1) covariance structures
+
+    Parameters
+    ----------
+    X : array of shape (..., n_time_points, n_columns)
+        array to whiten, time being the second to last axis
+
+    rho : float or array broadcastable against X[..., 1:, :]
+        AR(1) coefficient(s), e.g. one value per column of X
+
+    Returns
+    -------
+    wX : ndarray
+        X whitened with the given AR(1) coefficients
+    """
+    X = np.asarray(X, np.float64)
+    shape = np.broadcast(X[..., 1:, :], rho).shape
+    wX = np.empty(shape[:-2] + X.shape[-2:])
+    wX[..., :1, :] = X[..., :1, :]
+    np.multiply(rho, X[..., :-1, :], out=wX[..., 1:, :])
+    np.subtract(X[..., 1:, :], wX[..., 1:, :], out=wX[..., 1:, :])
+    return wX
+
+
+def _bin_order(labels, n_bins):
+    """ Return the permutation that makes each bin of `labels` contiguous
+
+    Parameters
+    ----------
+    labels : array of shape (n_voxels,), dtype=int
+        bin index of each voxel, in [0, n_bins)
+
+    n_bins : int
+        number of bins
+
+    Returns
+    -------
+    order : array of shape (n_voxels,)
+        stable permutation sorting the voxels by bin
+
+    bounds : array of shape (n_bins + 1,)
+        voxels of bin k are ``order[bounds[k]:bounds[k + 1]]``
+    """
+    order = np.argsort(labels, kind='mergesort')
+    bounds = np.zeros(n_bins + 1, dtype=np.intp)
+    bounds[1:] = np.cumsum(np.bincount(labels, minlength=n_bins))
+    return order, bounds
+
+
+class BatchedARModel(object):
+    """ A family of AR(1) regression models sharing the same design.
+
+    Fitting this model is equivalent to fitting one ``ARModel(design, rho)``
+    per value of `rho` on the corresponding voxels, but the whitened designs
+    and their pseudo-inverses are computed as a single stacked batch, and the
+    data are reordered and whitened only once.
+
+    Parameters
+    ----------
+    design : array of shape (n_time_points, n_regressors)
+        The design matrix, shared by all models.
+
+    rho : array of shape (n_models,)
+        The AR(1) coefficient of each model.
+
+    dtype : numpy dtype or None, optional
+        If not None, floating point type in which the data, parameters and
+        residuals are handled by `fit`, e.g. np.float32. The design-sized
+        quantities are always computed in float64. Defaults to float64.
+
+    Attributes
+    ----------
+    wdesign : array of shape (n_models, n_time_points, n_regressors)
+        The whitened design matrices.
+
+    calc_beta : array of shape (n_models, n_regressors, n_time_points)
+        The pseudo-inverses of the whitened design matrices.
+
+    normalized_cov_beta : array of shape (n_models, n_regressors,
+        n_regressors)
+        ``np.dot(calc_beta[k], calc_beta[k].T)`` for each model k.
+
+    df_resid : scalar
+        Degrees of freedom of the residuals, identical for all models.
+
+    df_model : scalar
+        Degrees of freedom of the model, identical for all models.
+    """
+
+    def __init__(self, design, rho, dtype=None):
+        self.design = design
+        self.rho = np.atleast_1d(np.asarray(rho, np.float64))
+        self.dtype = dtype
+        self.order = 1
+        self.wdesign = _ar1_whiten(design[np.newaxis],
+                                   self.rho[:, np.newaxis, np.newaxis])
+        # batched pseudo-inverses, through one stacked SVD
+        u, s, vt = np.linalg.svd(self.wdesign, full_matrices=False)
+        cutoff = 1e-15 * s.max(axis=-1)[:, np.newaxis]
+        s_inv = positive_reciprocal(np.where(s > cutoff, s, 0))
+        v_s_inv = np.transpose(vt, (0, 2, 1)) * s_inv[:, np.newaxis]
+        self.calc_beta = np.matmul(v_s_inv, np.transpose(u, (0, 2, 1)))
+        self.normalized_cov_beta = np.matmul(v_s_inv,
+                                             np.transpose(v_s_inv, (0, 2, 1)))
+        self.df_total = self.wdesign.shape[1]
+
+        # the rank is that of the unwhitened design, as in ARModel
+        eps = np.abs(self.design).sum() * np.finfo(np.float).eps
+        self.df_model = _matrix_rank(self.design, eps)
+        self.df_resid = self.df_total - self.df_model
+
+    def whiten(self, Y, labels):
+        """ Whiten the columns of `Y`, each with the AR(1) coefficient of
+        its model
+
+        Parameters
+        ----------
+        Y : array of shape (n_time_points, n_voxels)
+            data to whiten
+
+        labels : array of shape (n_voxels,), dtype=int
+            index of the model of each voxel
+
+        Returns
+        -------
+        wY : array of shape (n_time_points, n_voxels)
+            whitened data
+        """
+        return _ar1_whiten(Y, self.rho[labels])
+
+    def model(self, k):
+        """ Return the ARModel instance equivalent to the k-th model,
+        without recomputing its pseudo-inverse
+        """
+        model = ARModel.__new__(ARModel)
+        model.order = 1
+        model.rho = self.rho[k:k + 1]
+        model.design = self.design
+        model.wdesign = self.wdesign[k]
+        model.calc_beta = self.calc_beta[k]
+        model.normalized_cov_beta = self.normalized_cov_beta[k]
+        model.df_total = self.df_total
+        model.df_model = self.df_model
+        model.df_resid = self.df_resid
+        model.dtype = self.dtype
+        return model
+
+    def _fit_sorted(self, Y, labels):
+        """ Fit the models to the voxels reordered by model
+
+        Returns the permutation and bin bounds of ``_bin_order``, and the
+        voxel-major data, whitened data, parameters, whitened residuals and
+        dispersions of the reordered voxels.
+        """
+        labels = np.asarray(labels)
+        dtype = np.dtype(self.dtype)
+        order, bounds = _bin_order(labels, self.rho.size)
+        # voxel-major layout, so that the voxels of each bin are contiguous
+        Yt = np.asarray(Y).T[order]
+        rho = self.rho[labels[order]][:, np.newaxis].astype(dtype)
+        wYt = np.empty(Yt.shape, dtype)
+        wYt[:, :1] = Yt[:, :1]
+        np.multiply(rho, Yt[:, :-1], out=wYt[:, 1:], casting='unsafe')
+        np.subtract(Yt[:, 1:], wYt[:, 1:], out=wYt[:, 1:], casting='unsafe')
+        calc_beta = self.calc_beta.astype(dtype, copy=False)
+        wdesign = self.wdesign.astype(dtype, copy=False)
+        theta = np.empty((Yt.shape[0], self.wdesign.shape[2]), dtype)
+        wresid = np.empty(Yt.shape, dtype)
+        dispersion = np.empty(Yt.shape[0])
+        for k in np.flatnonzero(np.diff(bounds)):
+            bin_ = slice(bounds[k], bounds[k + 1])
+            np.dot(wYt[bin_], calc_beta[k].T, out=theta[bin_])
+            np.dot(theta[bin_], wdesign[k].T, out=wresid[bin_])
+            np.subtract(wYt[bin_], wresid[bin_], out=wresid[bin_])
+            dispersion[bin_] = (
+                np.einsum('ij,ij->i', wresid[bin_], wresid[bin_],
+                          dtype=np.float64) /
+                (self.wdesign.shape[1] - self.wdesign.shape[2]))
+        return order, bounds, Yt, wYt, theta, wresid, dispersion
+
+    def fit(self, Y, labels):
+        """ Fit each model to the columns of `Y` it is associated with
+
+        Parameters
+        ----------
+        Y : array of shape (n_time_points, n_voxels)
+            The dependent variables.
+
+        labels : array of shape (n_voxels,), dtype=int
+            Index of the model of each voxel.
+
+        Returns
+        -------
+        results : dict
+            Keys are the indices of the models that have at least one voxel,
+            values are the corresponding RegressionResults. The voxels of
+            each model keep their relative order in `Y`.
+        """
+        _, bounds, Yt, wYt, theta, wresid, dispersion = self._fit_sorted(
+            Y, labels)
+        results = {}
+        for k in np.flatnonzero(np.diff(bounds)):
+            bin_ = slice(bounds[k], bounds[k + 1])
+            results[k] = RegressionResults(
+                theta[bin_].T, Yt[bin_].T, self.model(k), wYt[bin_].T,
+                wresid[bin_].T, dispersion=dispersion[bin_],
+                cov=self.normalized_cov_beta[k])
+        return results
+
+    def fit_compact(self, Y, labels, return_residuals=False):
+        """ Fit each model to the columns of `Y` it is associated with,
+        only keeping the parameters and dispersion estimates
+
+        Parameters
+        ----------
+        Y : array of shape (n_time_points, n_voxels)
+            The dependent variables.
+
+        labels : array of shape (n_voxels,), dtype=int
+            Index of the model of each voxel.
+
+        return_residuals : bool, optional
+            Whether to also return the whitened data and residuals.
+
+        Returns
+        -------
+        theta : array of shape (n_regressors, n_voxels)
+            The parameter estimates, in the voxel order of `Y`.
+
+        dispersion : array of shape (n_voxels,)
+            The dispersion estimates, in the voxel order of `Y`.
+
+        wY : array of shape (n_time_points, n_voxels)
+            The whitened data, in the voxel order of `Y`. Only returned
+            if `return_residuals` is True.
+
+        wresid : array of shape (n_time_points, n_voxels)
+            The whitened residuals, in the voxel order of `Y`. Only returned
+            if `return_residuals` is True.
+        """
+        order, _, _, wYt, theta_, wresid_, dispersion_ = self._fit_sorted(
+            Y, labels)
+        theta = np.empty(theta_.T.shape, theta_.dtype)
+        theta[:, order] = theta_.T
+        dispersion = np.empty_like(dispersion_)
+        dispersion[order] = dispersion_
+        if not return_residuals:
+            return theta, dispersion
+        wY = np.empty(wYt.T.shape, wYt.dtype)
+        wY[:, order] = wYt.T
+        wresid = np.empty(wresid_.T.shape, wresid_.dtype)
+        wresid[:, order] = wresid_.T
+        return theta, dispersion, wY, wresid
+
+
 class RegressionResults(LikelihoodModelResults):
     """
     This class summarizes the fit of a linear regression model.
@@ -387,3 +660,372 @@ class SimpleRegressionResults(LikelihoodModelResults):
         # the LikelihoodModelResults has parameters named 'theta'
         X = self.model.design
         return np.dot(X, beta)
+
+
+def _simple_results(theta, cov, dispersion, model):
+    """ Build SimpleRegressionResults directly from the estimates of `model`,
+    when the full RegressionResults were never materialized
+
+    Parameters
+    ----------
+    theta : array of shape (n_regressors, n_voxels)
+        parameter estimates
+
+    cov : array of shape (n_regressors, n_regressors)
+        normalized covariance of the parameter estimates
+
+    dispersion : array of shape (n_voxels,)
+        dispersion estimates
+
+    model : OLSModel, ARModel or BatchedARModel instance
+        model used to generate the fit
+
+    Returns
+    -------
+    results : SimpleRegressionResults
+    """
+    results = SimpleRegressionResults.__new__(SimpleRegressionResults)
+    results.theta = theta
+    results.cov = cov
+    results.dispersion = dispersion
+    results.nuisance = None
+    results.df_total = model.df_total
+    results.df_model = model.df_model
+    results.df_resid = results.df_total - results.df_model
+    return results
+
+
+class PackedRegressionResults(Mapping):
+    """ Compact results of a GLM fitted with one model per AR(1) bin.
+
+    The parameter and dispersion estimates of all the voxels are stored in
+    contiguous arrays, next to the stack of the normalized covariances of
+    the bins and the bin index of each voxel. It behaves as the dict that
+    maps the AR(1) coefficient of each bin to the SimpleRegressionResults of
+    its voxels, which are built on access.
+
+    Parameters
+    ----------
+    theta : array of shape (n_regressors, n_voxels)
+        parameter estimates
+
+    dispersion : array of shape (n_voxels,)
+        dispersion estimates
+
+    cov : array of shape (n_bins, n_regressors, n_regressors)
+        normalized covariance of the parameter estimates of each bin
+
+    bin_index : array of shape (n_voxels,), dtype=int
+        bin of each voxel
+
+    rho : array of shape (n_bins,)
+        sorted AR(1) coefficients of the bins, which are the keys of the
+        results (0 for an OLS model)
+
+    df_total : int
+        number of observations
+
+    df_model : int
+        rank of the design
+
+    Attributes
+    ----------
+    bin_index : array of shape (n_voxels,)
+        bin of each voxel, stored in the smallest unsigned integer type
+        able to hold n_bins values (uint8 for up to 256 bins)
+
+    df_resid : int
+        residual degrees of freedom
+    """
+
+    def __init__(self, theta, dispersion, cov, bin_index, rho, df_total,
+                 df_model):
+        self.rho = np.atleast_1d(np.asarray(rho, np.float64))
+        self.theta = np.asarray(theta)
+        self.dispersion = np.asarray(dispersion, np.float64)
+        self.cov = np.asarray(cov, np.float64).reshape(
+            (self.rho.size,) + self.theta.shape[:1] * 2)
+        self.bin_index = np.asarray(
+            bin_index, np.min_scalar_type(max(self.rho.size - 1, 0)))
+        self.df_total = df_total
+        self.df_model = df_model
+        self.df_resid = df_total - df_model
+
+    @property
+    def labels(self):
+        """ AR(1) coefficient of each voxel, the labels returned by run_glm
+        """
+        return self.rho[self.bin_index]
+
+    def __getitem__(self, key):
+        k = np.searchsorted(self.rho, key)
+        if k == self.rho.size or self.rho[k] != key:
+            raise KeyError(key)
+        mask = self.bin_index == k
+        return _simple_results(self.theta[:, mask], self.cov[k],
+                               self.dispersion[mask], self)
+
+    def __iter__(self):
+        return iter(self.rho.tolist())
+
+    def __len__(self):
+        return self.rho.size
+
+
+def _pack_results(labels, results):
+    """ Pack the dict of results of run_glm, keyed by the values of
+    `labels`, in a PackedRegressionResults. Packed results are returned
+    unchanged.
+    """
+    if isinstance(results, PackedRegressionResults):
+        return results
+    rho = np.array(sorted(results), dtype=np.float64)
+    bin_index = np.searchsorted(rho, labels)
+    first = results[rho[0]]
+    theta = np.empty((np.shape(first.theta)[0], bin_index.size),
+                     np.asarray(first.theta).dtype)
+    dispersion = np.empty(bin_index.size)
+    for k, val in enumerate(rho):
+        mask = bin_index == k
+        theta[:, mask] = results[val].theta
+        dispersion[mask] = results[val].dispersion
+    cov = np.array([results[val].cov for val in rho])
+    return PackedRegressionResults(theta, dispersion, cov, bin_index, rho,
+                                   first.df_total, first.df_model)
+
+
+def _pinv_sym(matrices):
+    """ Pseudo-inverses of a stack of symmetric positive semi-definite
+    matrices of shape (..., p, p), from one stacked eigendecomposition """
+    eigvals, eigvecs = np.linalg.eigh(matrices)
+    cutoff = (matrices.shape[-1] * np.finfo(np.float64).eps *
+              np.abs(eigvals).max(axis=-1))
+    inv_eigvals = np.where(eigvals > cutoff[..., np.newaxis],
+                           1. / np.where(eigvals == 0, 1, eigvals), 0)
+    return np.einsum('...ij,...j,...kj->...ik', eigvecs, inv_eigvals, eigvecs)
+
+
+class SufficientStatistics(object):
+    """ Running sufficient statistics of the GLM of one run.
+
+    The cross products of the design X and of the data Y, and their lag-1
+    counterparts, are accumulated over blocks of scans. The OLS fit, the
+    AR(1) estimates of its residuals and the AR(1) refits of the voxels are
+    then computed exactly from them, at a cost that does not depend on the
+    number of scans.
+
+    Attributes
+    ----------
+    n_scans : int
+        number of scans accumulated so far
+
+    XtX : array of shape (n_regressors, n_regressors)
+        sum over t of x_t x_t^T
+
+    XtY : array of shape (n_regressors, n_voxels)
+        sum over t of x_t y_t^T
+
+    YtY : array of shape (n_voxels,)
+        sum over t of y_t ** 2
+
+    XlX : array of shape (n_regressors, n_regressors)
+        sum over t > 0 of x_t x_{t-1}^T
+
+    XlY : array of shape (n_regressors, n_voxels)
+        sum over t > 0 of x_t y_{t-1}^T
+
+    lXY : array of shape (n_regressors, n_voxels)
+        sum over t > 0 of x_{t-1} y_t^T
+
+    YlY : array of shape (n_voxels,)
+        sum over t > 0 of y_t y_{t-1}
+
+    x_sum, y_sum : arrays of shape (n_regressors,) and (n_voxels,)
+        sums over t of x_t and y_t
+
+    x_first, y_first, x_last, y_last : arrays
+        first and last rows of the design and of the data
+
+    x_abs_sum : float
+        sum of the absolute values of the design, used for its rank
+    """
+
+    def __init__(self):
+        self.n_scans = 0
+
+    def update(self, X, Y):
+        """ Accumulate a new block of scans
+
+        Parameters
+        ----------
+        X : array of shape (n_block_scans, n_regressors)
+            rows of the design matrix for the new scans
+
+        Y : array of shape (n_block_scans, n_voxels) or (n_voxels,)
+            data of the new scans
+
+        Returns
+        -------
+        self : SufficientStatistics
+        """
+        X = np.atleast_2d(np.asarray(X, np.float64))
+        Y = np.atleast_2d(np.asarray(Y, np.float64))
+        if X.shape[0] != Y.shape[0]:
+            raise ValueError(
+                'The number of rows of Y should match the number of rows of '
+                'X. You provided X with shape {0} and Y with shape {1}'.
+                format(X.shape, Y.shape))
+        if self.n_scans == 0:
+            p, v = X.shape[1], Y.shape[1]
+            self.XtX, self.XlX = np.zeros((p, p)), np.zeros((p, p))
+            self.XtY, self.XlY = np.zeros((p, v)), np.zeros((p, v))
+            self.lXY = np.zeros((p, v))
+            self.YtY, self.YlY = np.zeros(v), np.zeros(v)
+            self.x_sum, self.y_sum = np.zeros(p), np.zeros(v)
+            self.x_abs_sum = 0.
+            self.x_first, self.y_first = X[0].copy(), Y[0].copy()
+            Xl, Yl = X, Y
+        else:
+            # the first new scan is lagged with the last accumulated one
+            Xl = np.vstack((self.x_last, X))
+            Yl = np.vstack((self.y_last, Y))
+        self.XtX += np.dot(X.T, X)
+        self.XtY += np.dot(X.T, Y)
+        self.YtY += np.einsum('ij,ij->j', Y, Y)
+        self.XlX += np.dot(Xl[1:].T, Xl[:-1])
+        self.XlY += np.dot(Xl[1:].T, Yl[:-1])
+        self.lXY += np.dot(Xl[:-1].T, Yl[1:])
+        self.YlY += np.einsum('ij,ij->j', Yl[1:], Yl[:-1])
+        self.x_sum += X.sum(0)
+        self.y_sum += Y.sum(0)
+        self.x_abs_sum += np.abs(X).sum()
+        self.x_last, self.y_last = X[-1].copy(), Y[-1].copy()
+        self.n_scans += X.shape[0]
+        return self
+
+    def scaled(self, mean):
+        """ Statistics of the data mean-scaled as 100 * (Y / mean - 1)
+
+        Parameters
+        ----------
+        mean : float or array of shape (n_voxels,)
+            the mean of the data, see first_level_model.mean_scaling
+
+        Returns
+        -------
+        stats : SufficientStatistics
+            the statistics of the scaled data, with the same design
+        """
+        scale, n = 100. / np.asarray(mean, np.float64), self.n_scans
+        stats = SufficientStatistics.__new__(SufficientStatistics)
+        stats.__dict__.update(self.__dict__)
+        stats.XtY = scale * self.XtY - 100 * self.x_sum[:, np.newaxis]
+        stats.XlY = (scale * self.XlY -
+                     100 * (self.x_sum - self.x_first)[:, np.newaxis])
+        stats.lXY = (scale * self.lXY -
+                     100 * (self.x_sum - self.x_last)[:, np.newaxis])
+        stats.YtY = (scale ** 2 * self.YtY - 200 * scale * self.y_sum +
+                     1e4 * n)
+        stats.YlY = (scale ** 2 * self.YlY - 100 * scale *
+                     (2 * self.y_sum - self.y_first - self.y_last) +
+                     1e4 * (n - 1))
+        stats.y_sum = scale * self.y_sum - 100 * n
+        stats.y_first = scale * self.y_first - 100
+        stats.y_last = scale * self.y_last - 100
+        return stats
+
+    def fit(self, noise_model='ar1', bins=100):
+        """ Fit the GLM from the statistics, as run_glm does from the data
+
+        Parameters
+        ----------
+        noise_model : {'ar1', 'ols'}, optional
+            The temporal variance model. Defaults to 'ar1'.
+
+        bins : int, optional
+            Maximum number of discrete bins for the AR(1) coef histogram.
+
+        Returns
+        -------
+        labels : array of shape (n_voxels,),
+            A map of values on voxels used to identify the corresponding
+            model.
+
+        results : PackedRegressionResults
+            The results of the fit
+        """
+        n, p = self.n_scans, self.XtX.shape[0]
+        if noise_model == 'ar1':
+            beta = np.dot(_pinv_sym(self.XtX), self.XtY)
+            # sums of squares and lag-1 products of the OLS residuals
+            rss = self.YtY - np.einsum('iv,iv->v', beta, self.XtY)
+            lag = (self.YlY - np.einsum('iv,iv->v', beta,
+                                        self.XlY + self.lXY) +
+                   np.einsum('iv,ij,jv->v', beta, self.XlX, beta))
+            labels = (lag / rss * bins).astype(np.int) * 1. / bins
+            rho, bin_index = np.unique(labels, return_inverse=True)
+        elif noise_model == 'ols':
+            labels = np.zeros(self.XtY.shape[1])
+            rho = np.zeros(1)
+            bin_index = np.zeros(labels.size, dtype=np.intp)
+        else:
+            raise ValueError(
+                "Acceptable noise models are {0}. You provided "
+                "'noise_model={1}'".format(['ar1', 'ols'], noise_model))
+
+        # cross products of the AR(1)-whitened design and data, whose first
+        # scan is left unchanged
+        XpX = self.XtX - np.outer(self.x_last, self.x_last)
+        wXtwX = (self.XtX - rho[:, None, None] * (self.XlX + self.XlX.T) +
+                 rho[:, None, None] ** 2 * XpX)
+        cov = _pinv_sym(wXtwX)
+        r = rho[bin_index]
+        wXtwY = (self.XtY - r * (self.XlY + self.lXY) + r ** 2 *
+                 (self.XtY - np.outer(self.x_last, self.y_last)))
+        wYtwY = (self.YtY - 2 * r * self.YlY +
+                 r ** 2 * (self.YtY - self.y_last ** 2))
+        order, bounds = _bin_order(bin_index, rho.size)
+        theta = np.empty_like(wXtwY)
+        for k in np.flatnonzero(np.diff(bounds)):
+            voxels = order[bounds[k]:bounds[k + 1]]
+            theta[:, voxels] = np.dot(cov[k], wXtwY[:, voxels])
+        rss = wYtwY - np.einsum('iv,iv->v', theta, wXtwY)
+        dispersion = np.maximum(rss, 0) / (n - p)
+
+        singular_values = np.sqrt(np.maximum(np.linalg.eigvalsh(self.XtX), 0))
+        df_model = np.sum(
+            singular_values > self.x_abs_sum * np.finfo(np.float).eps)
+        results = PackedRegressionResults(theta, dispersion, cov, bin_index,
+                                          rho, n, df_model)
+        return labels, results
+
+    def save(self, filename):
+        """ Save the statistics in a .npz file, see load_statistics
+
+        Parameters
+        ----------
+        filename : str
+            path of the file
+        """
+        np.savez(filename, **self.__dict__)
+
+
+def load_statistics(filename):
+    """ Load SufficientStatistics saved with SufficientStatistics.save
+
+    Parameters
+    ----------
+    filename : str
+        path of the .npz file
+
+    Returns
+    -------
+    stats : SufficientStatistics
+    """
+    stats = SufficientStatistics.__new__(SufficientStatistics)
+    with np.load(filename) as data:
+        for name in data.files:
+            stats.__dict__[name] = data[name]
+    stats.n_scans = int(stats.n_scans)
+    stats.x_abs_sum = float(stats.x_abs_sum)
+    return stats
@@ -10,6 +10,7 @@ Author: Martin Perez-Guevara, 2016
 
 import sys
 import time
+from collections import OrderedDict
 from warnings import warn
 
 import pandas as pd
@@ -26,12 +27,18 @@ from sklearn.externals.joblib import Memory
 
 from .first_level_model import FirstLevelModel
 from .first_level_model import run_glm
-from .regression import SimpleRegressionResults
+from .glm_cache import GLMCache, _fingerprint
+from .regression import _pack_results
 from .contrasts import compute_contrast, expression_to_contrast_vector
 from .utils import _basestring
 from .design_matrix import make_second_level_design_matrix
+from nistats._utils.gzip_index import load_niimgs
 from nistats._utils.helpers import replace_parameters
 
+# number of fits of first level contrasts kept by a SecondLevelModel, when
+# minimize_memory is True
+FITS_CACHE_SIZE = 16
+
 
 def _check_second_level_input(second_level_input, design_matrix,
                               confounds=None, flm_object=True, df_object=True):
@@ -221,6 +228,14 @@ def _infer_effect_maps(second_level_input, contrast_def):
     else:
         effect_maps = second_level_input
 
+    return effect_maps
+
+
+def _load_effect_maps(effect_maps, n_jobs=1):
+    """Load the effect maps given as files with n_jobs threads, and check
+    the effect maps"""
+    effect_maps = load_niimgs(effect_maps, n_jobs=n_jobs)
+
     # check niimgs
     for niimg in effect_maps:
         check_niimg(niimg, ensure_ndim=3)
@@ -269,11 +284,25 @@ class SecondLevelModel(BaseEstimator, TransformerMixin, CacheMixin):
         further inspection of model details. This has an important impact
         on memory consumption. True by default.
 
+    dtype : numpy dtype or None, optional
+        If not None, floating point type of the masked effect maps and of
+        the GLM fit, e.g. np.float32 to halve the memory used by the fit.
+        The covariances of the parameters are always computed in float64.
+        Defaults to float64.
+
+    glm_cache : str or GLMCache or None, optional
+        If not None, cache of the GLM fits of compute_contrast, or its
+        directory. A fit is found in the cache from the path, size and
+        modification time of the effect map files, or digests of the effect
+        maps, the mask and parameters of the masker and a digest of the
+        design matrix, without loading the effect maps. Used only when
+        minimize_memory is True.
+
     """
     @replace_parameters({'mask': 'mask_img'}, end_version='next')
     def __init__(self, mask_img=None, smoothing_fwhm=None,
                  memory=Memory(None), memory_level=1, verbose=0,
-                 n_jobs=1, minimize_memory=True):
+                 n_jobs=1, minimize_memory=True, dtype=None, glm_cache=None):
         self.mask_img = mask_img
         self.smoothing_fwhm = smoothing_fwhm
         if isinstance(memory, _basestring):
@@ -284,6 +313,11 @@ class SecondLevelModel(BaseEstimator, TransformerMixin, CacheMixin):
         self.verbose = verbose
         self.n_jobs = n_jobs
         self.minimize_memory = minimize_memory
+        self.dtype = dtype
+        if isinstance(glm_cache, _basestring):
+            self.glm_cache = GLMCache(glm_cache)
+        else:
+            self.glm_cache = glm_cache
         self.second_level_input_ = None
         self.confounds_ = None
 
@@ -402,6 +436,9 @@ class SecondLevelModel(BaseEstimator, TransformerMixin, CacheMixin):
                     warn('Parameter %s of the masker overriden' % param_name)
                 setattr(self.masker_, param_name, our_param)
         self.masker_.fit(sample_map)
+        # GLM fits of the effect maps of the last first level contrasts,
+        # reused by compute_contrast
+        self._fits = OrderedDict()
 
         # Report progress
         if self.verbose > 0:
@@ -410,12 +447,65 @@ class SecondLevelModel(BaseEstimator, TransformerMixin, CacheMixin):
 
         return self
 
+    def _fit_effect_maps(self, first_level_contrast):
+        """Fit the GLM of the effect maps of first_level_contrast, or find
+        it in glm_cache
+
+        Returns
+        -------
+        labels, results :
+            As returned by run_glm, packed if minimize_memory is True.
+        """
+        # Get effect_maps appropriate for chosen contrast
+        effect_maps = _infer_effect_maps(self.second_level_input_,
+                                         first_level_contrast)
+        # Check design matrix X and effect maps Y agree on number of rows
+        _check_effect_maps(effect_maps, self.design_matrix_)
+
+        # The fit found in the cache is neither loaded nor computed
+        key, cached = None, None
+        if self.glm_cache is not None and self.minimize_memory:
+            key = self.glm_cache.key('second_level', effect_maps,
+                                     self.masker_, self.design_matrix_,
+                                     self.dtype)
+            cached = self.glm_cache.get(key)
+        if cached is not None:
+            labels, results = cached
+        else:
+            effect_maps = _load_effect_maps(effect_maps,
+                                            n_jobs=self.n_jobs)
+            # Fit an Ordinary Least Squares regression for parametric
+            # statistics
+            Y = self.masker_.transform(effect_maps)
+            if self.dtype is not None:
+                Y = np.asarray(Y, self.dtype)
+            if self.memory:
+                mem_glm = self.memory.cache(run_glm, ignore=['n_jobs'])
+            else:
+                mem_glm = run_glm
+            labels, results = mem_glm(Y, self.design_matrix_.values,
+                                      n_jobs=self.n_jobs, noise_model='ols',
+                                      dtype=self.dtype)
+            if key is not None:
+                self.glm_cache.put(key, labels, results)
+
+        # We save memory if inspecting model details is not necessary
+        if self.minimize_memory:
+            results = _pack_results(labels, results)
+        return labels, results
+
     def compute_contrast(
             self, second_level_contrast=None, first_level_contrast=None,
             second_level_stat_type=None, output_type='z_score'):
         """Generate different outputs corresponding to
         the contrasts provided e.g. z_map, t_map, effects and variance.
 
+        The effect maps of each first_level_contrast are loaded, masked and
+        fitted once after fit: the following calls with the same
+        first_level_contrast only compute the second level contrast. The
+        fits of the last FITS_CACHE_SIZE first level contrasts are kept, or
+        of the last one only if minimize_memory is False.
+
         Parameters
         ----------
         second_level_contrast: str or array of shape (n_col), optional
@@ -470,30 +560,21 @@ class SecondLevelModel(BaseEstimator, TransformerMixin, CacheMixin):
                        'effect_variance', 'all']
         _check_output_type(output_type, valid_types)
 
-        # Get effect_maps appropriate for chosen contrast
-        effect_maps = _infer_effect_maps(self.second_level_input_,
-                                         first_level_contrast)
-        # Check design matrix X and effect maps Y agree on number of rows
-        _check_effect_maps(effect_maps, self.design_matrix_)
-
-        # Fit an Ordinary Least Squares regression for parametric statistics
-        Y = self.masker_.transform(effect_maps)
-        if self.memory:
-            mem_glm = self.memory.cache(run_glm, ignore=['n_jobs'])
-        else:
-            mem_glm = run_glm
-        labels, results = mem_glm(Y, self.design_matrix_.values,
-                                  n_jobs=self.n_jobs, noise_model='ols')
-
-        # We save memory if inspecting model details is not necessary
-        if self.minimize_memory:
-            for key in results:
-                results[key] = SimpleRegressionResults(results[key])
-        self.labels_ = labels
-        self.results_ = results
-
-        # We compute contrast object
-        if self.memory:
+        # The maps of a first level contrast are masked and fitted once, for
+        # all the second level contrasts
+        fit_key = repr(_fingerprint(first_level_contrast))
+        fit = self._fits.pop(fit_key, None)
+        if fit is None:
+            fit = self._fit_effect_maps(first_level_contrast)
+        self.labels_, self.results_ = fit
+        # the least recently used fits are evicted first
+        self._fits[fit_key] = fit
+        while len(self._fits) > (FITS_CACHE_SIZE if self.minimize_memory
+                                 else 1):
+            self._fits.popitem(last=False)
+
+        # We compute contrast object, cheaply from the cached results
+        if self.memory and self.glm_cache is None:
             mem_contrast = self.memory.cache(compute_contrast)
         else:
             mem_contrast = compute_contrast
@@ -645,7 +726,8 @@ def non_parametric_inference(
     contrast = _get_contrast(second_level_contrast, design_matrix)
 
     # Get effect_maps
-    effect_maps = _infer_effect_maps(second_level_input, None)
+    effect_maps = _load_effect_maps(
+        _infer_effect_maps(second_level_input, None), n_jobs=n_jobs)
 
     # Check design matrix and effect maps agree on number of rows
     _check_effect_maps(effect_maps, design_matrix)
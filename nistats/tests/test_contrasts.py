@@ -2,12 +2,18 @@ from __future__ import with_statement
 
 import numpy as np
 
+from nose.tools import (assert_equal,
+                        assert_true,
+                        )
 from numpy.testing import assert_almost_equal
 from sklearn.datasets import make_regression
 from sklearn.linear_model import LinearRegression
 
 from nistats.first_level_model import run_glm
-from nistats.contrasts import (_fixed_effect_contrast,
+from nistats.regression import _pack_results
+from nistats.contrasts import (_F_contrast,
+                               _fixed_effect_contrast,
+                               _inverse_sqrtm,
                                compute_contrast,
                                expression_to_contrast_vector
                                )
@@ -40,6 +46,23 @@ def test_Tcontrast():
     assert_almost_equal(z_vals.std(), 1, 0)
 
 
+def test_Tcontrast_packed():
+    n, p, q = 100, 80, 10
+    X, Y = np.random.randn(p, q), np.random.randn(p, n)
+    labels, results = run_glm(Y, X, 'ar1')
+    con_val = np.random.randn(q)
+    effect, variance = np.zeros(n), np.zeros(n)
+    for label_ in results:
+        tcontrast = results[label_].Tcontrast(con_val)
+        effect[labels == label_] = tcontrast.effect
+        variance[labels == label_] = tcontrast.sd ** 2
+    for results_ in [results, _pack_results(labels, results)]:
+        con = compute_contrast(labels, results_, con_val)
+        assert_almost_equal(con.effect[0], effect)
+        assert_almost_equal(con.variance, variance)
+        assert_equal(con.dof, p - q)
+
+
 def test_Fcontrast():
     # new API
     n, p, q = 100, 80, 10
@@ -53,6 +76,48 @@ def test_Fcontrast():
             assert_almost_equal(z_vals.std(), 1, 0)
 
 
+def test_Fcontrast_packed():
+    from scipy.linalg import sqrtm
+    n, p, q = 100, 80, 10
+    X, Y = np.random.randn(p, q), np.random.randn(p, n)
+    labels, results = run_glm(Y, X, 'ar1')
+    con_val = np.random.randn(3, q)
+    effect, variance = np.zeros((3, n)), np.zeros(n)
+    for label_ in results:
+        invcov = np.linalg.inv(
+            results[label_].vcov(matrix=con_val, dispersion=1.))
+        effect[:, labels == label_] = np.dot(
+            sqrtm(invcov), np.dot(con_val, results[label_].theta))
+        variance[labels == label_] = results[label_].dispersion
+    for results_ in [results, _pack_results(labels, results)]:
+        con = compute_contrast(labels, results_, con_val)
+        assert_almost_equal(con.effect, effect)
+        assert_almost_equal(con.variance, variance)
+        # streaming the voxels by small chunks gives the same effects
+        assert_almost_equal(
+            _F_contrast(labels, results_, con_val, chunk_size=7)[0], effect)
+
+
+def test_inverse_sqrtm():
+    rng = np.random.RandomState(42)
+    A = rng.randn(2, 4, 4)
+    matrices = np.einsum('kij,klj->kil', A, A)
+    whitening = _inverse_sqrtm(matrices)
+    for k in range(2):
+        assert_almost_equal(
+            np.dot(whitening[k], np.dot(matrices[k], whitening[k])),
+            np.eye(4))
+    # the round-off eigenvalues of rank deficient matrices are ignored
+    A[:, :, 2:] = 0
+    matrices = np.einsum('kij,klj->kil', A, A)
+    whitening = _inverse_sqrtm(matrices)
+    for k in range(2):
+        projector = np.dot(whitening[k], np.dot(matrices[k], whitening[k]))
+        assert_almost_equal(projector, np.dot(projector, projector))
+        assert_almost_equal(np.trace(projector), 2)
+        assert_true(np.abs(whitening[k]).max() < 1e3)
+
+
 def test_t_contrast_add():
     # new API
     n, p, q = 100, 80, 10
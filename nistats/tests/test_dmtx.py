@@ -15,7 +15,8 @@ import pandas as pd
 from nibabel.tmpdirs import InTemporaryDirectory
 from nilearn._utils.testing import assert_raises_regex
 
-from nistats.design_matrix import (_convolve_regressors,
+from nistats.design_matrix import (_cond_exceeds,
+                                   _convolve_regressors,
                                    _cosine_drift,
                                    check_design_matrix,
                                    make_first_level_design_matrix,
@@ -23,6 +24,7 @@ from nistats.design_matrix import (_convolve_regressors,
                                    )
 
 
+from nistats.hemodynamic_models import compute_regressor
 from nose.tools import assert_true, assert_equal, assert_raises
 from numpy.testing import assert_almost_equal, assert_array_equal
 
@@ -170,6 +172,27 @@ def test_convolve_regressors():
     assert_equal(names, ['c0', 'c1'])
 
 
+def test_convolve_regressors_many_events():
+    # the events of interleaved conditions are grouped by condition
+    rng = np.random.RandomState(42)
+    n_events = 5000
+    events = pd.DataFrame({'trial_type': rng.choice(['c2', 'c0', 'c1'],
+                                                    n_events),
+                           'onset': rng.uniform(0, 190, n_events),
+                           'duration': rng.choice([0, .5, 2], n_events),
+                           'modulation': rng.randn(n_events)})
+    frame_times = np.arange(100) * 2.
+    X, names = _convolve_regressors(events, 'spm + derivative', frame_times)
+    assert_equal(names, ['c0', 'c0_derivative', 'c1', 'c1_derivative',
+                         'c2', 'c2_derivative'])
+    for k, condition in enumerate(['c0', 'c1', 'c2']):
+        condition_events = events[events.trial_type == condition]
+        reg, _ = compute_regressor(condition_events[['onset', 'duration',
+                                                     'modulation']].values.T,
+                                   'spm + derivative', frame_times)
+        assert_almost_equal(X[:, 2 * k:2 * k + 2], reg)
+
+
 def test_design_matrix1():
     # basic test based on basic_paradigm and glover hrf
     tr = 1.0
@@ -540,3 +563,33 @@ def test_create_second_level_design():
     assert_array_equal(design, expected_design)
     assert_true(len(design.columns) == 2)
     assert_true(len(design) == 2)
+
+
+def test_create_second_level_design_checks():
+    regressors = pd.DataFrame({'subject_label': ['03', '01', '02', '03'],
+                               'f1': [1, 2, 3, 4], 'f2': [.5, 0, 1, 3]},
+                              columns=['subject_label', 'f1', 'f2'])
+    design = make_second_level_design_matrix(['02', '01', '02'], regressors)
+    assert_array_equal(design.columns, ['f1', 'f2', 'intercept'])
+    assert_array_equal(design, [[3, 1, 1], [2, 0, 1], [3, 1, 1]])
+    assert_equal(design.values.dtype, np.float)
+    # the first subject with no row or several rows is reported
+    assert_raises_regex(ValueError, 'more than one row for subject 03',
+                        make_second_level_design_matrix,
+                        ['01', '03', '04'], regressors)
+    assert_raises_regex(ValueError, 'not specified for subject 04',
+                        make_second_level_design_matrix,
+                        ['01', '04', '03'], regressors)
+    design = make_second_level_design_matrix(['01', '02'])
+    assert_array_equal(design, [[1], [1]])
+
+
+def test_cond_exceeds():
+    rng = np.random.RandomState(42)
+    X = rng.randn(200, 10)
+    assert_true(not _cond_exceeds(X, X.size))
+    X[:, 9] = X[:, :3].sum(1)
+    assert_true(_cond_exceeds(X, X.size))
+    X[:, 9] += 1e-6 * rng.randn(200)
+    assert_equal(_cond_exceeds(X, 1e5), np.linalg.cond(X) > 1e5)
+    assert_equal(_cond_exceeds(X, 1e7), np.linalg.cond(X) > 1e7)
@@ -7,6 +7,7 @@ from __future__ import with_statement
 
 import os
 import shutil
+import threading
 import warnings
 
 import numpy as np
@@ -23,7 +24,9 @@ from numpy.testing import (assert_almost_equal,
                            assert_array_equal,
                            )
 from nibabel.tmpdirs import InTemporaryDirectory
+from nilearn.image import index_img
 
+from nistats import first_level_model
 from nistats.design_matrix import (check_design_matrix,
                                    make_first_level_design_matrix,
                                    )
@@ -31,8 +34,12 @@ from nistats.first_level_model import (first_level_models_from_bids,
                                        FirstLevelModel,
                                        mean_scaling,
                                        run_glm,
+                                       _beta_series,
+                                       _prefetch,
                                        )
+from nistats.regression import PackedRegressionResults, load_statistics
 from nistats.utils import get_bids_files
+from nistats._utils.gzip_index import load_niimg
 from nistats._utils.testing import (_create_fake_bids_dataset,
                                     _generate_fake_fmri_data,
                                     _write_fake_fmri_data,
@@ -167,11 +174,401 @@ def test_run_glm():
     tmp = sum([val.theta.shape[1] for val in results.values()])
     assert_equal(tmp, n)
 
+    # the parallel fit, on memory-mapped data, yields the same models
+    labels_, results_ = run_glm(Y, X, 'ar1', n_jobs=2)
+    assert_array_equal(labels_, labels)
+    assert_equal(sorted(results_.keys()), sorted(results.keys()))
+    for key in results:
+        assert_almost_equal(results_[key].theta, results[key].theta)
+        assert_almost_equal(results_[key].wresid, results[key].wresid)
+        assert_array_equal(results_[key].Y, results[key].Y)
+        assert_true(not isinstance(results_[key].wY, np.memmap))
+
     # non-existant case
     assert_raises(ValueError, run_glm, Y, X, 'ar2')
     assert_raises(ValueError, run_glm, Y, X.T)
 
 
+def test_run_glm_block_size():
+    n, p, q = 100, 80, 10
+    X, Y = np.random.randn(p, q), np.random.randn(p, n)
+    for noise_model in ['ols', 'ar1']:
+        labels, results = run_glm(Y, X, noise_model)
+        for n_jobs in [1, 2]:
+            labels_, results_ = run_glm(Y, X, noise_model, n_jobs=n_jobs,
+                                        block_size=30)
+            assert_array_equal(labels_, labels)
+            assert_equal(sorted(results_.keys()), sorted(results.keys()))
+            for key in results:
+                assert_almost_equal(results_[key].theta, results[key].theta)
+                assert_almost_equal(results_[key].dispersion,
+                                    results[key].dispersion)
+                assert_equal(results_[key].df_resid, results[key].df_resid)
+
+
+def test_run_glm_float32():
+    rng = np.random.RandomState(42)
+    n, p, q = 100, 80, 10
+    X, Y = rng.randn(p, q), rng.randn(p, n)
+    for noise_model in ['ols', 'ar1']:
+        labels, results = run_glm(Y, X, noise_model)
+        labels_, results_ = run_glm(Y, X, noise_model, dtype=np.float32)
+        assert_array_equal(labels_, labels)
+        for key in results:
+            assert_equal(results_[key].theta.dtype, np.float32)
+            assert_equal(results_[key].wresid.dtype, np.float32)
+            assert_equal(results_[key].cov.dtype, np.float64)
+            assert_almost_equal(results_[key].theta, results[key].theta, 5)
+            assert_almost_equal(results_[key].dispersion,
+                                results[key].dispersion, 5)
+
+
+def test_high_level_glm_block_size():
+    shapes, rk = ((7, 8, 7, 15), (7, 8, 7, 16)), 3
+    mask, fmri_data, design_matrices = _generate_fake_fmri_data(shapes, rk)
+    model = FirstLevelModel(mask_img=mask).fit(
+        fmri_data, design_matrices=design_matrices)
+    block_model = FirstLevelModel(mask_img=mask, block_size=50).fit(
+        fmri_data, design_matrices=design_matrices)
+    for results in model.results_ + block_model.results_:
+        assert_true(isinstance(results, PackedRegressionResults))
+    z_image = model.compute_contrast(np.eye(rk)[1])
+    block_z_image = block_model.compute_contrast(np.eye(rk)[1])
+    assert_almost_equal(block_z_image.get_data(), z_image.get_data())
+    with warnings.catch_warnings(record=True) as warning_list:
+        warnings.simplefilter('always')
+        FirstLevelModel(mask_img=mask, block_size=50,
+                        minimize_memory=False).fit(
+            fmri_data[0], design_matrices=design_matrices[0])
+    assert_true(any('block_size' in str(warning_.message)
+                    for warning_ in warning_list))
+
+
+def test_high_level_glm_float32():
+    shapes, rk = ((7, 8, 7, 15), (7, 8, 7, 16)), 3
+    mask, fmri_data, design_matrices = _generate_fake_fmri_data(shapes, rk)
+    model = FirstLevelModel(mask_img=mask).fit(
+        fmri_data, design_matrices=design_matrices)
+    model32 = FirstLevelModel(mask_img=mask, dtype=np.float32).fit(
+        fmri_data, design_matrices=design_matrices)
+    assert_equal(model32.results_[0][model32.labels_[0][0]].theta.dtype,
+                 np.float32)
+    z_image = model.compute_contrast(np.eye(rk)[1])
+    z_image32 = model32.compute_contrast(np.eye(rk)[1])
+    assert_almost_equal(z_image32.get_data(), z_image.get_data(), 3)
+
+
+def test_high_level_glm_partial_fit():
+    shapes, rk = ((7, 8, 7, 15),), 3
+    mask, fmri_data, design_matrices = _generate_fake_fmri_data(shapes, rk)
+    model = FirstLevelModel(mask_img=mask).fit(
+        fmri_data[0], design_matrices=design_matrices[0])
+    z_image = model.compute_contrast(np.eye(rk)[1])
+    partial_model = FirstLevelModel(mask_img=mask)
+    assert_raises(ValueError, partial_model.partial_fit, fmri_data[0])
+    # stream single scans, then a block of scans
+    for scan in range(5):
+        partial_model.partial_fit(index_img(fmri_data[0], scan),
+                                  design_matrix=design_matrices[0])
+    partial_model.partial_fit(index_img(fmri_data[0], slice(5, 15)))
+    assert_equal(partial_model.sufficient_statistics_[0].n_scans, 15)
+    partial_z_image = partial_model.compute_contrast(np.eye(rk)[1])
+    assert_almost_equal(partial_z_image.get_data(), z_image.get_data())
+    assert_raises(ValueError, partial_model.partial_fit,
+                  index_img(fmri_data[0], 0))
+    # the first call after fit starts over, also when fit stored statistics
+    partial_model = FirstLevelModel(mask_img=mask, store_statistics=True)
+    partial_model.fit(fmri_data[0], design_matrices=design_matrices[0])
+    for start in (0, 5):
+        partial_model.partial_fit(
+            index_img(fmri_data[0], slice(start, start + 5)),
+            design_matrix=design_matrices[0][start:])
+        assert_equal(partial_model.sufficient_statistics_[0].n_scans, 5)
+        partial_model.fit(fmri_data[0], design_matrices=design_matrices[0])
+    partial_model.partial_fit(index_img(fmri_data[0], slice(0, 5)),
+                              design_matrix=design_matrices[0])
+    partial_model.partial_fit(index_img(fmri_data[0], slice(5, 15)))
+    assert_almost_equal(
+        partial_model.compute_contrast(np.eye(rk)[1]).get_data(),
+        z_image.get_data())
+
+
+def test_high_level_glm_from_statistics():
+    shapes, rk = ((7, 8, 7, 15), (7, 8, 7, 16)), 3
+    mask, fmri_data, design_matrices = _generate_fake_fmri_data(shapes, rk)
+    model = FirstLevelModel(mask_img=mask, store_statistics=True).fit(
+        fmri_data, design_matrices=design_matrices)
+    assert_equal(len(model.sufficient_statistics_), 2)
+    z_image = model.compute_contrast(np.eye(rk)[1])
+    model.fit_from_statistics()
+    assert_almost_equal(model.compute_contrast(np.eye(rk)[1]).get_data(),
+                        z_image.get_data())
+    # another noise model, without the data
+    ols_model = FirstLevelModel(mask_img=mask, noise_model='ols').fit(
+        fmri_data, design_matrices=design_matrices)
+    model.noise_model = 'ols'
+    model.fit_from_statistics()
+    assert_almost_equal(model.compute_contrast(np.eye(rk)[1]).get_data(),
+                        ols_model.compute_contrast(np.eye(rk)[1]).get_data())
+    # from saved statistics, in a new model
+    with InTemporaryDirectory():
+        for run, stats in enumerate(model.sufficient_statistics_):
+            stats.save('stats_%d.npz' % run)
+        new_model = FirstLevelModel(
+            mask_img=mask, noise_model='ols').fit_from_statistics(
+            [load_statistics('stats_%d.npz' % run) for run in range(2)],
+            design_matrices)
+    assert_almost_equal(new_model.compute_contrast('a').get_data(),
+                        ols_model.compute_contrast('a').get_data())
+    assert_raises(ValueError,
+                  FirstLevelModel(mask_img=mask).fit_from_statistics)
+    assert_raises(ValueError, new_model.fit_from_statistics,
+                  new_model.sufficient_statistics_, design_matrices[0])
+
+
+def test_high_level_glm_residuals_dir():
+    shapes, rk = ((7, 8, 7, 15), (7, 8, 7, 16)), 3
+    mask, fmri_data, design_matrices = _generate_fake_fmri_data(shapes, rk)
+    model = FirstLevelModel(mask_img=mask, minimize_memory=False).fit(
+        fmri_data, design_matrices=design_matrices)
+    assert_raises(ValueError, model.residuals)
+    with InTemporaryDirectory():
+        disk_model = FirstLevelModel(mask_img=mask,
+                                     residuals_dir='residuals').fit(
+            fmri_data, design_matrices=design_matrices)
+        for run in range(2):
+            labels = model.labels_[run]
+            for key, result in model.results_[run].items():
+                voxels = np.flatnonzero(labels == key)
+                assert_almost_equal(disk_model.residuals(run, voxels),
+                                    result.resid)
+                assert_almost_equal(disk_model.predicted(run, voxels),
+                                    result.predicted)
+        residuals = disk_model.residuals(1)
+        assert_equal(residuals.shape, (16, labels.size))
+        assert_almost_equal(disk_model.residuals(1, slice(2, 5), [0, 3]),
+                            residuals[[0, 3], 2:5])
+        # the fits sharing the directory write their own files
+        other_model = FirstLevelModel(mask_img=mask,
+                                      residuals_dir='residuals').fit(
+            fmri_data[::-1], design_matrices=design_matrices[::-1])
+        assert_equal(len(os.listdir('residuals')), 8)
+        assert_almost_equal(disk_model.residuals(1), residuals)
+        assert_almost_equal(other_model.residuals(0), residuals)
+        del disk_model, other_model, residuals
+
+
+def test_high_level_glm_parallel_runs():
+    shapes, rk = ((7, 8, 7, 15), (7, 8, 7, 16), (7, 8, 7, 14)), 3
+    mask, fmri_data, design_matrices = _generate_fake_fmri_data(shapes, rk)
+    model = FirstLevelModel(mask_img=mask).fit(
+        fmri_data, design_matrices=design_matrices)
+    parallel_model = FirstLevelModel(mask_img=mask, n_jobs_runs=2).fit(
+        fmri_data, design_matrices=design_matrices)
+    assert_equal(len(parallel_model.results_), 3)
+    for run in range(3):
+        assert_array_equal(parallel_model.labels_[run], model.labels_[run])
+        assert_array_equal(parallel_model.design_matrices_[run],
+                           design_matrices[run])
+    z = model.compute_contrast(np.eye(rk)[1]).get_data()
+    parallel_z = parallel_model.compute_contrast(np.eye(rk)[1]).get_data()
+    assert_almost_equal(parallel_z, z)
+
+
+def test_high_level_glm_prefetch():
+    shapes = ((7, 8, 7, 110), (7, 8, 7, 120), (7, 8, 7, 100))
+    mask, fmri_data, _ = _generate_fake_fmri_data(shapes)
+    events = [basic_paradigm()] * 3
+    model = FirstLevelModel(t_r=1., mask_img=mask).fit(fmri_data, events)
+    prefetch_model = FirstLevelModel(t_r=1., mask_img=mask, prefetch=1).fit(
+        fmri_data, events)
+    for run in range(3):
+        assert_array_equal(prefetch_model.labels_[run], model.labels_[run])
+        assert_array_equal(prefetch_model.design_matrices_[run],
+                           model.design_matrices_[run])
+    z = model.compute_contrast('c0 - c1').get_data()
+    assert_almost_equal(prefetch_model.compute_contrast('c0 - c1').get_data(),
+                        z)
+    confounds = [pd.DataFrame(np.zeros((n_scans, 1)))
+                 for n_scans in (110, 120, 10)]
+    assert_raises(ValueError, prefetch_model.fit, fmri_data, events,
+                  confounds)
+    # errors of the values computed in the background are raised when they
+    # are consumed
+    values = _prefetch(lambda x: 1 // x, [(2,), (1,), (0,), (3,)], 1)
+    assert_equal([next(values), next(values)], [0, 1])
+    assert_raises(ZeroDivisionError, next, values)
+    # the thread stops when the consumer stops, e.g. when a fit fails
+    n_threads = threading.active_count()
+    values = _prefetch(lambda x: x, [(0,), (1,), (2,), (3,)], 1)
+    assert_equal(next(values), 0)
+    values.close()
+    assert_equal(threading.active_count(), n_threads)
+    assert_raises(ValueError, FirstLevelModel(t_r=1., mask_img=mask,
+                                              noise_model='ar2',
+                                              prefetch=1).fit,
+                  fmri_data, events)
+    assert_equal(threading.active_count(), n_threads)
+
+
+def test_high_level_glm_slabs():
+    shapes, rk = ((7, 8, 7, 15), (7, 8, 7, 16)), 3
+    with InTemporaryDirectory():
+        mask, fmri_files, design_files = _write_fake_fmri_data(shapes, rk)
+        model = FirstLevelModel(mask_img=mask, smoothing_fwhm=2.).fit(
+            fmri_files, design_matrices=design_files)
+        slab_model = FirstLevelModel(mask_img=mask, smoothing_fwhm=2.,
+                                     slab_size=4).fit(
+            fmri_files, design_matrices=design_files)
+        z = model.compute_contrast(np.eye(rk)[1]).get_data()
+        assert_almost_equal(
+            slab_model.compute_contrast(np.eye(rk)[1]).get_data(), z)
+        # the scans of standardized runs are masked at once
+        with warnings.catch_warnings(record=True) as warning_list:
+            warnings.simplefilter('always')
+            FirstLevelModel(mask_img=mask, standardize=True,
+                            signal_scaling=False, slab_size=4).fit(
+                fmri_files, design_matrices=design_files)
+        assert_true(any('slab_size' in str(w.message) for w in warning_list))
+        del model, slab_model, z
+
+
+def test_high_level_glm_gzip_runs():
+    shapes = ((7, 8, 7, 15), (7, 8, 7, 16))
+    mask, fmri_data, designs = _generate_fake_fmri_data(shapes)
+    opened = []
+
+    def _load_niimg(filename):
+        opened.append(load_niimg(filename))
+        return opened[-1]
+
+    first_level_model.load_niimg = _load_niimg
+    try:
+        with InTemporaryDirectory():
+            fmri_files = ['run%d.nii.gz' % run for run in range(2)]
+            for img, fmri_file in zip(fmri_data, fmri_files):
+                img.to_filename(fmri_file)
+            # the runs are closed once masked
+            model = FirstLevelModel(mask_img=mask, slab_size=4).fit(
+                fmri_files, design_matrices=designs)
+            assert_equal(len(opened), 2)
+            assert_true(all(img.file_map['image'].fileobj.closed
+                            for img in opened))
+            assert_almost_equal(
+                model.compute_contrast(np.eye(3)[1]).get_data(),
+                FirstLevelModel(mask_img=mask).fit(
+                    fmri_data, design_matrices=designs).compute_contrast(
+                    np.eye(3)[1]).get_data())
+            # and are not opened by fits that fail on their header
+            del opened[:]
+            confounds = [pd.DataFrame(np.zeros((n_scans, 1)))
+                         for n_scans in (15, 10)]
+            assert_raises(ValueError,
+                          FirstLevelModel(t_r=1., mask_img=mask).fit,
+                          fmri_files, [basic_paradigm()] * 2, confounds)
+            assert_equal(opened, [])
+            del model, img
+    finally:
+        first_level_model.load_niimg = load_niimg
+
+
+def test_high_level_glm_cache():
+    shapes, rk = ((7, 8, 7, 15), (7, 8, 7, 16)), 3
+    with InTemporaryDirectory():
+        mask, fmri_files, design_files = _write_fake_fmri_data(shapes, rk)
+        model = FirstLevelModel(mask_img=mask, glm_cache='glm_cache').fit(
+            fmri_files, design_matrices=design_files)
+        assert_equal(len(os.listdir('glm_cache')), 2)
+        z = model.compute_contrast(np.eye(rk)[1]).get_data()
+        # the fits are read from the cache, without opening the runs
+        opened = []
+
+        def _load_niimg(filename):
+            opened.append(filename)
+            return load_niimg(filename)
+
+        first_level_model.load_niimg = _load_niimg
+        try:
+            cached_model = FirstLevelModel(mask_img=mask,
+                                           glm_cache='glm_cache').fit(
+                fmri_files, design_matrices=design_files)
+        finally:
+            first_level_model.load_niimg = load_niimg
+        assert_equal(opened, [])
+        assert_equal(len(os.listdir('glm_cache')), 2)
+        for run in range(2):
+            assert_array_equal(cached_model.labels_[run], model.labels_[run])
+            assert_array_equal(cached_model.results_[run].theta,
+                               model.results_[run].theta)
+        assert_almost_equal(
+            cached_model.compute_contrast(np.eye(rk)[1]).get_data(), z)
+        # another noise model or design are other fits
+        FirstLevelModel(mask_img=mask, noise_model='ols',
+                        glm_cache='glm_cache').fit(
+            fmri_files, design_matrices=design_files)
+        assert_equal(len(os.listdir('glm_cache')), 4)
+        designs = [pd.read_csv(design_file, index_col=0) * 2
+                   for design_file in design_files]
+        FirstLevelModel(mask_img=mask, glm_cache='glm_cache').fit(
+            fmri_files, design_matrices=designs)
+        assert_equal(len(os.listdir('glm_cache')), 6)
+        del model, cached_model
+
+
+def test_beta_series():
+    rng = np.random.RandomState(42)
+    n_scans, n_kernels, n_voxels = 80, 2, 10
+    conditions = np.array(['a', 'b', 'a', 'c', 'b', 'a'])
+    X = rng.randn(n_scans, conditions.size * n_kernels)
+    nuisance = np.column_stack((np.ones(n_scans),
+                                np.linspace(-1, 1, n_scans)))
+    Y = rng.randn(n_scans, n_voxels)
+    betas = _beta_series(X, nuisance, Y, conditions, n_kernels)
+    assert_equal(betas.shape, (conditions.size, n_voxels))
+    # the model of each trial, fitted on its own
+    blocks = np.split(X, conditions.size, axis=1)
+    for trial, block in enumerate(blocks):
+        others = [sum((blocks[other] for other in range(conditions.size)
+                       if conditions[other] == condition and other != trial),
+                      np.zeros_like(block))
+                  for condition in ['a', 'b', 'c']]
+        design = np.hstack([block] + others + [nuisance])
+        assert_almost_equal(betas[trial], np.dot(np.linalg.pinv(design),
+                                                 Y)[0])
+
+
+def test_high_level_glm_beta_series():
+    rng = np.random.RandomState(42)
+    shape = (4, 5, 3, 60)
+    mask = Nifti1Image(np.ones(shape[:3], dtype=np.int8), np.eye(4))
+    fmri = Nifti1Image(100 + rng.randn(*shape), np.eye(4))
+    events = pd.DataFrame({'trial_type': ['a', 'b', 'a', 'c', 'b', 'a'],
+                           'onset': [6, 20, 40, 58, 80, 100],
+                           'duration': [1, 1, 2, 1, 1, 1]})
+    # each beta is the effect of its trial in its own model, whose
+    # derivatives are orthogonalized condition by condition
+    for hrf_model in ('glover', 'spm + derivative'):
+        model = FirstLevelModel(t_r=2, mask_img=mask, noise_model='ols',
+                                hrf_model=hrf_model)
+        beta_series = model.compute_beta_series(fmri, events)
+        assert_equal(beta_series.shape, shape[:3] + (6,))
+        for trial in range(6):
+            lss_events = events.copy()
+            lss_events.loc[trial, 'trial_type'] = 'trial'
+            lss_model = FirstLevelModel(t_r=2, mask_img=mask,
+                                        noise_model='ols',
+                                        hrf_model=hrf_model).fit(
+                fmri, lss_events)
+            effect = lss_model.compute_contrast('trial',
+                                                output_type='effect_size')
+            assert_almost_equal(beta_series.get_data()[..., trial],
+                                effect.get_data())
+    assert_raises(ValueError, FirstLevelModel(t_r=2, mask_img=mask,
+                                              hrf_model='fir'
+                                              ).compute_beta_series,
+                  fmri, events)
+
+
 def test_scaling():
     """Test the scaling function"""
     shape = (400, 10)
@@ -182,6 +579,11 @@ def test_scaling():
     assert_almost_equal(Y_.mean(0), 0, 5)
     assert_almost_equal(mean_, mean, 0)
     assert_true(Y.std() > 1)
+    Y_, _ = mean_scaling(Y, 1)
+    assert_almost_equal(Y_.mean(1), 0, 5)
+    Y_, mean_ = mean_scaling(Y.astype(np.float32))
+    assert_equal(Y_.dtype, np.float32)
+    assert_almost_equal(Y_.mean(0), 0, 4)
 
 
 def test_fmri_inputs():
@@ -360,6 +762,35 @@ def test_first_level_model_contrast_computation():
         del func_img, FUNCFILE, model
 
 
+def test_first_level_model_contrasts_computation():
+    shapes, rk = ((7, 8, 7, 15), (7, 8, 7, 16)), 3
+    mask, fmri_data, design_matrices = _generate_fake_fmri_data(shapes, rk)
+    c1, c2, cnull = np.eye(rk)[0], np.eye(rk)[1], np.zeros(rk)
+    contrasts = {'c1': c1, 'c1 - c2': [c1 - c2, c1 - c2],
+                 'c2 once': [c2, cnull], 'formula': 'a - c',
+                 'F': np.eye(rk)[:2], 'row': c1[np.newaxis]}
+    for minimize_memory in [True, False]:
+        model = FirstLevelModel(mask_img=mask,
+                                minimize_memory=minimize_memory)
+        assert_raises(ValueError, model.compute_contrasts, contrasts)
+        model = model.fit(fmri_data, design_matrices=design_matrices)
+        outputs = model.compute_contrasts(contrasts, output_type='all')
+        assert_equal(sorted(outputs.keys()), sorted(contrasts.keys()))
+        for name, contrast_def in contrasts.items():
+            expected = model.compute_contrast(contrast_def, output_type='all')
+            for output_type, output in expected.items():
+                assert_almost_equal(outputs[name][output_type].get_data(),
+                                    output.get_data())
+        z_maps = model.compute_contrasts(contrasts, as_4d=True)
+        assert_equal(z_maps.shape, shapes[0][:3] + (len(contrasts),))
+        for volume, name in enumerate(contrasts):
+            assert_almost_equal(z_maps.get_data()[..., volume],
+                                outputs[name]['z_score'].get_data())
+        assert_raises(ValueError, model.compute_contrasts, {'null': cnull})
+        assert_raises(ValueError, model.compute_contrasts, [c1])
+        assert_raises(ValueError, model.compute_contrasts, contrasts, '')
+
+
 def test_first_level_models_from_bids():
     with InTemporaryDirectory():
         bids_path = _create_fake_bids_dataset(n_sub=10, n_ses=2,
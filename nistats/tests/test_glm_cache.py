@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+
+from nibabel import Nifti1Image
+from nibabel.tmpdirs import InTemporaryDirectory
+from nilearn.input_data import NiftiMasker
+from nose.tools import (assert_equal,
+                        assert_not_equal,
+                        assert_true,
+                        )
+from numpy.testing import (assert_almost_equal,
+                           assert_array_equal,
+                           )
+
+from nistats.first_level_model import run_glm
+from nistats.glm_cache import GLMCache, _digest
+
+
+def test_glm_cache():
+    rng = np.random.RandomState(42)
+    X, Y = rng.randn(40, 3), rng.randn(40, 200)
+    with InTemporaryDirectory():
+        cache = GLMCache('cache')
+        key = cache.key(X, 'ar1')
+        assert_equal(key, cache.key(X.copy(), 'ar1'))
+        assert_not_equal(key, cache.key(X, 'ols'))
+        assert_not_equal(key, cache.key(X[::-1], 'ar1'))
+        # the arrays are identified by their values, not their layout
+        assert_equal(key, cache.key(np.asfortranarray(X), 'ar1'))
+        assert_not_equal(_digest(np.asfortranarray(X)),
+                         _digest(np.ascontiguousarray(X.T)))
+        assert_not_equal(_digest(X), _digest(X.T.reshape(X.shape)))
+        assert_true(cache.get(key) is None)
+        labels, results = run_glm(Y, X, 'ar1')
+        cache.put(key, labels, results)
+        labels_, results_ = cache.get(key)
+        assert_array_equal(labels_, labels)
+        assert_equal(sorted(results_.keys()), sorted(results.keys()))
+        for rho, result in results.items():
+            assert_almost_equal(results_[rho].theta, result.theta)
+            assert_almost_equal(results_[rho].cov, result.cov)
+            assert_almost_equal(results_[rho].dispersion, result.dispersion)
+
+        # files are identified by their path, size and modification time
+        img = Nifti1Image(Y[:, :, np.newaxis, np.newaxis].T, np.eye(4))
+        img.to_filename('img.nii')
+        key = cache.key('img.nii')
+        assert_equal(cache.key('img.nii'), key)
+        os.utime('img.nii', (0, 0))
+        assert_not_equal(cache.key('img.nii'), key)
+
+        # and maskers by their mask and the parameters of the masked data
+        mask = Nifti1Image(np.ones((200, 1, 1), np.int8), np.eye(4))
+        masker = NiftiMasker(mask).fit()
+        key = cache.key(masker)
+        assert_equal(cache.key(NiftiMasker(mask).fit()), key)
+        assert_not_equal(cache.key(NiftiMasker(mask, dtype='float32').fit()),
+                         key)
+        assert_not_equal(cache.key(NiftiMasker(mask, detrend=True).fit()),
+                         key)
+
+        # the least recently used entries are evicted
+        entry = os.path.join('cache', cache.key(X, 'ar1'))
+        size = sum(os.path.getsize(os.path.join(entry, name))
+                   for name in os.listdir(entry))
+        cache = GLMCache('cache', max_bytes=2.5 * size)
+        cache.put(cache.key(X, 'ols'), labels, results)
+        os.utime(entry, (0, 0))
+        cache.get(cache.key(X, 'ols'))
+        cache.put(cache.key(Y), labels, results)
+        assert_equal(len(os.listdir('cache')), 2)
+        assert_true(cache.get(cache.key(X, 'ar1')) is None)
+        assert_true(cache.get(cache.key(X, 'ols')) is not None)
+        cache.clear()
+        assert_true(not os.path.exists('cache'))
@@ -0,0 +1,109 @@
+import gc
+import gzip
+import pickle
+import threading
+import time
+
+import numpy as np
+
+from nibabel import Nifti1Image
+from nibabel.tmpdirs import InTemporaryDirectory
+from nose.tools import (assert_equal,
+                        assert_raises,
+                        assert_true,
+                        )
+from numpy.testing import assert_array_equal
+
+from nistats._utils.gzip_index import (IndexedGzipFile,
+                                       load_niimg,
+                                       load_niimgs,
+                                       )
+
+
+def test_indexed_gzip_file():
+    rng = np.random.RandomState(42)
+    data = rng.randint(0, 20, 300000).astype(np.uint8).tobytes()
+    with InTemporaryDirectory():
+        # a file of two gzip members
+        for name, part in (('a.gz', data[:100000]), ('b.gz', data[100000:])):
+            with gzip.open(name, 'wb') as fileobj:
+                fileobj.write(part)
+        with open('ab.gz', 'wb') as fileobj:
+            for name in ('a.gz', 'b.gz'):
+                with open(name, 'rb') as member:
+                    fileobj.write(member.read())
+        with IndexedGzipFile('ab.gz', spacing=2 ** 14, readahead=2) as gz:
+            assert_equal(gz.read(), data)
+            assert_true(len(gz._index.points) > 10)
+            # random accesses restart from the seek points
+            for offset, size in ((250000, 1000), (10, 5), (99990, 30),
+                                 (299990, 100), (0, -1)):
+                assert_equal(gz.seek(offset), offset)
+                assert_equal(gz.read(size), data[offset:][:size]
+                             if size > 0 else data[offset:])
+            buffer = bytearray(50)
+            gz.seek(-50, 2)
+            assert_equal(gz.readinto(buffer), 50)
+            assert_equal(bytes(buffer), data[-50:])
+            assert_equal(gz.read(10), b'')
+            assert_raises(IOError, gz.write, b'')
+        assert_raises(ValueError, gz.read)
+        # the next files opened on ab.gz restart from the seek points found
+        with IndexedGzipFile('ab.gz', spacing=2 ** 14, readahead=2) as gz:
+            assert_true(len(gz._index.points) > 10)
+            assert_equal(gz.seek(0, 2), len(data))
+            gz.seek(250000)
+            assert_equal(gz.read(1000), data[250000:251000])
+            assert_true(0 < gz._inflater.offset <= 250000)
+        # until the file changes
+        with open('ab.gz', 'ab') as fileobj:
+            with open('a.gz', 'rb') as member:
+                fileobj.write(member.read())
+        with IndexedGzipFile('ab.gz', spacing=2 ** 14, readahead=2) as gz:
+            assert_equal(len(gz._index.points), 1)
+            assert_equal(gz.read(), data + data[:100000])
+
+
+def test_load_niimg():
+    rng = np.random.RandomState(42)
+    data = rng.randn(7, 8, 9, 20).astype(np.float32)
+    with InTemporaryDirectory():
+        Nifti1Image(data, np.eye(4)).to_filename('img.nii.gz')
+        Nifti1Image(data[..., 0], np.eye(4)).to_filename('img.nii')
+        img = load_niimg('img.nii.gz')
+        assert_equal(img.shape, data.shape)
+        assert_true(not img.in_memory)
+        assert_array_equal(np.asarray(img.dataobj[..., 15:18]),
+                           data[..., 15:18])
+        assert_array_equal(img.get_data(), data)
+        # the next loads of the file share its seek points
+        fileobj = img.file_map['image'].fileobj
+        assert_true(load_niimg('img.nii.gz').file_map['image'].fileobj._index
+                    is fileobj._index)
+        assert_array_equal(pickle.loads(pickle.dumps(img)).get_data(), data)
+        imgs = load_niimgs(['img.nii.gz', 'img.nii', img], n_jobs=2)
+        assert_array_equal(imgs[0].get_data(), data)
+        assert_array_equal(imgs[1].get_data(), data[..., 0])
+        assert_true(imgs[2] is img)
+        del img, imgs
+
+
+def test_load_niimg_threads():
+    # neither header loads nor partly read images leave inflating threads
+    data = np.arange(6 * 7 * 8 * 30, dtype=np.float32).reshape(6, 7, 8, 30)
+    n_threads = threading.active_count()
+    with InTemporaryDirectory():
+        Nifti1Image(data, np.eye(4)).to_filename('img.nii.gz')
+        imgs = [load_niimg('img.nii.gz', spacing=2 ** 12, readahead=1)
+                for _ in range(5)]
+        assert_equal(threading.active_count(), n_threads)
+        for img in imgs:
+            assert_array_equal(np.asarray(img.dataobj[..., :2]),
+                               data[..., :2])
+        del img, imgs
+        gc.collect()
+        for _ in range(50):
+            if threading.active_count() == n_threads:
+                break
+            time.sleep(.1)
+        assert_equal(threading.active_count(), n_threads)
@@ -2,17 +2,27 @@ import warnings
 
 import numpy as np
 
+from nose.tools import (assert_raises,
+                        assert_true,
+                        )
 from numpy.testing import (assert_almost_equal,
                            assert_array_equal,
                            assert_equal,
                            assert_warns,
                            )
 
-from nistats.hemodynamic_models import (_hrf_kernel,
+from nistats.hemodynamic_models import (HRF_CACHE_SIZE,
+                                        _compute_regressors,
+                                        _convolve_kernels,
+                                        _hrf_cache,
+                                        _hrf_kernel,
                                         _orthogonalize,
+                                        _registered_hrfs,
                                         _regressor_names,
                                         _resample_regressor,
+                                        _resampling_matrix,
                                         _sample_condition,
+                                        compute_continuous_regressor,
                                         compute_regressor,
                                         spm_dispersion_derivative,
                                         spm_hrf,
@@ -20,6 +30,7 @@ from nistats.hemodynamic_models import (_hrf_kernel,
                                         glover_dispersion_derivative,
                                         glover_hrf,
                                         glover_time_derivative,
+                                        register_hrf_kernel,
                                         )
 
 
@@ -80,6 +91,22 @@ def test_resample_regressor_nl():
     assert_almost_equal(z, np.cos(y), decimal=2)
 
 
+def test_resampling_matrix():
+    """ test that the resampling matrix interpolates several regressors
+    like interp1d, and is shared by the calls with the same timing
+    """
+    from scipy.interpolate import interp1d
+    rng = np.random.RandomState(42)
+    x = np.sort(rng.uniform(0, 10, 500))
+    y = np.linspace(x[0], x[-1], 30)
+    regressors = rng.randn(4, 500)
+    z = _resample_regressor(regressors, x, y)
+    assert_equal(z.shape, (30, 4))
+    assert_almost_equal(z, interp1d(x, regressors)(y).T)
+    assert_true(_resampling_matrix(x, y) is _resampling_matrix(x.copy(), y))
+    assert_raises(ValueError, _resampling_matrix, x, y + 1)
+
+
 def test_orthogonalize():
     """ test that the orthogonalization is OK """
     X = np.random.randn(100, 5)
@@ -213,6 +240,62 @@ def test_hkernel():
     assert_almost_equal(h[0], np.hstack((1, np.zeros(49))))
 
 
+def test_hkernel_cache():
+    """ test that the kernels are computed once, and shared read-only
+    """
+    tr = 2.5
+    h = _hrf_kernel('glover + derivative', tr)
+    h_ = _hrf_kernel('glover + derivative', tr)
+    assert_true(all(k is k_ for k, k_ in zip(h, h_)))
+    assert_true(not h[0].flags.writeable)
+    assert_true(_hrf_kernel('glover', tr)[0] is not h[0])
+    assert_true(_hrf_kernel('fir', tr, fir_delays=[1, 2])[0] is not
+                _hrf_kernel('fir', tr, fir_delays=[0, 2])[0])
+    # the delays are ignored by the other models
+    assert_true(_hrf_kernel('glover + derivative', tr,
+                            fir_delays=[1, 2])[0] is h[0])
+    for tr_ in np.linspace(1, 2, HRF_CACHE_SIZE + 1):
+        _hrf_kernel('spm', tr_)
+    assert_equal(len(_hrf_cache), HRF_CACHE_SIZE)
+    assert_true(_hrf_kernel('glover + derivative', tr)[0] is not h[0])
+
+
+def test_register_hrf_kernel():
+    """ test the regressors of registered kernels
+    """
+    tr, oversampling = 1., 16
+    kernels = [glover_hrf(tr, oversampling),
+               glover_time_derivative(tr, oversampling)]
+    register_hrf_kernel('My HRF', kernels, tr, oversampling)
+    try:
+        frame_times = np.linspace(0, 99, 100)
+        condition = ([10, 40, 70], [1, 1, 1], [1, 1, 1])
+        reg, names = compute_regressor(condition, 'my hrf', frame_times,
+                                       con_id='c', oversampling=oversampling)
+        reg_, _ = compute_regressor(condition, 'glover + derivative',
+                                    frame_times, con_id='c',
+                                    oversampling=oversampling)
+        assert_almost_equal(reg, reg_)
+        assert_equal(names, ['c', 'c_1'])
+        # the names are not case sensitive
+        assert_almost_equal(
+            compute_regressor(condition, 'My HRF', frame_times,
+                              oversampling=oversampling)[0], reg)
+        # the kernels are registered for one tr and oversampling
+        assert_raises(ValueError, compute_regressor, condition, 'my hrf',
+                      frame_times, oversampling=50)
+        assert_raises(ValueError, register_hrf_kernel, 'spm', kernels, tr)
+        assert_raises(ValueError, register_hrf_kernel, 'my hrf',
+                      kernels[:1], 2 * tr)
+        register_hrf_kernel('my hrf', kernels, 2 * tr, oversampling,
+                            suffixes=['', '_derivative'])
+        assert_equal(_regressor_names('c', 'MY HRF'),
+                     ['c', 'c_derivative'])
+    finally:
+        _registered_hrfs.pop('my hrf', None)
+        _hrf_cache.clear()
+
+
 def test_make_regressor_1():
     """ test the generated regressor
     """
@@ -248,6 +331,84 @@ def test_make_regressor_3():
     assert_equal(len(reg_names), 4)
 
 
+def test_sample_condition_coinciding_onsets():
+    """ test that the events on the same samples add up
+    """
+    rng = np.random.RandomState(42)
+    onsets = np.repeat(rng.uniform(0, 50, 20), 3) + rng.choice(
+        [0, .001], 60)
+    durations = rng.choice([0, 0, 2.5], 60)
+    values = rng.randn(60)
+    frame_times = np.linspace(0, 58, 30)
+    reg, hr_frame_times = _sample_condition((onsets, durations, values),
+                                            frame_times, oversampling=16)
+    reg_ = sum(_sample_condition(([onset], [duration], [value]),
+                                 frame_times, oversampling=16)[0]
+               for onset, duration, value in zip(onsets, durations, values))
+    assert_almost_equal(reg, reg_)
+
+
+def test_make_regressors():
+    """ test that the regressors of several conditions computed at once
+    match the regressors computed by condition
+    """
+    conditions = [([1, 20, 20, 36.5], [2, 2, 1, 2], [1, 1, 3, 1]),
+                  ([5, 50, 50.01], [0, 10, 0], [2, -1, 1]),
+                  ([80.], [0.], [1.])]
+    frame_times = np.linspace(0, 138, 70)
+    for hrf_model in ['spm + derivative + dispersion', 'glover', 'fir', None]:
+        reg, reg_names = _compute_regressors(
+            conditions, hrf_model, frame_times, ['a', 'b', 'c'],
+            fir_delays=np.arange(3))
+        regs, names = zip(*[compute_regressor(
+            condition, hrf_model, frame_times, con_id=con_id,
+            fir_delays=np.arange(3))
+            for condition, con_id in zip(conditions, ['a', 'b', 'c'])])
+        assert_almost_equal(reg, np.hstack(regs))
+        assert_equal(reg_names, sum(names, []))
+
+
+def test_convolve_kernels():
+    rng = np.random.RandomState(42)
+    regressors = rng.randn(5, 300)
+    hkernel = [rng.randn(100), rng.randn(7)]
+    conv_reg = _convolve_kernels(regressors, hkernel)
+    assert_equal(conv_reg.shape, (5, 2, 300))
+    assert_almost_equal(conv_reg, _convolve_kernels(regressors, hkernel,
+                                                    fft=False))
+    assert_almost_equal(conv_reg[3, 1], np.convolve(regressors[3],
+                                                    hkernel[1])[:300])
+
+
+def test_continuous_regressor():
+    """ test the filtering and resampling of a high rate signal
+    """
+    rate = 100.
+    sample_times = np.arange(0, 600, 1. / rate)
+    slow = np.sin(2 * np.pi * .02 * sample_times)
+    fast = np.sin(2 * np.pi * 10 * sample_times + .3)
+    frame_times = np.arange(290) * 2. + 1
+    reg, reg_names = compute_continuous_regressor(slow + fast, sample_times,
+                                                  frame_times)
+    assert_equal(reg_names, ['signal'])
+    # the fast oscillation is not aliased
+    assert_almost_equal(reg[10:-10, 0],
+                        np.sin(2 * np.pi * .02 * frame_times[10:-10]))
+    reg, reg_names = compute_continuous_regressor(
+        np.column_stack((slow, slow ** 2)), sample_times, frame_times,
+        'spm + derivative', con_id=['a', 'b'])
+    assert_equal(reg.shape, (290, 4))
+    assert_equal(reg_names, ['a', 'a_derivative', 'b', 'b_derivative'])
+    convolved = np.convolve(slow, _hrf_kernel('spm', 1. / rate, 1)[0])
+    assert_almost_equal(reg[20:-20, 0],
+                        convolved[(frame_times[20:-20] * rate).astype(int)],
+                        decimal=4)
+    assert_raises(ValueError, compute_continuous_regressor, slow,
+                  sample_times ** 1.01, frame_times)
+    assert_raises(ValueError, compute_continuous_regressor, slow,
+                  sample_times, frame_times, 'fir')
+
+
 def test_design_warnings():
     """ test that warnings are correctly raised upon weird design specification
     """
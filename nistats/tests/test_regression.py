@@ -2,11 +2,16 @@
 Test functions for models.regression
 """
 
+import pickle
+
 import numpy as np
 
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_raises, assert_true
+from numpy.testing import assert_almost_equal
 
-from nistats.regression import OLSModel, ARModel
+from nistats.regression import (ARModel, BatchedARModel, OLSModel,
+                                PackedRegressionResults, SufficientStatistics,
+                                _pack_results)
 
 
 RNG = np.random.RandomState(20110902)
@@ -26,6 +31,17 @@ def test_AR():
     assert_equal(results.df_resid, 30)
 
 
+def test_OLS_float32():
+    Y2 = RNG.standard_normal((40, 5))
+    results = OLSModel(design=X).fit(Y2)
+    results32 = OLSModel(design=X, dtype=np.float32).fit(Y2)
+    assert_equal(results32.theta.dtype, np.float32)
+    assert_equal(results32.wresid.dtype, np.float32)
+    assert_equal(results32.cov.dtype, np.float64)
+    assert_almost_equal(results32.theta, results.theta, 5)
+    assert_almost_equal(results32.dispersion, results.dispersion, 5)
+
+
 def test_OLS_degenerate():
     Xd = X.copy()
     Xd[:, 0] = Xd[:, 1] + Xd[:, 2]
@@ -40,3 +56,89 @@ def test_AR_degenerate():
     model = ARModel(design=Xd, rho=0.9)
     results = model.fit(Y)
     assert_equal(results.df_resid, 31)
+
+
+def test_batched_AR():
+    rho = np.array([-.2, 0., .4])
+    Yb = RNG.standard_normal((40, 9))
+    labels = np.array([2, 0, 2, 1, 0, 0, 2, 1, 2])
+    batched_results = BatchedARModel(X, rho).fit(Yb, labels)
+    assert_equal(sorted(batched_results.keys()), [0, 1, 2])
+    for k, result in batched_results.items():
+        reference = ARModel(X, rho[k]).fit(Yb[:, labels == k])
+        assert_almost_equal(result.theta, reference.theta)
+        assert_almost_equal(result.wresid, reference.wresid)
+        assert_almost_equal(result.dispersion, reference.dispersion)
+        assert_almost_equal(result.cov, reference.cov)
+        assert_almost_equal(result.Y, Yb[:, labels == k])
+        assert_equal(result.df_resid, reference.df_resid)
+
+
+def test_batched_AR_fit_compact():
+    rho = np.array([-.2, 0., .4])
+    Yb = RNG.standard_normal((40, 9))
+    labels = np.array([2, 0, 2, 1, 0, 0, 2, 1, 2])
+    model = BatchedARModel(X, rho)
+    theta, dispersion = model.fit_compact(Yb, labels)
+    for k, result in model.fit(Yb, labels).items():
+        assert_almost_equal(theta[:, labels == k], result.theta)
+        assert_almost_equal(dispersion[labels == k], result.dispersion)
+
+
+def test_batched_AR_empty_bin():
+    rho = np.array([0., .5])
+    results = BatchedARModel(X, rho).fit(
+        RNG.standard_normal((40, 3)), np.ones(3, dtype=int))
+    assert_equal(list(results.keys()), [1])
+    assert_equal(results[1].theta.shape, (10, 3))
+
+
+def test_packed_results():
+    rho = np.array([-.2, 0., .4])
+    Yb = RNG.standard_normal((40, 9))
+    labels = np.array([2, 0, 2, 1, 0, 0, 2, 1, 2])
+    results = dict((rho[k], result) for k, result in
+                   BatchedARModel(X, rho).fit(Yb, labels).items())
+    packed = _pack_results(rho[labels], results)
+    assert_true(isinstance(packed, PackedRegressionResults))
+    assert_true(_pack_results(rho[labels], packed) is packed)
+    assert_equal(packed.theta.shape, (10, 9))
+    assert_equal(packed.cov.shape, (3, 10, 10))
+    assert_equal(packed.bin_index.dtype, np.uint8)
+    assert_almost_equal(packed.labels, rho[labels])
+    assert_equal(sorted(packed.keys()), sorted(results.keys()))
+    assert_equal(len(packed), 3)
+    assert_raises(KeyError, packed.__getitem__, .1)
+    packed = pickle.loads(pickle.dumps(packed))
+    for key, result in results.items():
+        assert_almost_equal(packed[key].theta, result.theta)
+        assert_almost_equal(packed[key].dispersion, result.dispersion)
+        assert_almost_equal(packed[key].cov, result.cov)
+        assert_equal(packed[key].df_resid, result.df_resid)
+
+
+def test_sufficient_statistics():
+    Yb = RNG.standard_normal((40, 9)).cumsum(0) + 100
+    stats = SufficientStatistics()
+    for start in range(0, 40, 7):
+        stats.update(X[start:start + 7], Yb[start:start + 7])
+    assert_equal(stats.n_scans, 40)
+    results = OLSModel(X).fit(Yb)
+    labels, packed = stats.fit('ols')
+    assert_almost_equal(packed.theta, results.theta)
+    assert_almost_equal(packed.dispersion, results.dispersion)
+    assert_almost_equal(packed.cov[0], results.cov)
+    assert_equal(packed.df_resid, results.df_resid)
+    labels, packed = stats.fit('ar1')
+    for key in packed:
+        reference = ARModel(X, key).fit(Yb[:, labels == key])
+        assert_almost_equal(packed[key].theta, reference.theta)
+        assert_almost_equal(packed[key].dispersion, reference.dispersion)
+    # statistics of the scaled data
+    mean = Yb.mean(0)
+    labels, packed = stats.scaled(mean).fit('ols')
+    results = OLSModel(X).fit(100 * (Yb / mean - 1))
+    assert_almost_equal(packed.theta, results.theta)
+    assert_almost_equal(packed.dispersion, results.dispersion)
+    assert_raises(ValueError, stats.update, X[:2], Yb[:3])
+    assert_raises(ValueError, stats.fit, 'ar2')
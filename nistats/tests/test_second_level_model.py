@@ -390,6 +390,75 @@ def test_second_level_model_contrast_computation_with_memory_caching():
         del func_img, FUNCFILE, model, X, Y
 
 
+def test_second_level_model_contrast_computation_with_glm_cache():
+    with InTemporaryDirectory():
+        shapes = ((7, 8, 9, 1),)
+        mask, FUNCFILE, _ = _write_fake_fmri_data(shapes)
+        model = SecondLevelModel(mask_img=mask, glm_cache='glm_cache')
+        Y = FUNCFILE * 4
+        X = pd.DataFrame([[1]] * 4, columns=['intercept'])
+        model = model.fit(Y, design_matrix=X)
+        z_image = model.compute_contrast(output_type='z_score')
+        assert_equal(len(os.listdir('glm_cache')), 1)
+        # the fit is read from the cache
+        cached_z_image = model.compute_contrast(output_type='z_score')
+        assert_equal(len(os.listdir('glm_cache')), 1)
+        assert_array_equal(cached_z_image.get_data(), z_image.get_data())
+        uncached_model = SecondLevelModel(mask_img=mask).fit(
+            Y, design_matrix=X)
+        assert_almost_equal(
+            uncached_model.compute_contrast(output_type='z_score').get_data(),
+            z_image.get_data())
+        del z_image, cached_z_image, model, uncached_model
+
+
+def test_second_level_model_reuses_fits():
+    with InTemporaryDirectory():
+        shapes, rk = ((7, 8, 9, 10),), 3
+        mask, fmri_files, design_files = _write_fake_fmri_data(shapes, rk)
+        flm = FirstLevelModel(mask_img=mask).fit(
+            fmri_files, design_matrices=design_files)
+        columns = flm.design_matrices_[0].columns
+        # count the effect maps computed by the first level model
+        n_maps = []
+        compute_first_level_contrast = flm.compute_contrast
+
+        def counted_compute_contrast(*args, **kwargs):
+            n_maps.append(1)
+            return compute_first_level_contrast(*args, **kwargs)
+        flm.compute_contrast = counted_compute_contrast
+        X = pd.DataFrame({'intercept': np.ones(4), 'group': [1, 2, 3, 5]},
+                         columns=['intercept', 'group'])
+        model = SecondLevelModel(mask_img=mask).fit([flm] * 4,
+                                                    design_matrix=X)
+        del n_maps[:]
+        model.compute_contrast('intercept', first_level_contrast=columns[0])
+        results = model.results_
+        assert_equal(len(n_maps), 4)
+        # the maps and fit of a first level contrast are reused
+        z_image = model.compute_contrast('group',
+                                         first_level_contrast=columns[0])
+        assert_equal(len(n_maps), 4)
+        assert_true(model.results_ is results)
+        model.compute_contrast('group', first_level_contrast=columns[1])
+        assert_equal(len(n_maps), 8)
+        assert_true(model.results_ is not results)
+        model.compute_contrast('group', first_level_contrast=columns[0])
+        assert_true(model.results_ is results)
+        # the full results of one fit only are kept
+        model.minimize_memory = False
+        model.compute_contrast('group', first_level_contrast=columns[2])
+        assert_equal(len(model._fits), 1)
+        # fitting starts over
+        model.fit([flm] * 4, design_matrix=X)
+        del n_maps[:]
+        assert_array_equal(model.compute_contrast(
+            'group', first_level_contrast=columns[0]).get_data(),
+            z_image.get_data())
+        assert_equal(len(n_maps), 4)
+        del flm, model, z_image
+
+
 def test_param_mask_deprecation_SecondLevelModel():
     """ Tests whether use of deprecated keyword parameter `mask`
     raises the correct warning & transfers its value to
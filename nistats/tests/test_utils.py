@@ -30,6 +30,9 @@ from nistats.tests.test_datasets import setup_mock, teardown_mock
 from nistats.utils import (_check_run_tables,
                            _check_and_load_tables,
                            _check_list_length_match,
+                           _matrix_rank,
+                           _pinv,
+                           _svd,
                            full_rank,
                            get_bids_files,
                            get_design_from_fslmat,
@@ -52,6 +55,21 @@ def test_full_rank():
     assert_array_almost_equal(X, X_)
 
 
+def test_shared_svd():
+    rng = np.random.RandomState(42)
+    X = rng.randn(30, 6)
+    X[:, -1] = X[:, :2].sum(1)
+    # the factorization is computed once for equal matrices
+    assert_true(_svd(X) is _svd(X.copy()))
+    assert_true(_svd(X) is not _svd(X[:, :-1]))
+    assert_equal(_matrix_rank(X), np.linalg.matrix_rank(X))
+    assert_equal(_matrix_rank(X, tol=1e-20), 6)
+    pinv, cov = _pinv(X)
+    assert_array_almost_equal(pinv, np.linalg.pinv(X))
+    assert_array_almost_equal(cov, np.dot(pinv, pinv.T))
+    assert_raises(ValueError, _svd(X)[1].__setitem__, 0, 0)
+
+
 def test_z_score():
     p = np.random.rand(10)
     assert_array_almost_equal(norm.sf(z_score(p)), p)
@@ -82,6 +100,8 @@ def test_mahalanobis2():
     mah = np.dot(x[:, i], np.dot(spl.inv(Aa[:, :, i]), x[:, i]))
     f_mah = (multiple_mahalanobis(x, Aa))[i]
     assert_true(np.allclose(mah, f_mah))
+    assert_true(np.allclose(multiple_mahalanobis(x, Aa, chunk_size=2),
+                            multiple_mahalanobis(x, Aa)))
 
 
 def test_multiple_fast_inv():
@@ -91,8 +111,11 @@ def test_multiple_fast_inv():
     for i in range(shape[0]):
         X[i] = np.dot(X[i], X[i].T)
         X_inv_ref[i] = spl.inv(X[i])
+    X_inv = multiple_fast_inverse(X.copy(), chunk_size=3)
+    assert_almost_equal(X_inv_ref, X_inv)
     X_inv = multiple_fast_inverse(X)
     assert_almost_equal(X_inv_ref, X_inv)
+    assert_raises(ValueError, multiple_fast_inverse, np.zeros((2, 3, 3)))
 
 
 def test_pos_recipr():
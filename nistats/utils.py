@@ -4,9 +4,12 @@ Authors: Bertrand Thirion, Matthew Brett, 2015
 """
 import csv
 import glob
+import hashlib
 import os
 import sys
+import threading
 
+from collections import OrderedDict
 from warnings import warn
 
 import numpy as np
@@ -17,6 +20,11 @@ from scipy.stats import norm
 
 py3 = sys.version_info[0] >= 3
 
+# number of factorizations kept by _svd
+SVD_CACHE_SIZE = 8
+_svd_cache = OrderedDict()
+_svd_cache_lock = threading.Lock()
+
 
 def _check_list_length_match(list_1, list_2, var_name_1, var_name_2):
     """Check length match of two given lists to raise error if necessary"""
@@ -151,7 +159,7 @@ def z_score(pvalue):
     return norm.isf(pvalue)
 
 
-def multiple_fast_inverse(a):
+def multiple_fast_inverse(a, chunk_size=1000):
     """Compute the inverse of a set of arrays.
 
     Parameters
@@ -159,6 +167,9 @@ def multiple_fast_inverse(a):
     a: array_like of shape (n_samples, n_dim, n_dim)
         Set of square matrices to be inverted. A is changed in place.
 
+    chunk_size: int, optional
+        Number of matrices inverted at once by the stacked LAPACK calls.
+
     Returns
     -------
     a: ndarray
@@ -166,51 +177,26 @@ def multiple_fast_inverse(a):
 
     Raises
     ------
-    LinAlgError :
-        If `a` is singular.
     ValueError :
-        If `a` is not square, or not 2-dimensional.
+        If `a` is singular, or not of shape (n_samples, n_dim, n_dim).
 
     Notes
     -----
-    This function is borrowed from scipy.linalg.inv,
-    but with some customizations for speed-up.
+    The matrices are inverted by chunks with the stacked np.linalg.inv,
+    instead of one LAPACK call per matrix from Python.
     """
-    if a.shape[1] != a.shape[2]:
+    if a.ndim != 3 or a.shape[1] != a.shape[2]:
         raise ValueError('a must have shape (n_samples, n_dim, n_dim)')
-    from scipy.linalg.lapack import get_lapack_funcs
-    a1, n = a[0], a.shape[0]
-    getrf, getri = get_lapack_funcs(('getrf', 'getri'), (a1,))
-    getrf, getri, getri_lwork = get_lapack_funcs(
-        ('getrf', 'getri', 'getri_lwork'), (a1,))
-    for i in range(n):
-        if (getrf.module_name[:7] == 'clapack' and
-            getri.module_name[:7] != 'clapack'):
-            # ATLAS 3.2.1 has getrf but not getri.
-            lu, piv, info = getrf(np.transpose(a[i]), rowmajor=0,
-                                  overwrite_a=True)
-            a[i] = np.transpose(lu)
-        else:
-            a[i], piv, info = getrf(a[i], overwrite_a=True)
-        if info == 0:
-            if getri.module_name[:7] == 'flapack':
-                lwork, info_ = getri_lwork(a1.shape[0])
-                # XXX: the following line fixes curious SEGFAULT when
-                # benchmarking 500x500 matrix inverse. This seems to
-                # be a bug in LAPACK ?getri routine because if lwork is
-                # minimal (when using lwork[0] instead of lwork[1]) then
-                # all tests pass. Further investigation is required if
-                # more such SEGFAULTs occur.
-                lwork = int(1.01 * lwork.real)
-                a[i], _ = getri(a[i], piv, lwork=lwork, overwrite_lu=1)
-            else:  # clapack
-                a[i], _ = getri(a[i], piv, overwrite_lu=1)
-        else:
+    for start in range(0, a.shape[0], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        try:
+            a[chunk] = np.linalg.inv(a[chunk])
+        except np.linalg.LinAlgError:
             raise ValueError('Matrix LU decomposition failed')
     return a
 
 
-def multiple_mahalanobis(effect, covariance):
+def multiple_mahalanobis(effect, covariance, chunk_size=1000):
     """Returns the squared Mahalanobis distance for a given set of samples
 
     Parameters
@@ -221,10 +207,20 @@ def multiple_mahalanobis(effect, covariance):
     covariance: array of shape (n_features, n_features, n_samples),
         Corresponding covariance models stacked along the last axis
 
+    chunk_size: int, optional
+        Number of samples processed at once.
+
     Returns
     -------
     sqd: array of shape (n_samples,)
          the squared distances (one per sample)
+
+    Notes
+    -----
+    The distances are computed with stacked Cholesky factorizations and
+    solves of the covariances, by chunks of samples, without inverting the
+    covariances nor building (n_samples, n_features, n_features)
+    temporaries.
     """
     # check size
     if effect.ndim == 1:
@@ -236,15 +232,82 @@ def multiple_mahalanobis(effect, covariance):
     if covariance.shape[0] != covariance.shape[1]:
         raise ValueError('Inconsistant shape for covariance')
 
-    # transpose and make contuguous for the sake of speed
-    Xt, Kt = np.ascontiguousarray(effect.T), np.ascontiguousarray(covariance.T)
+    n_samples = effect.shape[1]
+    sqd = np.empty(n_samples)
+    for start in range(0, n_samples, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        # (n_chunk, n_features, n_features) and (n_chunk, n_features, 1)
+        Kt = np.transpose(covariance[:, :, chunk], (2, 0, 1))
+        Xt = effect[:, chunk].T[:, :, np.newaxis]
+        # with K = L L^T, x^T K^-1 x = |L^-1 x|^2
+        Lx = np.linalg.solve(np.linalg.cholesky(Kt), Xt)
+        sqd[chunk] = np.sum(Lx[:, :, 0] ** 2, axis=1)
+    return sqd
+
 
-    # compute the inverse of the covariances
-    Kt = multiple_fast_inverse(Kt)
+def _svd(X):
+    """ Thin singular value decomposition of X, shared by the computations
+    on the same matrix
 
-    # derive the squared Mahalanobis distances
-    sqd = np.sum(np.sum(Xt[:, :, np.newaxis] * Xt[:, np.newaxis] * Kt, 1), 1)
-    return sqd
+    The condition number and regularization of a design (full_rank), its
+    pseudo-inverse (_pinv) and its rank (_matrix_rank) are all derived from
+    this factorization. The factorizations of the most recent matrices are
+    kept in a bounded cache, keyed on a digest of their values, so that a
+    design is decomposed once while it is built and fitted.
+
+    Parameters
+    ----------
+    X : array of shape (nrows, ncols)
+        input array
+
+    Returns
+    -------
+    U, s, Vt : read-only arrays of shape (nrows, k), (k,) and (k, ncols)
+        with k = min(nrows, ncols), such that X = np.dot(U * s, Vt)
+    """
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    digest = hashlib.sha1(X)
+    digest.update(repr(X.shape).encode())
+    key = digest.hexdigest()
+    with _svd_cache_lock:
+        factorization = _svd_cache.pop(key, None)
+        if factorization is not None:
+            _svd_cache[key] = factorization
+            return factorization
+    factorization = spl.svd(X, full_matrices=False)
+    for array in factorization:
+        array.setflags(write=False)
+    with _svd_cache_lock:
+        _svd_cache[key] = factorization
+        while len(_svd_cache) > SVD_CACHE_SIZE:
+            _svd_cache.popitem(last=False)
+    return factorization
+
+
+def _matrix_rank(X, tol=None):
+    """ Rank of X, as numpy.linalg.matrix_rank, from the shared _svd """
+    s = _svd(X)[1]
+    if tol is None:
+        tol = s.max() * max(np.shape(X)) * np.finfo(s.dtype).eps
+    return int(np.sum(s > tol))
+
+
+def _pinv(X, rcond=1e-15):
+    """ Moore-Penrose pseudo-inverse of X from the shared _svd
+
+    Returns
+    -------
+    pinv : array of shape (ncols, nrows)
+        The pseudo-inverse of X.
+
+    normalized_cov : array of shape (ncols, ncols)
+        np.dot(pinv, pinv.T), computed from the factors at the cost of a
+        product of shape (ncols, ncols).
+    """
+    U, s, Vt = _svd(X)
+    s_inv = positive_reciprocal(np.where(s > rcond * s.max(), s, 0))
+    V_s_inv = Vt.T * s_inv
+    return np.dot(V_s_inv, U.T), np.dot(V_s_inv, V_s_inv.T)
 
 
 def full_rank(X, cmax=1e15):
@@ -267,7 +330,7 @@ def full_rank(X, cmax=1e15):
     cond : float,
         actual condition number
     """
-    U, s, V = spl.svd(X, full_matrices=False)
+    U, s, V = _svd(X)
     smax, smin = s.max(), s.min()
     cond = smax / smin
     if cond < cmax: